@@ -2,30 +2,34 @@ import os
 import re
 import sqlite3
 import random
-from flask import Flask, request, render_template, send_file, redirect, url_for, flash, jsonify, session
+from flask import Flask, Response, request, render_template, send_file, send_from_directory, redirect, url_for, flash, jsonify, session, make_response
+from werkzeug.http import http_date, parse_date
+from werkzeug.wsgi import ClosingIterator
 from urllib.parse import quote, unquote
 import threading
+import queue
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import psutil
 import socket
 import platform
 import subprocess
 import json
-
-def get_all_videos():
-    """Получает все видео из базы данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT filename, display_name, orientation 
-        FROM videos 
-        WHERE banned = 0 
-        ORDER BY created_at DESC
-    ''')
-    videos = cursor.fetchall()
-    conn.close()
-    return videos
+import select
+import struct
+import ctypes
+import hashlib
+import base64
+import multiprocessing
+import atexit
+import unicodedata
+import shutil
+import zlib
+import io
+import bisect
+import click
+from collections import namedtuple, OrderedDict, deque
+from types import MappingProxyType
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
@@ -42,238 +46,2007 @@ except ImportError:
 # Конфигурация
 VIDEO_FOLDER = r'E:\videos'  # Измените на абсолютный путь к папке с видео
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
+SCAN_RECURSIVE = True  # Искать видео и во вложенных папках
+SCAN_POLL_INTERVAL = 60  # Как часто проверять папку, если уведомления ФС недоступны (секунды)
+SCAN_WATCH_INTERVAL = 600  # Контрольная проверка при работающих уведомлениях (секунды)
+SCAN_SETTLE_SECONDS = 5  # Файлы, измененные недавно, считаются еще копирующимися
+SCAN_DEBOUNCE_SECONDS = 2  # Пауза после уведомления, чтобы собрать пачку изменений
 DATABASE_PATH = 'video_database.db'
+THUMBNAIL_FOLDER = 'thumbnails'  # Кэш превью, создается автоматически
+THUMBNAIL_WIDTH = 480  # Ширина превью в пикселях
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600  # Время кэширования превью браузером (секунды)
+THUMBNAIL_RETRY_SECONDS = 24 * 3600  # Через сколько снова пробовать получить кадр, если не получилось
+VIDEO_MAX_AGE = 3600  # Время кэширования видео браузером (секунды), затем проверка по ETag
+STREAM_CHUNK_SIZE = 256 * 1024  # Размер блока при отдаче видео без sendfile
+STREAM_MAX_RANGES = 16  # Больше диапазонов в одном запросе не обслуживаем, отдаем файл целиком
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Размер куска при загрузке частями (байты)
+UPLOAD_MAX_SIZE = 2 * 1024 ** 3  # Максимальный размер загружаемого файла (байты)
+UPLOAD_EXPIRE_HOURS = 24  # Через сколько часов без активности брошенная загрузка удаляется
+FASTSTART_ENABLED = True  # Переносить индекс MP4/MOV в начало файла для быстрого старта (нужен ffmpeg)
+FASTSTART_EXTENSIONS = {'mp4', 'mov'}
+FASTSTART_TIMEOUT = 3600  # Максимальное время перепаковки одного файла (секунды)
+HLS_ENABLED = True  # Готовить адаптивные потоки (HLS) для видео высокого разрешения (нужен ffmpeg)
+HLS_FOLDER = 'hls'  # Папка для HLS-версий, создается автоматически
+HLS_DISK_BUDGET = 20 * 1024 ** 3  # Сколько места можно занять под HLS (байты), старые версии удаляются
+HLS_MIN_SOURCE_HEIGHT = 720  # Готовить HLS, только если меньшая сторона кадра не меньше этого значения
+HLS_SEGMENT_SECONDS = 6  # Длительность одного сегмента HLS (секунды)
+HLS_WORKERS = 1  # Сколько видео перекодировать одновременно
+HLS_TRANSCODE_TIMEOUT = 6 * 3600  # Максимальное время перекодирования одного качества (секунды)
+HLS_RENDITIONS = [
+    # (имя, меньшая сторона кадра, битрейт видео, битрейт звука)
+    ('360p', 360, 800_000, 96_000),
+    ('720p', 720, 2_800_000, 128_000),
+]
+PAGE_SIZE = 24  # Размер страницы по умолчанию для /api/videos
+SEARCH_PAGE_SIZE = 48  # Сколько результатов поиска показывать за раз
+MAX_PAGE_SIZE = 100
+CATALOG_MAX_ITEMS = 200000  # Больше видео в памяти не держим, читаем из БД
+SHORTS_FEED_MAX_SESSIONS = 5000  # Сколько лент shorts хранить в памяти
+SHORTS_FEED_HISTORY = 200  # Сколько просмотренных shorts помнить для кнопки "назад"
+SHORTS_FEED_IDLE_SECONDS = 6 * 3600  # Ленту сессии, не открывавшей shorts столько времени, убираем из памяти
+SHORTS_FEED_PERSIST = True  # Сохранять историю навигации shorts в БД (переживает перезапуск и вытеснение)
+SHORTS_FEED_FLUSH_INTERVAL = 5  # Как часто записывать измененные ленты в БД (секунды)
+SHORTS_FEED_PERSIST_DAYS = 30  # Сколько дней хранить в БД навигацию неактивных сессий
+SHORTS_BATCH_MAX = 10  # Сколько следующих shorts можно запросить за раз (/api/shorts/batch)
+SHORTS_PRELOAD_COUNT = 2  # Для скольких следующих shorts браузер заранее загружает начало
+SHORTS_PREFETCH_BYTES = 1024 * 1024  # Сколько байт с начала файла загружать заранее
+DB_POOL_SIZE = 16  # Сколько свободных соединений с БД держать открытыми
+DB_BUSY_TIMEOUT = 30  # Сколько секунд ждать освобождения блокировки записи
+PROBE_WORKERS = 0  # Сколько процессов анализируют видео (0 - по числу ядер)
+PROBE_IO_CONCURRENCY = 2  # Сколько файлов читать одновременно, если папка на HDD
+PROBE_TIMEOUT = 120  # Сколько секунд ждать анализа одного файла
+PROBE_BATCH_SIZE = 50  # Сколько результатов анализа записывать в БД за раз
+VIEW_FLUSH_INTERVAL = 5  # Как часто записывать накопленные просмотры в БД (секунды)
+VIEW_FLUSH_THRESHOLD = 500  # Записать раньше, если накопилось столько просмотров
+VIEW_DEDUPE_SECONDS = 300  # Повторный просмотр того же видео в сессии за это время не считается
+VIEW_DEDUPE_MAX_ENTRIES = 100000  # Сколько недавних просмотров помнить для проверки повторов
+VIEW_BUFFER_MAX_ENTRIES = 100000  # Сколько незаписанных просмотров держать, пока БД недоступна (старые отбрасываются)
+SYSTEM_SAMPLE_INTERVAL = 5  # Как часто снимать показатели системы (секунды)
+SYSTEM_SAMPLE_HISTORY = 720  # Сколько замеров хранить (720 по 5 секунд - последний час)
+METRICS_ENABLED = True  # Отдавать метрики в формате Prometheus по адресу /metrics
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Границы гистограмм времени (секунды)
+POPULAR_VIDEOS_LIMIT = 5  # Сколько популярных видео показывать в админке (после изменения: flask --app app check-stats --rebuild)
+LEASE_TTL = 30  # Через сколько секунд без продления аренды процесс считается остановившимся
+LEASE_RENEW_INTERVAL = 10  # Как часто процессы продлевают аренды (секунды)
+CATALOG_SYNC_INTERVAL = 1  # Как часто проверять, не изменил ли каталог другой процесс (секунды)
+JOB_WORKERS = 2  # Сколько задач администратора выполнять одновременно
+JOB_HISTORY_LIMIT = 100  # Сколько завершенных задач хранить в истории
+JOB_PROGRESS_INTERVAL = 1  # Как часто записывать прогресс задачи в БД (секунды)
+RECOMMEND_NEIGHBORS = 20  # Сколько соседей по совместным просмотрам хранить для каждого видео
+RECOMMEND_WINDOW = 5  # Со сколькими предыдущими просмотрами сессии связывать новый просмотр
+RECOMMEND_WINDOW_SECONDS = 3 * 3600  # Просмотры с большим перерывом не считаются совместными
+RECOMMEND_BATCH_SIZE = 5000  # Сколько новых строк истории обрабатывать за раз
+HISTORY_RETENTION_DAYS = 90  # Сколько дней хранить подробную историю просмотров (старше - только итоги по дням)
+HISTORY_MAX_PER_SESSION = 1000  # Сколько последних просмотров хранить для одной сессии
+HISTORY_CLEANUP_INTERVAL = 3600  # Как часто очищать историю просмотров (секунды)
+HISTORY_CLEANUP_BATCH = 500  # Сколько строк истории удалять одной транзакцией
+HISTORY_CLEANUP_PAUSE = 0.05  # Пауза между пачками, чтобы другие запросы успевали записывать (секунды)
+VACUUM_STEP_PAGES = 256  # Сколько свободных страниц БД возвращать системе за один шаг
+
+# Метрики в формате Prometheus (/metrics).
+# Значения хранятся в памяти процесса. Обновление метрики - одна операция со
+# словарем под блокировкой, поэтому метрики можно обновлять и при отдаче видео.
+metrics_registry = []
+
+def format_metric_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_metric_labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Metric:
+    """Основа метрик: значения по наборам меток и вывод в текстовом формате"""
+    
+    kind = 'untyped'
+    
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def samples(self):
+        """Строки метрики: (суффикс имени, пары меток, значение)"""
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield '', list(zip(self.labels, labels)), value
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, pairs, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_metric_labels(pairs)} {format_metric_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """Текущее значение. callback вычисляет значение при выводе метрик"""
+    
+    kind = 'gauge'
+    
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+    
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+    
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+    
+    def samples(self):
+        if self.callback is not None:
+            try:
+                value = self.callback()
+            except Exception as e:
+                print(f"Ошибка при вычислении метрики {self.name}: {e}")
+                return
+            yield '', [], value
+            return
+        yield from super().samples()
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labels=(), buckets=METRICS_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Счетчики по корзинам (без накопления), сумма и количество
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, (counts[:], total, count)) for labels, (counts, total, count) in self.values.items())
+        for labels, (counts, total, count) in items:
+            pairs = list(zip(self.labels, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', pairs + [('le', format_metric_value(float(bound)))], cumulative
+            yield '_bucket', pairs + [('le', '+Inf')], count
+            yield '_sum', pairs, total
+            yield '_count', pairs, count
 
-# Добавляем переменную для хранения статуса админского доступа
-admin_access = False
+http_requests_total = Counter('nantube_http_requests_total', 'Обработано HTTP-запросов', ('endpoint', 'method', 'status'))
+http_request_seconds = Histogram('nantube_http_request_seconds', 'Время обработки запроса до начала ответа', ('endpoint',))
+http_request_db_queries = Histogram('nantube_http_request_db_queries', 'Запросов к SQLite за один HTTP-запрос', ('endpoint',),
+                                    buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+http_request_db_seconds = Histogram('nantube_http_request_db_seconds', 'Время запросов к SQLite за один HTTP-запрос', ('endpoint',))
+video_bytes_served = Counter('nantube_video_bytes_served_total', 'Байт видео отдано (по Content-Length ответов)')
+video_streams_in_flight = Gauge('nantube_video_streams_in_flight', 'Видеофайлов, открытых для отдачи')
+db_queries_total = Counter('nantube_db_queries_total', 'Запросов к SQLite')
+db_query_seconds_total = Counter('nantube_db_query_seconds_total', 'Суммарное время выполнения запросов к SQLite')
+scan_seconds = Histogram('nantube_scan_seconds', 'Длительность прохода сканера папки с видео',
+                         buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800))
+scan_changes_total = Counter('nantube_scan_changes_total', 'Изменений, найденных сканером', ('kind',))
+probe_run_seconds = Histogram('nantube_probe_run_seconds', 'Длительность анализа пачки видео',
+                              buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800))
+probe_files_total = Counter('nantube_probe_files_total', 'Видео, отправленных на анализ', ('result',))
+cache_requests_total = Counter('nantube_cache_requests_total', 'Обращения к кэшам', ('cache', 'result'))
+views_dropped_total = Counter('nantube_views_dropped_total', 'Просмотров, отброшенных из переполненного буфера')
+
+# Счетчики запросов к SQLite текущего потока, сбрасываются в начале HTTP-запроса
+request_metrics = threading.local()
+
+def record_db_query(seconds):
+    db_queries_total.inc()
+    db_query_seconds_total.inc(amount=seconds)
+    request_metrics.db_queries = getattr(request_metrics, 'db_queries', 0) + 1
+    request_metrics.db_seconds = getattr(request_metrics, 'db_seconds', 0.0) + seconds
+
+class MeteredCursor(sqlite3.Cursor):
+    """Курсор, учитывающий число и время запросов"""
+    
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_db_query(time.perf_counter() - started)
+    
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_db_query(time.perf_counter() - started)
+
+class MeteredConnection(sqlite3.Connection):
+    """Соединение, все запросы которого идут через MeteredCursor"""
+    
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+# Пул соединений с базой данных.
+# Каждый поток получает свое соединение и использует его до конца запроса,
+# после чего соединение возвращается в пул и переиспользуется следующим запросом.
+db_local = threading.local()
+db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def create_db_connection():
+    """Открывает новое соединение с БД и настраивает его"""
+    conn = sqlite3.connect(
+        DATABASE_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        check_same_thread=False,  # Соединение может перейти в другой поток через пул
+        cached_statements=256,  # Кэш подготовленных запросов на соединение
+        factory=MeteredConnection  # Считает запросы для /metrics
+    )
+    # Действует только для новой (пустой) базы и должно идти до перехода в WAL:
+    # место после удаления данных возвращается частями (см. incremental_vacuum)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL позволяет читать параллельно с записью фонового сканера
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -16000')  # 16 МБ страничного кэша
+    conn.execute('PRAGMA mmap_size = 268435456')  # 256 МБ
+    conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    # Нужно, чтобы INSERT OR REPLACE вызывал триггеры удаления (поисковый индекс)
+    conn.execute('PRAGMA recursive_triggers = ON')
+    # LOWER в SQLite меняет регистр только латиницы: поиск без FTS5 сравнивает через Python
+    conn.create_function('fold_search_text', 1, fold_search_text, deterministic=True)
+    return conn
+
+def get_db():
+    """Возвращает соединение с БД для текущего потока"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        try:
+            conn = db_pool.get_nowait()
+        except queue.Empty:
+            conn = create_db_connection()
+        db_local.conn = conn
+    return conn
+
+def release_db(exception=None):
+    """Возвращает соединение текущего потока в пул"""
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        return
+    db_local.conn = None
+    try:
+        # Не оставляем незавершенных транзакций после ошибок
+        if conn.in_transaction:
+            conn.rollback()
+        db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
+app.teardown_appcontext(release_db)
+
+def close_db_connections():
+    """Закрывает соединение потока и все соединения пула (перед fork рабочих процессов)"""
+    release_db()
+    while True:
+        try:
+            db_pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+# Общее состояние процессов.
+# При запуске в нескольких процессах (serve.py) все, что должно быть видно
+# каждому процессу, хранится в SQLite: флаги в app_state, аренды в leases.
+
+def get_shared_state(key, default=None):
+    row = get_db().execute('SELECT value FROM app_state WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else default
+
+def set_shared_state(key, value):
+    conn = get_db()
+    conn.execute('''
+        INSERT INTO app_state (key, value) VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value
+    ''', (key, value))
+    conn.commit()
+
+def has_admin_access():
+    """Админский доступ общий для всех процессов"""
+    return get_shared_state('admin_access') == '1'
+
+def revoke_admin_access():
+    """Сбрасывает админский доступ при запуске сервера: он действует только до перезапуска"""
+    conn = get_db()
+    conn.execute("DELETE FROM app_state WHERE key = 'admin_access'")
+    conn.commit()
+
+class ProcessCoordinator:
+    """Координация рабочих процессов через таблицу leases.
+    
+    Каждый процесс продлевает аренду process:<метка>, по ней видно, что он жив.
+    Аренду leader держит один процесс: он сканирует папку и подбирает работу
+    (задачи, загрузки, HLS), владелец которой остановился.
+    """
+    
+    def __init__(self, ttl, interval):
+        self.ttl = ttl
+        self.interval = interval
+        self.pid = None
+        self.process_token = None
+        self.leader = False
+        self.thread = None
+        self.scanner_thread = None
+        self.leader_tasks = []
+        self.lock = threading.Lock()
+    
+    @property
+    def token(self):
+        """Метка процесса. После fork у дочернего процесса своя метка"""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.process_token = f'{socket.gethostname()}:{self.pid}:{os.urandom(4).hex()}'
+        return self.process_token
+    
+    def acquire(self, name):
+        """Берет или продлевает аренду. Возвращает False, если ее держит другой живой процесс"""
+        now = time.time()
+        conn = get_db()
+        cursor = conn.execute('''
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+        ''', (name, self.token, now + self.ttl, now))
+        conn.commit()
+        return cursor.rowcount > 0
+    
+    def dead_owner_clause(self, column='owner'):
+        """Условие SQL для строк, владелец которых не продлевает аренду (или не задан)"""
+        return (f"({column} IS NULL OR {column} NOT IN "
+                "(SELECT owner FROM leases WHERE name LIKE 'process:%' AND expires_at >= ?))", (time.time(),))
+    
+    def leader_task(self, task):
+        """Регистрирует функцию, которую ведущий процесс выполняет при каждом продлении аренды"""
+        self.leader_tasks.append(task)
+        return task
+    
+    def tick(self):
+        self.acquire(f'process:{self.token}')
+        was_leader = self.leader
+        self.leader = self.acquire('leader')
+        if self.leader != was_leader:
+            print(f"Процесс {os.getpid()} {'стал ведущим' if self.leader else 'больше не ведущий'}")
+        if not self.leader:
+            return
+        if self.scanner_thread is None:
+            self.scanner_thread = threading.Thread(target=background_scanner, daemon=True)
+            self.scanner_thread.start()
+        conn = get_db()
+        conn.execute("DELETE FROM leases WHERE name LIKE 'process:%' AND expires_at < ?", (time.time(),))
+        conn.commit()
+        for task in self.leader_tasks:
+            try:
+                task()
+            except Exception as e:
+                print(f"Ошибка в задаче ведущего процесса {task.__name__}: {e}")
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"Ошибка продления аренды: {e}")
+            finally:
+                release_db()
+    
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            # Первое продление сразу: единственный процесс становится ведущим без задержки
+            try:
+                self.tick()
+            finally:
+                release_db()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def release(self, name):
+        """Отдает аренду, если ее держит этот процесс"""
+        conn = get_db()
+        conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, self.token))
+        conn.commit()
+    
+    def shutdown(self):
+        """Освобождает аренды, чтобы другой процесс сразу стал ведущим и подобрал работу"""
+        if self.thread is None:
+            return
+        try:
+            conn = get_db()
+            conn.execute('DELETE FROM leases WHERE owner = ?', (self.token,))
+            conn.commit()
+        finally:
+            release_db()
+
+coordinator = ProcessCoordinator(LEASE_TTL, LEASE_RENEW_INTERVAL)
+
+# Кэш каталога в памяти.
+# Снимок каталога неизменяемый и помечен номером версии. Любое изменение
+# списка видео (сканирование, загрузка, бан, переименование, удаление,
+# смена ориентации) увеличивает версию, и снимок перестраивается при
+# следующем чтении одним запросом к БД.
+CatalogVideo = namedtuple('CatalogVideo', 'filename display_name orientation duration width height')
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога видео"""
+    
+    __slots__ = ('version', 'videos', 'by_filename', 'vertical', 'vertical_sorted', 'banned')
+    
+    def __init__(self, version, videos, banned):
+        self.version = version
+        # Незабаненные видео, новые первыми (как на главной странице)
+        self.videos = tuple(videos)
+        self.by_filename = MappingProxyType({video.filename: video for video in self.videos})
+        self.vertical = tuple(video.filename for video in self.videos if video.orientation == 'vertical')
+        self.vertical_sorted = tuple(sorted(self.vertical))
+        self.banned = frozenset(banned)
+
+class CatalogCache:
+    """Версионированный кэш каталога с явной инвалидацией"""
+    
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self.version = 0
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.hooks = []
+        self.remote_hooks = []
+        self.shared_version = None
+        self.checked_at = 0.0
+    
+    def get(self):
+        """Возвращает актуальный снимок или None, если каталог слишком большой для памяти"""
+        self.sync()
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.version == self.version:
+            cache_requests_total.inc('catalog', 'hit')
+            return snapshot
+        
+        cache_requests_total.inc('catalog', 'miss')
+        with self.build_lock:
+            # Пока мы ждали, снимок мог перестроить другой поток
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.version == self.version:
+                return snapshot
+            
+            version = self.version
+            snapshot = self.build(version)
+            self.snapshot = snapshot
+            return snapshot
+    
+    def build(self, version):
+        """Строит снимок каталога из БД"""
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM videos')
+        if cursor.fetchone()[0] > self.max_items:
+            print(f"Каталог больше {self.max_items} видео, кэш в памяти отключен")
+            return None
+        
+        cursor.execute('''
+            SELECT filename, display_name, orientation, duration, width, height, banned
+            FROM videos 
+            ORDER BY created_at DESC, filename DESC
+        ''')
+        videos = []
+        banned = []
+        for row in cursor.fetchall():
+            if row[6] == 1:
+                banned.append(row[0])
+            else:
+                videos.append(CatalogVideo(*row[:6]))
+        return CatalogSnapshot(version, videos, banned)
+    
+    def sync(self):
+        """Не чаще CATALOG_SYNC_INTERVAL проверяет общую версию, которую увеличивают другие процессы"""
+        now = time.monotonic()
+        if now - self.checked_at < CATALOG_SYNC_INTERVAL:
+            return
+        self.checked_at = now
+        try:
+            shared_version = get_shared_state('catalog_version', '0')
+        except sqlite3.OperationalError:
+            # Таблицы еще нет: база не инициализирована
+            return
+        changed = self.shared_version is not None and shared_version != self.shared_version
+        self.shared_version = shared_version
+        if changed:
+            self.invalidate_local(self.hooks + self.remote_hooks)
+    
+    def invalidate(self):
+        """Увеличивает версию каталога во всех процессах и вызывает подписчиков"""
+        conn = get_db()
+        in_transaction = conn.in_transaction
+        try:
+            # Внутри чужой транзакции версия увеличится вместе с ее изменениями (или откатится с ними)
+            conn.execute('''
+                INSERT INTO app_state (key, value) VALUES ('catalog_version', '1')
+                ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            ''')
+            self.shared_version = get_shared_state('catalog_version')
+            if not in_transaction:
+                conn.commit()
+        except sqlite3.OperationalError as e:
+            print(f"Не удалось сообщить другим процессам об изменении каталога: {e}")
+        self.invalidate_local(self.hooks)
+    
+    def invalidate_local(self, hooks):
+        with self.lock:
+            self.version += 1
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                print(f"Ошибка в обработчике инвалидации каталога: {e}")
+    
+    def on_invalidate(self, hook):
+        """Регистрирует функцию, вызываемую при каждом изменении каталога"""
+        self.hooks.append(hook)
+        return hook
+    
+    def on_remote_invalidate(self, hook):
+        """Регистрирует функцию, вызываемую, когда каталог изменил другой процесс"""
+        self.remote_hooks.append(hook)
+        return hook
+
+catalog_cache = CatalogCache(CATALOG_MAX_ITEMS)
+
+def get_catalog():
+    """Возвращает снимок каталога (или None, если нужно читать из БД)"""
+    return catalog_cache.get()
+
+def invalidate_catalog():
+    """Сообщает, что список видео изменился"""
+    catalog_cache.invalidate()
+
+def pick_random_video(videos, exclude=None):
+    """Выбирает случайное видео из последовательности за O(1), исключая exclude"""
+    if not videos:
+        return None
+    if len(videos) == 1:
+        return None if videos[0] == exclude else videos[0]
+    while True:
+        video = videos[random.randrange(len(videos))]
+        if video != exclude:
+            return video
+
+# Лента shorts для каждой сессии.
+# Все вертикальные видео получают постоянный номер слота в общем индексе:
+# новые видео добавляются в конец, удаленные заменяются на None. Каждая
+# сессия перемешивает слоты "лениво" (алгоритм Фишера-Йейтса, где
+# переставленные элементы хранятся в словаре), поэтому следующее видео
+# выбирается за O(1) без копирования списка, а видео, добавленные в каталог
+# позже, сразу попадают в еще не показанную часть ленты.
+class VerticalSlotIndex:
+    """Общий индекс слотов вертикальных видео"""
+    
+    def __init__(self):
+        self.slots = []
+        self.slot_of = {}
+        self.version = None
+        self.epoch = 0
+    
+    def sync(self, catalog):
+        """Приводит индекс к снимку каталога (только при смене версии)"""
+        if catalog.version == self.version:
+            return
+        current = set(catalog.vertical)
+        for filename in [f for f in self.slot_of if f not in current]:
+            self.slots[self.slot_of.pop(filename)] = None
+        for filename in catalog.vertical:
+            if filename not in self.slot_of:
+                self.slot_of[filename] = len(self.slots)
+                self.slots.append(filename)
+        
+        # Если удаленных слотов стало слишком много, уплотняем индекс.
+        # Ленты со старой эпохой начнут новый круг, пропуская уже просмотренное.
+        if len(self.slots) > 1000 and len(self.slot_of) < len(self.slots) // 2:
+            self.slots = [f for f in self.slots if f is not None]
+            self.slot_of = {f: i for i, f in enumerate(self.slots)}
+            self.epoch += 1
+        self.version = catalog.version
+
+class ShortsFeed:
+    """Перемешанная лента shorts одной сессии без повторов"""
+    
+    __slots__ = ('epoch', 'position', 'swaps', 'seen', 'history', 'cursor', 'ahead', 'touched')
+    
+    def __init__(self, epoch, history=(), cursor=-1):
+        self.epoch = epoch
+        self.reset(epoch)
+        self.history = list(history)
+        self.cursor = cursor
+        # Сколько видео в конце истории выбрано заранее и еще не открывалось
+        self.ahead = 0
+        # Видео из сохраненной истории в этом круге уже показывались
+        self.seen.update(self.history)
+        self.touched = time.monotonic()
+    
+    def reset(self, epoch):
+        """Начинает новый круг: все видео снова доступны"""
+        self.epoch = epoch
+        self.position = 0
+        self.swaps = {}
+        self.seen = set()
+    
+    def draw(self, index, exclude=None):
+        """Выбирает следующее непросмотренное видео за O(1) (в среднем).
+        
+        exclude (текущее видео) после начала нового круга не выбирается,
+        если только оно не единственное.
+        """
+        if self.epoch != index.epoch:
+            # Индекс уплотнили: начинаем заново, но помним просмотренное
+            seen = self.seen
+            self.reset(index.epoch)
+            self.seen = seen
+        
+        if not index.slot_of:
+            return None
+        
+        skipped = None
+        for _ in range(2):
+            while self.position < len(index.slots):
+                j = random.randrange(self.position, len(index.slots))
+                slot = self.swaps.get(j, j)
+                self.swaps[j] = self.swaps.get(self.position, self.position)
+                self.swaps.pop(self.position, None)
+                self.position += 1
+                
+                filename = index.slots[slot]
+                if filename is not None and filename not in self.seen:
+                    self.seen.add(filename)
+                    if filename == exclude:
+                        # Текущее видео уже на экране, в новом круге оно считается просмотренным
+                        skipped = filename
+                        continue
+                    return filename
+            # Сессия посмотрела все видео — начинаем новый круг
+            self.reset(index.epoch)
+        return skipped
+    
+    def visit(self, filename):
+        """Отмечает, что видео открыто (в том числе по прямой ссылке)"""
+        if self.cursor >= 0 and self.history[self.cursor] == filename:
+            return
+        if self.cursor + 1 < len(self.history) and self.history[self.cursor + 1] == filename:
+            # Переход к следующему видео истории или выбранному заранее (см. ShortsFeedStore.upcoming)
+            self.advance()
+            return
+        # Переход по прямой ссылке: выбранные заранее, но не открытые видео снова доступны
+        if self.ahead:
+            self.seen.difference_update(self.history[-self.ahead:])
+            del self.history[-self.ahead:]
+            self.ahead = 0
+        self.seen.add(filename)
+        self.append(filename)
+        self.cursor = len(self.history) - 1
+    
+    def advance(self):
+        """Сдвигает курсор вперед по истории"""
+        self.cursor += 1
+        self.ahead = min(self.ahead, len(self.history) - 1 - self.cursor)
+    
+    def visited(self):
+        """История без выбранных заранее видео (то, что сессия действительно открывала)"""
+        return self.history[:len(self.history) - self.ahead]
+    
+    def append(self, filename):
+        """Добавляет видео в конец истории, не сдвигая курсор"""
+        self.history.append(filename)
+        excess = len(self.history) - SHORTS_FEED_HISTORY
+        if excess > 0:
+            del self.history[:excess]
+            self.cursor = max(self.cursor - excess, -1)
+
+class ShortsFeedStore:
+    """Ленты shorts всех сессий: история навигации (назад/вперед) и перемешанный порядок.
+    
+    Ленты живут в памяти процесса, переходы не обращаются к БД. Давно неактивные
+    ленты и ленты сверх max_sessions вытесняются (LRU). При persist история и
+    курсор измененных лент раз в flush_interval записываются в shorts_navigation
+    и читаются оттуда, если ленты нет в памяти (после перезапуска, вытеснения
+    или в другом процессе).
+    """
+    
+    def __init__(self, max_sessions, idle_seconds, persist, flush_interval):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.index = VerticalSlotIndex()
+        self.feeds = OrderedDict()
+        self.lock = threading.Lock()
+        # Ленты, измененные после последней записи в БД, и снимки вытесненных
+        self.dirty = set()
+        self.evicted = {}
+        self.flush_lock = threading.Lock()
+        self.thread = None
+    
+    def get_feed(self, session_id, stored=None):
+        now = time.monotonic()
+        feed = self.feeds.get(session_id)
+        if feed is None:
+            feed = ShortsFeed(self.index.epoch, *(stored or ()))
+            self.feeds[session_id] = feed
+        else:
+            self.feeds.move_to_end(session_id)
+        feed.touched = now
+        # Ленты упорядочены по последнему обращению: неактивные лежат в начале
+        while len(self.feeds) > self.max_sessions or now - next(iter(self.feeds.values())).touched > self.idle_seconds:
+            evicted_id, evicted = self.feeds.popitem(last=False)
+            if evicted_id in self.dirty:
+                self.dirty.discard(evicted_id)
+                self.evicted[evicted_id] = (evicted.visited(), evicted.cursor)
+        return feed
+    
+    def load(self, session_id):
+        """Ищет сохраненную историю ленты, если ее нет в памяти (запрос к БД без блокировки)"""
+        if not self.persist or session_id in self.feeds:
+            return None
+        with self.lock:
+            stored = self.evicted.get(session_id)
+        if stored is not None:
+            return stored
+        row = get_db().execute('SELECT history, cursor FROM shorts_navigation WHERE session_id = ?',
+                               (session_id,)).fetchone()
+        if row is None:
+            return None
+        history = json.loads(row[0])
+        return history, min(row[1], len(history) - 1)
+    
+    def open_feed(self, session_id, stored):
+        """Лента сессии для изменения (вызывается под self.lock)"""
+        feed = self.get_feed(session_id, stored)
+        if self.persist:
+            self.dirty.add(session_id)
+            if self.thread is None:
+                self.start()
+        return feed
+    
+    def next(self, session_id, catalog):
+        """Следующее видео ленты: сначала вперед по истории, затем новое"""
+        stored = self.load(session_id)
+        with self.lock:
+            self.index.sync(catalog)
+            feed = self.open_feed(session_id, stored)
+            while feed.cursor < len(feed.history) - 1:
+                feed.advance()
+                filename = feed.history[feed.cursor]
+                if filename in self.index.slot_of:
+                    return filename
+            current = feed.history[feed.cursor] if feed.cursor >= 0 else None
+            filename = feed.draw(self.index, exclude=current)
+            if filename is not None:
+                feed.visit(filename)
+            return filename
+    
+    def prev(self, session_id, catalog):
+        """Предыдущее видео из истории ленты"""
+        stored = self.load(session_id)
+        with self.lock:
+            self.index.sync(catalog)
+            feed = self.open_feed(session_id, stored)
+            while feed.cursor > 0:
+                feed.cursor -= 1
+                filename = feed.history[feed.cursor]
+                if filename in self.index.slot_of:
+                    return filename
+            return None
+    
+    def upcoming(self, session_id, catalog, count):
+        """Следующие count видео ленты без сдвига курсора.
+        
+        Недостающие видео выбираются заранее и дописываются в историю после
+        курсора, поэтому next() потом вернет их в том же порядке.
+        """
+        stored = self.load(session_id)
+        with self.lock:
+            self.index.sync(catalog)
+            feed = self.open_feed(session_id, stored)
+            current = feed.history[feed.cursor] if feed.cursor >= 0 else None
+            result = [f for f in feed.history[feed.cursor + 1:] if f in self.index.slot_of][:count]
+            while len(result) < count:
+                filename = feed.draw(self.index, exclude=current)
+                # В маленькой библиотеке новый круг может начаться с уже выбранного видео
+                if filename is None or filename == current or filename in result:
+                    break
+                feed.append(filename)
+                feed.ahead += 1
+                result.append(filename)
+            return result
+    
+    def visit(self, session_id, filename):
+        stored = self.load(session_id)
+        with self.lock:
+            self.open_feed(session_id, stored).visit(filename)
+    
+    def flush(self):
+        """Записывает историю измененных лент одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                rows = [(session_id, json.dumps(history), cursor)
+                        for session_id, (history, cursor) in self.evicted.items()]
+                for session_id in self.dirty:
+                    feed = self.feeds[session_id]
+                    rows.append((session_id, json.dumps(feed.visited()), feed.cursor))
+                self.dirty, self.evicted = set(), {}
+            if not rows:
+                return 0
+            
+            conn = get_db()
+            try:
+                conn.executemany('''
+                    INSERT INTO shorts_navigation (session_id, history, cursor, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(session_id) DO UPDATE SET
+                        history = excluded.history, cursor = excluded.cursor, updated_at = excluded.updated_at
+                ''', rows)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Ошибка при записи навигации shorts: {e}")
+                return 0
+            return len(rows)
+    
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            finally:
+                release_db()
+    
+    def start(self):
+        """Запускает фоновую запись (при первом изменении ленты)"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.shutdown)
+    
+    def shutdown(self):
+        """Записывает измененные ленты при остановке сервера"""
+        try:
+            self.flush()
+        finally:
+            release_db()
+
+shorts_feeds = ShortsFeedStore(SHORTS_FEED_MAX_SESSIONS, SHORTS_FEED_IDLE_SECONDS,
+                               SHORTS_FEED_PERSIST, SHORTS_FEED_FLUSH_INTERVAL)
+
+def next_short(session_id, current=None):
+    """Следующее вертикальное видео для сессии без повторов"""
+    catalog = get_catalog()
+    if catalog is None:
+        return pick_random_video(get_all_vertical_videos(), exclude=current)
+    if current:
+        shorts_feeds.visit(session_id, current)
+    return shorts_feeds.next(session_id, catalog)
+
+def previous_short(session_id, current=None):
+    """Предыдущее вертикальное видео сессии или None"""
+    catalog = get_catalog()
+    if catalog is None:
+        return None
+    if current:
+        shorts_feeds.visit(session_id, current)
+    return shorts_feeds.prev(session_id, catalog)
+
+def upcoming_shorts(session_id, count, current=None):
+    """Следующие count вертикальных видео сессии (CatalogVideo) без сдвига ленты"""
+    catalog = get_catalog()
+    if catalog is not None:
+        if current:
+            shorts_feeds.visit(session_id, current)
+        filenames = shorts_feeds.upcoming(session_id, catalog, count)
+        return [catalog.by_filename[filename] for filename in filenames]
+    
+    # Каталог слишком большой для памяти: случайные видео без учета истории
+    vertical_videos = [f for f in get_all_vertical_videos() if f != current]
+    filenames = random.sample(vertical_videos, min(count, len(vertical_videos)))
+    if not filenames:
+        return []
+    rows = get_db().execute(f'''
+        SELECT filename, display_name, orientation, duration, width, height FROM videos
+        WHERE filename IN ({','.join('?' * len(filenames))})
+    ''', filenames).fetchall()
+    by_filename = {row[0]: CatalogVideo(*row) for row in rows}
+    return [by_filename[filename] for filename in filenames if filename in by_filename]
+
+def short_to_json(video):
+    """Представление видео ленты shorts для предзагрузки или None, если файла нет"""
+    file_path = get_video_file_path(video.filename)
+    try:
+        size = os.path.getsize(file_path) if file_path else None
+    except OSError:
+        size = None
+    if size is None:
+        return None
+    return {
+        'filename': video.filename,
+        'display_name': video.display_name or video.filename,
+        'duration': video.duration or 0,
+        'duration_text': format_duration(video.duration),
+        'width': video.width or 0,
+        'height': video.height or 0,
+        'size': size,
+        'url': url_for('vertical_video', filename=video.filename),
+        'video_url': url_for('serve_video', filename=video.filename),
+        'hls_url': get_hls_url(video.filename, file_path),
+        'poster_url': thumbnail_url(video.filename)
+    }
+
+def shorts_preload_links(items):
+    """Заголовок Link: превью и страницы следующих shorts"""
+    links = []
+    for item in items[:SHORTS_PRELOAD_COUNT]:
+        links.append(f'<{item["poster_url"]}>; rel=preload; as=image')
+        links.append(f'<{item["url"]}>; rel=prefetch')
+    return ', '.join(links)
 
 @app.route('/random_vertical')
 def random_vertical():
     """Открывает случайное вертикальное видео"""
-    vertical_videos = get_all_vertical_videos()
+    random_video = next_short(session['session_id'])
     
-    if vertical_videos:
-        random_video = random.choice(vertical_videos)
+    if random_video:
         return redirect(url_for('vertical_video', filename=random_video))
     else:
         flash('Нет вертикальных видео')
         return redirect(url_for('index'))
 
+def is_inside_video_folder(path):
+    """Проверяет, что путь не выходит за пределы папки с видео (защита от ../)"""
+    root = os.path.abspath(VIDEO_FOLDER)
+    path = os.path.abspath(path)
+    return path != root and os.path.commonpath([root, path]) == root
+
+class FilenameIndex:
+    """Индекс имен файлов: исходное, раскодированное и NFC-нормализованное имя -> реальный файл.
+    
+    Поддерживается сканером, загрузкой и переименованием, поэтому поиск файла
+    по имени из URL не требует чтения папки.
+    """
+    
+    def __init__(self):
+        self.exact = {}  # исходное имя (и его NFC-форма) -> файл
+        self.decoded = {}  # раскодированное имя (и его NFC-форма) -> файл
+        self.files = set()
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def variants(name):
+        """Имя и его NFC-форма (macOS хранит имена в NFD)"""
+        return {name, unicodedata.normalize('NFC', name)}
+    
+    @staticmethod
+    def decode(name):
+        try:
+            return unquote(name)
+        except Exception:
+            return name
+    
+    def add_locked(self, filename):
+        self.files.add(filename)
+        # Точное совпадение имени важнее совпадения после раскодирования
+        for key in self.variants(filename):
+            self.exact[key] = filename
+        for key in self.variants(self.decode(filename)):
+            self.decoded.setdefault(key, filename)
+    
+    def remove_locked(self, filename):
+        self.files.discard(filename)
+        for mapping in (self.exact, self.decoded):
+            for key in self.variants(filename) | self.variants(self.decode(filename)):
+                if mapping.get(key) == filename:
+                    del mapping[key]
+    
+    def add(self, filename):
+        with self.lock:
+            self.add_locked(filename)
+    
+    def remove(self, filename):
+        with self.lock:
+            self.remove_locked(filename)
+    
+    def rename(self, old_filename, new_filename):
+        with self.lock:
+            self.remove_locked(old_filename)
+            self.add_locked(new_filename)
+    
+    def sync(self, filenames):
+        """Приводит индекс к списку файлов, найденному сканером"""
+        with self.lock:
+            for filename in self.files - filenames:
+                self.remove_locked(filename)
+            for filename in filenames - self.files:
+                self.add_locked(filename)
+    
+    def resolve(self, name):
+        """Имя файла относительно VIDEO_FOLDER или None"""
+        decoded_name = self.decode(name)
+        with self.lock:
+            for mapping in (self.exact, self.decoded):
+                for candidate in (name, decoded_name):
+                    for key in self.variants(candidate):
+                        filename = mapping.get(key)
+                        if filename is not None:
+                            return filename
+        return None
+
+filename_index = FilenameIndex()
+
+@catalog_cache.on_remote_invalidate
+def reload_filename_index():
+    """Файлы могли загрузить, переименовать или удалить через другой процесс"""
+    rows = get_db().execute('SELECT filename FROM videos').fetchall()
+    filename_index.sync({filename for (filename,) in rows})
+
 def get_video_file_path(filename):
     """Получает безопасный путь к видеофайлу"""
-    try:
-        # Декодируем имя файла
-        decoded_filename = unquote(filename)
-    except:
-        decoded_filename = filename
+    resolved = filename_index.resolve(filename)
+    cache_requests_total.inc('filename_index', 'miss' if resolved is None else 'hit')
+    if resolved is None:
+        # Файла еще нет в индексе (сканер не успел его увидеть): проверяем путь напрямую
+        try:
+            # Декодируем имя файла
+            decoded_filename = unquote(filename)
+        except:
+            decoded_filename = filename
+        for candidate in (filename, decoded_filename):
+            file_path = os.path.join(VIDEO_FOLDER, candidate)
+            if is_inside_video_folder(file_path) and os.path.isfile(file_path):
+                return file_path
+        return None
     
     # Безопасно объединяем пути
-    file_path = os.path.join(VIDEO_FOLDER, decoded_filename)
-    
-    # Проверяем, что файл существует
-    if not os.path.exists(file_path):
-        # Ищем файл с другим кодированием
-        for file in os.listdir(VIDEO_FOLDER):
-            if file.split('.')[-1].lower() in ALLOWED_EXTENSIONS:
-                try:
-                    if unquote(file) == decoded_filename:
-                        return os.path.join(VIDEO_FOLDER, file)
-                except:
-                    if file == decoded_filename:
-                        return os.path.join(VIDEO_FOLDER, file)
+    file_path = os.path.join(VIDEO_FOLDER, resolved)
+    if not is_inside_video_folder(file_path):
         return None
-    
     return file_path
 
-def get_videos_with_orientation():
-    """Получает видео с информацией об ориентации"""
-    conn = sqlite3.connect(DATABASE_PATH)
+def search_videos_with_orientation(search_term, limit=-1, offset=0, orientation=None):
+    """Поиск видео по названию с возвратом ориентации (без полнотекстового индекса)"""
+    search_term = fold_search_text(search_term)
+    orientation_filter = ''
+    if orientation == 'vertical':
+        orientation_filter = "AND orientation = 'vertical'"
+    elif orientation == 'horizontal':
+        orientation_filter = "AND orientation IS NOT 'vertical'"
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT filename, display_name, orientation 
+    cursor.execute(f'''
+        SELECT filename, display_name, orientation, duration 
         FROM videos 
         WHERE banned = 0 
+        AND (fold_search_text(display_name) LIKE ? OR fold_search_text(filename) LIKE ?)
+        {orientation_filter}
         ORDER BY created_at DESC
-    ''')
+        LIMIT ? OFFSET ?
+    ''', ('%' + search_term + '%', '%' + search_term + '%', limit, offset))
     videos = cursor.fetchall()
-    conn.close()
-    
-    # Отладочный вывод
-    print(f"Найдено видео: {len(videos)}")
-    horizontal_count = sum(1 for v in videos if v[2] != 'vertical')
-    vertical_count = sum(1 for v in videos if v[2] == 'vertical')
-    print(f"Горизонтальных: {horizontal_count}, Вертикальных: {vertical_count}")
-    
     return videos
 
-def search_videos_with_orientation(search_term):
-    """Поиск видео по названию с возвратом ориентации"""
-    search_term = search_term.lower()
-    conn = sqlite3.connect(DATABASE_PATH)
+def is_fts_enabled():
+    """Проверяет, есть ли в базе полнотекстовый индекс videos_fts"""
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT filename, display_name, orientation 
-        FROM videos 
-        WHERE banned = 0 
-        AND (LOWER(display_name) LIKE ? OR LOWER(filename) LIKE ?)
-        ORDER BY created_at DESC
-    ''', ('%' + search_term + '%', '%' + search_term + '%'))
-    videos = cursor.fetchall()
-    conn.close()
-    return videos
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'videos_fts'")
+    return cursor.fetchone() is not None
 
-def get_sorted_videos(sort_by='filename', sort_order='asc'):
-    """Получает видео с сортировкой"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
+def fold_search_text(text):
+    """Текст для сравнения при поиске: нижний регистр (в том числе кириллица), ё как е"""
+    return text.lower().replace('ё', 'е') if text else text
+
+def build_fts_query(search_term):
+    """Превращает строку поиска в запрос FTS5: все слова, каждое как префикс"""
+    words = re.findall(r'\w+', fold_search_text(search_term))[:10]
+    return ' '.join(f'"{word}"*' for word in words)
+
+# Поля, по которым разрешена сортировка списка видео
+SORT_COLUMNS = ('created_at', 'views', 'likes', 'filename')
+
+def encode_page_cursor(values):
+    """Кодирует позицию в списке (значения ключа сортировки) в строку курсора"""
+    raw = json.dumps(values, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor):
+    """Декодирует курсор; возвращает список значений или вызывает ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Некорректный курсор')
+    if not isinstance(values, list):
+        raise ValueError('Некорректный курсор')
+    return values
+
+def get_videos_page(cursor=None, limit=PAGE_SIZE, orientation=None, sort_by='created_at', sort_order='desc'):
+    """Получает страницу видео с keyset-пагинацией.
     
-    # Определяем направление сортировки
+    Возвращает (список (filename, display_name, orientation, duration), курсор следующей страницы).
+    Курсор следующей страницы равен None, если страниц больше нет.
+    """
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'created_at'
     order = 'ASC' if sort_order == 'asc' else 'DESC'
+    compare = '>' if order == 'ASC' else '<'
+    
+    conditions = ['banned = 0']
+    params = []
+    
+    if orientation == 'vertical':
+        conditions.append("orientation = 'vertical'")
+    elif orientation == 'horizontal':
+        # Все, что не вертикальное, показывается в горизонтальной сетке
+        conditions.append("orientation IS NOT 'vertical'")
+    
+    if cursor:
+        values = decode_page_cursor(cursor)
+        if sort_by == 'filename':
+            if len(values) != 1:
+                raise ValueError('Некорректный курсор')
+            conditions.append(f'filename {compare} ?')
+            params.extend(values)
+        else:
+            if len(values) != 2:
+                raise ValueError('Некорректный курсор')
+            conditions.append(f'({sort_by}, filename) {compare} (?, ?)')
+            params.extend(values)
     
-    # Выбираем поле для сортировки
     if sort_by == 'filename':
         order_by = f'filename {order}'
-    elif sort_by == 'created_at':
-        order_by = f'created_at {order}'
-    elif sort_by == 'views':
-        order_by = f'views {order}'
-    elif sort_by == 'likes':
-        order_by = f'likes {order}'
     else:
-        order_by = f'filename {order}'
+        order_by = f'{sort_by} {order}, filename {order}'
     
-    cursor.execute(f'''
-        SELECT filename, display_name FROM videos 
-        WHERE banned = 0 
+    conn = get_db()
+    db_cursor = conn.cursor()
+    db_cursor.execute(f'''
+        SELECT filename, display_name, orientation, duration, {sort_by}
+        FROM videos 
+        WHERE {' AND '.join(conditions)}
         ORDER BY {order_by}
-    ''')
-    videos = cursor.fetchall()
-    conn.close()
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = db_cursor.fetchall()
     
-    return videos
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if sort_by == 'filename':
+            next_cursor = encode_page_cursor([last[0]])
+        else:
+            next_cursor = encode_page_cursor([last[4], last[0]])
+    
+    return [row[:4] for row in rows], next_cursor
 
-def search_videos(search_term):
-    """Поиск видео по названию"""
-    videos = get_videos()
-    search_term = search_term.lower()
+def search_videos(search_term, cursor=None, limit=SEARCH_PAGE_SIZE, orientation=None):
+    """Поиск видео по названию, отсортированный по релевантности (bm25).
     
-    results = []
-    for filename, display_name in videos:
-        # Проверяем, не забанено ли видео
-        if not is_video_banned(filename):
-            # Ищем в отображаемом имени и оригинальном имени файла
-            if (search_term in display_name.lower() or 
-                search_term in filename.lower()):
-                results.append((filename, display_name))
+    Возвращает (список (filename, display_name, orientation, duration), курсор следующей страницы).
+    """
+    offset = 0
+    if cursor:
+        values = decode_page_cursor(cursor)
+        if len(values) != 1 or not isinstance(values[0], int) or values[0] < 0:
+            raise ValueError('Некорректный курсор')
+        offset = values[0]
     
-    return results
+    if is_fts_enabled():
+        fts_query = build_fts_query(search_term)
+        if not fts_query:
+            return [], None
+        
+        orientation_filter = ''
+        if orientation == 'vertical':
+            orientation_filter = "AND v.orientation = 'vertical'"
+        elif orientation == 'horizontal':
+            orientation_filter = "AND v.orientation IS NOT 'vertical'"
+        
+        conn = get_db()
+        db_cursor = conn.cursor()
+        # Совпадение в названии весит больше, чем совпадение в имени файла
+        db_cursor.execute(f'''
+            SELECT v.filename, v.display_name, v.orientation, v.duration
+            FROM videos_fts
+            JOIN videos v ON v.rowid = videos_fts.rowid
+            WHERE videos_fts MATCH ? AND v.banned = 0
+            {orientation_filter}
+            ORDER BY bm25(videos_fts, 10.0, 1.0), v.created_at DESC
+            LIMIT ? OFFSET ?
+        ''', (fts_query, limit + 1, offset))
+        videos = db_cursor.fetchall()
+    else:
+        videos = search_videos_with_orientation(search_term, limit + 1, offset, orientation)
+    
+    next_cursor = None
+    if len(videos) > limit:
+        videos = videos[:limit]
+        next_cursor = encode_page_cursor([offset + limit])
+    return videos, next_cursor
 
 def init_database():
     """Инициализация базы данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
+        CREATE TABLE IF NOT EXISTS videos (
+            filename TEXT PRIMARY KEY,
+            orientation TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            banned INTEGER DEFAULT 0,
+            views INTEGER DEFAULT 0,
+            likes INTEGER DEFAULT 0,
+            dislikes INTEGER DEFAULT 0,
+            display_name TEXT,
+            duration REAL DEFAULT 0,
+            width INTEGER DEFAULT 0,
+            height INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS video_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            filename TEXT,
+            watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS banned_videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT UNIQUE,
+            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            reason TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action TEXT,
+            details TEXT,
+            performed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS video_ratings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            filename TEXT,
+            rating INTEGER,
+            rated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(session_id, filename)
+        )
+    ''')
+    conn.commit()
+    
+    # Обновляем схему существующей базы до последней версии
+    run_migrations(conn)
+    
+    if get_shared_state('incremental_vacuum') == 'pending':
+        print("Место после очистки истории не возвращается системе. Чтобы включить это, "
+              "остановите сервер и выполните: flask --app app enable-incremental-vacuum")
+
+def migration_hot_query_indexes(cursor):
+    """Индексы для главной страницы, shorts, истории и переименования"""
+    # Главная страница: WHERE banned = 0 ORDER BY created_at DESC (покрывающий индекс)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_videos_banned_created
+        ON videos (banned, created_at DESC, filename, display_name, orientation, duration)
+    ''')
+    # Shorts: WHERE orientation = 'vertical' AND banned = 0
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_videos_orientation_banned
+        ON videos (orientation, banned, filename)
+    ''')
+    # История: WHERE session_id = ? ORDER BY watched_at DESC
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_history_session_watched
+        ON video_history (session_id, watched_at DESC, filename)
+    ''')
+    # Каскадные UPDATE ... WHERE filename = ? при переименовании и удалении
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_filename ON video_history (filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_filename ON video_ratings (filename)')
+
+def migration_keyset_indexes(cursor):
+    """Индексы для постраничной выборки по (ключ сортировки, filename)"""
+    # Пересоздаем индекс главной страницы так, чтобы он покрывал и ключ курсора
+    cursor.execute('DROP INDEX IF EXISTS idx_videos_banned_created')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_videos_banned_created
+        ON videos (banned, created_at, filename, display_name, orientation, duration)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_banned_views ON videos (banned, views, filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_banned_likes ON videos (banned, likes, filename)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_banned_filename ON videos (banned, filename)')
+
+def migration_fulltext_search(cursor):
+    """Полнотекстовый индекс FTS5 по названию и имени файла"""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        cursor.execute("DROP TABLE temp.fts5_probe")
+    except sqlite3.OperationalError:
+        print("SQLite собран без FTS5, поиск будет работать через LIKE")
+        return
+    
+    # unicode61 приводит к нижнему регистру любые буквы, включая кириллицу,
+    # и разбивает имена файлов по "_", "-", "." и пробелам
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING fts5(
+            display_name,
+            filename,
+            content='videos',
+            content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS videos_fts_insert AFTER INSERT ON videos BEGIN
+            INSERT INTO videos_fts (rowid, display_name, filename)
+            VALUES (new.rowid, new.display_name, new.filename);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS videos_fts_delete AFTER DELETE ON videos BEGIN
+            INSERT INTO videos_fts (videos_fts, rowid, display_name, filename)
+            VALUES ('delete', old.rowid, old.display_name, old.filename);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS videos_fts_update AFTER UPDATE OF display_name, filename ON videos BEGIN
+            INSERT INTO videos_fts (videos_fts, rowid, display_name, filename)
+            VALUES ('delete', old.rowid, old.display_name, old.filename);
+            INSERT INTO videos_fts (rowid, display_name, filename)
+            VALUES (new.rowid, new.display_name, new.filename);
+        END
+    ''')
+    # Индексируем уже существующие видео
+    cursor.execute("INSERT INTO videos_fts (videos_fts) VALUES ('rebuild')")
+
+def migration_file_fingerprints(cursor):
+    """Отпечатки файлов для инкрементального сканирования"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS video_files (
+            filename TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            scanned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migration_probe_cache(cursor):
+    """Кэш результатов анализа видео по размеру и времени изменения файла"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS probe_cache (
+            filename TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime_ns INTEGER,
+            orientation TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            fps REAL,
+            frame_count INTEGER,
+            codec TEXT,
+            rotation INTEGER,
+            backend TEXT,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migration_hls_packages(cursor):
+    """Учет HLS-версий видео: статус подготовки, качества, занятое место"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hls_packages (
+            filename TEXT PRIMARY KEY,
+            key TEXT,
+            source_size INTEGER,
+            source_mtime_ns INTEGER,
+            status TEXT DEFAULT 'queued',
+            renditions TEXT,
+            bytes INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP,
+            last_access TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hls_packages_key ON hls_packages (key)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hls_packages_status_access ON hls_packages (status, last_access)')
+
+def migration_optimized_files(cursor):
+    """Результаты перепаковки файлов для быстрого старта"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS optimized_files (
+            filename TEXT PRIMARY KEY,
+            status TEXT,
+            original_size INTEGER,
+            size INTEGER,
+            mtime_ns INTEGER,
+            error TEXT,
+            checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+def migration_uploads(cursor):
+    """Загрузки частями: принятый объем и состояние обработки"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            id TEXT PRIMARY KEY,
+            original_name TEXT,
+            size INTEGER,
+            received INTEGER DEFAULT 0,
+            orientation TEXT,
+            status TEXT,
+            filename TEXT,
+            error TEXT,
+            session_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_uploads_status_updated ON uploads (status, updated_at)')
+
+def migration_jobs(cursor):
+    """Фоновые задачи администратора с прогрессом и историей"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            params TEXT,
+            done INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    # Не больше одной незавершенной задачи каждого типа, в том числе между процессами
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_type ON jobs (type)
+        WHERE status IN ('queued', 'running')
+    ''')
+
+VIDEO_STATS_COLUMNS = ('total_videos', 'banned_videos', 'vertical_videos', 'horizontal_videos', 'unknown_videos',
+                       'total_views', 'total_likes', 'total_dislikes', 'total_duration')
+
+def create_video_stats_triggers(cursor, limit):
+    """Триггеры, поддерживающие video_stats_summary и popular_videos при изменениях videos.
+    
+    Число популярных видео зашито в текст триггеров, поэтому при изменении
+    POPULAR_VIDEOS_LIMIT триггеры пересоздаются (check-stats --rebuild).
+    """
+    limit = int(limit)
+    for name in ('videos_stats_insert', 'videos_stats_delete', 'videos_stats_update',
+                 'videos_popular_views', 'videos_popular_rename'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+    
+    # Лишние строки сверх limit в порядке views DESC, filename
+    prune = f'''
+        DELETE FROM popular_videos WHERE filename IN (
+            SELECT filename FROM popular_videos ORDER BY views DESC, filename LIMIT -1 OFFSET {limit}
+        );'''
+    # Дополнение списка из индекса idx_videos_views, когда лидер пропал или потерял просмотры
+    refill = f'''
+        INSERT OR IGNORE INTO popular_videos (filename, views)
+        SELECT filename, COALESCE(views, 0) FROM videos {{where}} ORDER BY views DESC, filename LIMIT {limit};'''
+    
+    def deltas(sign, row):
+        return f'''
+            total_videos = total_videos {sign} 1,
+            banned_videos = banned_videos {sign} ({row}.banned IS 1),
+            vertical_videos = vertical_videos {sign} ({row}.orientation IS 'vertical'),
+            horizontal_videos = horizontal_videos {sign} ({row}.orientation IS 'horizontal'),
+            unknown_videos = unknown_videos {sign} ({row}.orientation IS 'unknown'),
+            total_views = total_views {sign} COALESCE({row}.views, 0),
+            total_likes = total_likes {sign} COALESCE({row}.likes, 0),
+            total_dislikes = total_dislikes {sign} COALESCE({row}.dislikes, 0),
+            total_duration = total_duration {sign} COALESCE({row}.duration, 0)'''
+    
+    cursor.execute(f'''
+        CREATE TRIGGER videos_stats_insert AFTER INSERT ON videos BEGIN
+            UPDATE video_stats_summary SET {deltas('+', 'new')} WHERE id = 1;
+            INSERT OR REPLACE INTO popular_videos (filename, views) VALUES (new.filename, COALESCE(new.views, 0));
+            {prune}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER videos_stats_delete AFTER DELETE ON videos BEGIN
+            UPDATE video_stats_summary SET {deltas('-', 'old')} WHERE id = 1;
+            DELETE FROM popular_videos WHERE filename = old.filename;
+            {refill.format(where='')}
+            {prune}
+        END
+    ''')
+    # Вычитаем старую строку и прибавляем новую одним UPDATE
+    summary_update = ',\n'.join(
+        f'{column} = {column} - ({old_expr}) + ({old_expr.replace("old.", "new.")})'
+        for column, old_expr in (
+            ('banned_videos', 'old.banned IS 1'),
+            ('vertical_videos', "old.orientation IS 'vertical'"),
+            ('horizontal_videos', "old.orientation IS 'horizontal'"),
+            ('unknown_videos', "old.orientation IS 'unknown'"),
+            ('total_views', 'COALESCE(old.views, 0)'),
+            ('total_likes', 'COALESCE(old.likes, 0)'),
+            ('total_dislikes', 'COALESCE(old.dislikes, 0)'),
+            ('total_duration', 'COALESCE(old.duration, 0)'),
+        ))
+    cursor.execute(f'''
+        CREATE TRIGGER videos_stats_update
+        AFTER UPDATE OF banned, orientation, views, likes, dislikes, duration ON videos BEGIN
+            UPDATE video_stats_summary SET {summary_update} WHERE id = 1;
+        END
+    ''')
+    # Просмотры обычно только растут: тогда достаточно добавить видео в список и отрезать лишнее
+    cursor.execute(f'''
+        CREATE TRIGGER videos_popular_views AFTER UPDATE OF views ON videos BEGIN
+            DELETE FROM popular_videos
+            WHERE filename = old.filename AND COALESCE(new.views, 0) < COALESCE(old.views, 0);
+            {refill.format(where='WHERE COALESCE(new.views, 0) < COALESCE(old.views, 0)')}
+            INSERT OR REPLACE INTO popular_videos (filename, views)
+            SELECT new.filename, COALESCE(new.views, 0) WHERE COALESCE(new.views, 0) >= COALESCE(old.views, 0);
+            {prune}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER videos_popular_rename AFTER UPDATE OF filename ON videos BEGIN
+            UPDATE popular_videos SET filename = new.filename WHERE filename = old.filename;
+            {refill.format(where='')}
+            {prune}
+        END
+    ''')
+
+def compute_video_stats(cursor):
+    """Агрегаты полным проходом по videos (для перестроения и проверки)"""
+    cursor.execute('''
+        SELECT COUNT(*),
+               COALESCE(SUM(banned IS 1), 0),
+               COALESCE(SUM(orientation IS 'vertical'), 0),
+               COALESCE(SUM(orientation IS 'horizontal'), 0),
+               COALESCE(SUM(orientation IS 'unknown'), 0),
+               COALESCE(SUM(views), 0),
+               COALESCE(SUM(likes), 0),
+               COALESCE(SUM(dislikes), 0),
+               COALESCE(SUM(duration), 0)
+        FROM videos
+    ''')
+    return dict(zip(VIDEO_STATS_COLUMNS, cursor.fetchone()))
+
+def compute_popular_videos(cursor, limit):
+    cursor.execute('''
+        SELECT filename, COALESCE(views, 0) FROM videos ORDER BY views DESC, filename LIMIT ?
+    ''', (limit,))
+    return cursor.fetchall()
+
+def rebuild_video_stats(cursor, limit):
+    """Пересоздает триггеры и заново заполняет агрегаты из videos"""
+    create_video_stats_triggers(cursor, limit)
+    stats = compute_video_stats(cursor)
+    cursor.execute('DELETE FROM video_stats_summary')
+    cursor.execute(f'''
+        INSERT INTO video_stats_summary (id, {', '.join(VIDEO_STATS_COLUMNS)})
+        VALUES (1, {', '.join('?' * len(VIDEO_STATS_COLUMNS))})
+    ''', tuple(stats[column] for column in VIDEO_STATS_COLUMNS))
+    cursor.execute('DELETE FROM popular_videos')
+    cursor.executemany('INSERT INTO popular_videos (filename, views) VALUES (?, ?)',
+                       compute_popular_videos(cursor, limit))
+
+def check_video_stats(cursor, limit):
+    """Сравнивает агрегаты с полным пересчетом. Возвращает список расхождений"""
+    problems = []
+    expected = compute_video_stats(cursor)
+    cursor.execute(f"SELECT {', '.join(VIDEO_STATS_COLUMNS)} FROM video_stats_summary WHERE id = 1")
+    row = cursor.fetchone()
+    if row is None:
+        return ['нет строки в video_stats_summary']
+    for column, actual in zip(VIDEO_STATS_COLUMNS, row):
+        # Длительность - сумма дробных чисел, допускаем погрешность округления
+        if abs(actual - expected[column]) > 0.01:
+            problems.append(f'{column}: {actual}, ожидалось {expected[column]}')
+    
+    cursor.execute('SELECT filename, views FROM popular_videos ORDER BY views DESC, filename')
+    actual_popular = cursor.fetchall()
+    expected_popular = compute_popular_videos(cursor, limit)
+    if actual_popular != expected_popular:
+        problems.append(f'popular_videos: {actual_popular}, ожидалось {expected_popular}')
+    return problems
+
+def migration_video_stats(cursor):
+    """Агрегаты статистики админки и список популярных видео, поддерживаемые триггерами"""
+    columns = ',\n'.join(f'{column} {"REAL" if column == "total_duration" else "INTEGER"} DEFAULT 0'
+                         for column in VIDEO_STATS_COLUMNS)
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS video_stats_summary (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            {columns}
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS popular_videos (
             filename TEXT PRIMARY KEY,
-            orientation TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            banned INTEGER DEFAULT 0,
-            views INTEGER DEFAULT 0,
-            likes INTEGER DEFAULT 0,
-            dislikes INTEGER DEFAULT 0,
-            display_name TEXT,
-            duration REAL DEFAULT 0,
-            width INTEGER DEFAULT 0,
-            height INTEGER DEFAULT 0
+            views INTEGER
         )
     ''')
+    # Дополнение списка популярных читает первые строки этого индекса
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_videos_views ON videos (views DESC, filename)')
+    rebuild_video_stats(cursor, POPULAR_VIDEOS_LIMIT)
+
+def migration_shared_state(cursor):
+    """Общее состояние рабочих процессов: флаги, аренды и владельцы фоновой работы"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS video_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
-            filename TEXT,
-            watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
         )
     ''')
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS banned_videos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT UNIQUE,
-            banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            reason TEXT
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
         )
     ''')
+    # Процесс, который выполняет задачу, загрузку или подготовку HLS
+    for table in ('jobs', 'uploads', 'hls_packages'):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN owner TEXT')
+
+def migration_recommendations(cursor):
+    """Соседи видео по совместным просмотрам для рекомендаций"""
+    # Счетчики пар: сколько раз видео смотрели в одной сессии друг за другом
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS admin_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            action TEXT,
-            details TEXT,
-            performed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        CREATE TABLE IF NOT EXISTS video_cowatch (
+            filename TEXT,
+            neighbor TEXT,
+            count INTEGER,
+            PRIMARY KEY (filename, neighbor)
+        ) WITHOUT ROWID
     ''')
+    # Лучшие RECOMMEND_NEIGHBORS соседей каждого видео, по ним отдаются рекомендации
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS video_ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT,
+        CREATE TABLE IF NOT EXISTS video_neighbors (
             filename TEXT,
-            rating INTEGER,
-            rated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(session_id, filename)
+            rank INTEGER,
+            neighbor TEXT,
+            score INTEGER,
+            PRIMARY KEY (filename, rank)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_history_rollups(cursor):
+    """Итоги просмотров по дням для истории, удаленной очисткой"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history_daily (
+            day TEXT,
+            filename TEXT,
+            views INTEGER,
+            PRIMARY KEY (day, filename)
+        ) WITHOUT ROWID
+    ''')
+
+def migration_incremental_vacuum(cursor):
+    """Отмечает, что существующую базу нужно перевести в режим auto_vacuum = INCREMENTAL.
+    
+    Перевод - полный VACUUM: долгий, с эксклюзивной блокировкой и местом на диске
+    размером с базу. Поэтому при запуске он не выполняется, а запускается
+    отдельно: flask --app app enable-incremental-vacuum. Новые базы создаются
+    сразу в этом режиме (см. create_db_connection).
+    """
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] == 2:
+        return
+    cursor.execute("INSERT OR REPLACE INTO app_state (key, value) VALUES ('incremental_vacuum', 'pending')")
+
+def fts_text(column):
+    """Выражение SQL для текста в поисковом индексе: ё и е не различаются"""
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+def migration_fulltext_yo(cursor):
+    """Поиск не различает ё и е: индекс хранит текст с е вместо ё"""
+    if not is_fts_enabled():
+        return
+    for trigger in ('videos_fts_insert', 'videos_fts_delete', 'videos_fts_update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    # Для внешнего содержимого удаление из индекса должно получить те же значения, что были записаны
+    new_values = f"new.rowid, {fts_text('new.display_name')}, {fts_text('new.filename')}"
+    old_values = f"'delete', old.rowid, {fts_text('old.display_name')}, {fts_text('old.filename')}"
+    cursor.execute(f'''
+        CREATE TRIGGER videos_fts_insert AFTER INSERT ON videos BEGIN
+            INSERT INTO videos_fts (rowid, display_name, filename) VALUES ({new_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER videos_fts_delete AFTER DELETE ON videos BEGIN
+            INSERT INTO videos_fts (videos_fts, rowid, display_name, filename) VALUES ({old_values});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER videos_fts_update AFTER UPDATE OF display_name, filename ON videos BEGIN
+            INSERT INTO videos_fts (videos_fts, rowid, display_name, filename) VALUES ({old_values});
+            INSERT INTO videos_fts (rowid, display_name, filename) VALUES ({new_values});
+        END
+    ''')
+    # 'rebuild' читает текст из videos как есть, поэтому индекс заполняется заново вручную
+    cursor.execute("INSERT INTO videos_fts (videos_fts) VALUES ('delete-all')")
+    cursor.execute(f'''
+        INSERT INTO videos_fts (rowid, display_name, filename)
+        SELECT rowid, {fts_text('display_name')}, {fts_text('filename')} FROM videos
+    ''')
+
+def migration_shorts_navigation(cursor):
+    """Сохраненная история навигации shorts (см. ShortsFeedStore)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shorts_navigation (
+            session_id TEXT PRIMARY KEY,
+            history TEXT,
+            cursor INTEGER,
+            updated_at TIMESTAMP
+        )
+    ''')
+
+# Миграции схемы: (версия, описание, функция). Добавлять только в конец списка.
+MIGRATIONS = [
+    (1, 'Индексы для частых запросов', migration_hot_query_indexes),
+    (2, 'Индексы для постраничной выборки', migration_keyset_indexes),
+    (3, 'Полнотекстовый поиск', migration_fulltext_search),
+    (4, 'Отпечатки файлов для сканера', migration_file_fingerprints),
+    (5, 'Кэш анализа видео', migration_probe_cache),
+    (6, 'HLS-версии видео', migration_hls_packages),
+    (7, 'Перепаковка для быстрого старта', migration_optimized_files),
+    (8, 'Загрузки частями', migration_uploads),
+    (9, 'Фоновые задачи', migration_jobs),
+    (10, 'Агрегаты статистики на триггерах', migration_video_stats),
+    (11, 'Общее состояние процессов', migration_shared_state),
+    (12, 'Рекомендации по совместным просмотрам', migration_recommendations),
+    (13, 'Итоги просмотров по дням', migration_history_rollups),
+    (14, 'Постепенное освобождение места в БД', migration_incremental_vacuum),
+    (15, 'Навигация shorts', migration_shorts_navigation),
+    (16, 'Поиск без различия ё и е', migration_fulltext_yo),
+]
+
+def run_migrations(conn):
+    """Применяет к базе все миграции, которые еще не были применены"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     conn.commit()
-    conn.close()
+    
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+    current_version = cursor.fetchone()[0]
+    
+    for version, description, migrate in MIGRATIONS:
+        if version <= current_version:
+            continue
+        
+        print(f"Применение миграции {version}: {description}")
+        try:
+            # BEGIN IMMEDIATE: другой процесс не сможет применить ту же миграцию параллельно
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,))
+            if cursor.fetchone():
+                conn.rollback()
+                continue
+            migrate(cursor)
+            cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                           (version, description))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Ошибка при применении миграции {version}: {e}")
+            raise
+    
+    # Обновляем статистику планировщика запросов для новых индексов
+    cursor.execute('PRAGMA optimize')
 
 def get_video_orientation(filename):
     """Получить ориентацию видео из базы данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    catalog = get_catalog()
+    if catalog is not None and filename in catalog.by_filename:
+        return catalog.by_filename[filename].orientation
+    
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT orientation FROM videos WHERE filename = ?', (filename,))
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
 def set_video_orientation(filename, orientation):
     """Установить ориентацию видео в базе данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT OR REPLACE INTO videos (filename, orientation, updated_at)
         VALUES (?, ?, CURRENT_TIMESTAMP)
     ''', (filename, orientation))
     conn.commit()
-    conn.close()
+    invalidate_catalog()
 
 def get_all_vertical_videos():
     """Получить все вертикальные видео из базы данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    catalog = get_catalog()
+    if catalog is not None:
+        return catalog.vertical
+    
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT filename FROM videos WHERE orientation = "vertical" AND banned = 0')
+    cursor.execute("SELECT filename FROM videos WHERE orientation = 'vertical' AND banned = 0")
     result = [row[0] for row in cursor.fetchall()]
-    conn.close()
     return result
 
-def add_to_history(session_id, filename):
-    """Добавить видео в историю просмотров"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO video_history (session_id, filename)
-        VALUES (?, ?)
-    ''', (session_id, filename))
+class ViewAggregator:
+    """Буфер просмотров: счетчики и история записываются в БД пачками в фоновом потоке"""
     
-    # Увеличиваем счетчик просмотров
-    cursor.execute('''
-        UPDATE videos SET views = views + 1 WHERE filename = ?
-    ''', (filename,))
+    def __init__(self, flush_interval, flush_threshold, dedupe_seconds, dedupe_max_entries, max_pending):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.dedupe_seconds = dedupe_seconds
+        self.dedupe_max_entries = dedupe_max_entries
+        self.max_pending = max_pending
+        self.dropped = 0  # Сколько просмотров отброшено из-за переполнения буфера
+        self.views = {}  # filename -> сколько просмотров добавить
+        self.history = []  # (session_id, filename, watched_at)
+        self.recent = OrderedDict()  # (session_id, filename) -> время последнего засчитанного просмотра
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
     
-    conn.commit()
-    conn.close()
+    def record(self, session_id, filename):
+        """Засчитывает просмотр. Возвращает False для повторного просмотра в пределах окна"""
+        now = time.time()
+        key = (session_id, filename)
+        with self.lock:
+            last_seen = self.recent.get(key)
+            if last_seen is not None and now - last_seen < self.dedupe_seconds:
+                return False
+            self.recent[key] = now
+            self.recent.move_to_end(key)
+            # Записи упорядочены по времени: старые лежат в начале
+            while self.recent and (len(self.recent) > self.dedupe_max_entries or
+                                   now - next(iter(self.recent.values())) >= self.dedupe_seconds):
+                self.recent.popitem(last=False)
+            
+            self.views[filename] = self.views.get(filename, 0) + 1
+            # Формат совпадает с CURRENT_TIMESTAMP в SQLite
+            self.history.append((session_id, filename, time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now))))
+            self.trim()
+            if len(self.history) >= self.flush_threshold:
+                self.wakeup.set()
+            if self.thread is None:
+                self.start()
+        return True
+    
+    def trim(self):
+        """Отбрасывает самые старые просмотры сверх max_pending (вызывается под self.lock)"""
+        excess = len(self.history) - self.max_pending
+        if excess <= 0:
+            return
+        for _, filename, _ in self.history[:excess]:
+            self.views[filename] -= 1
+            if not self.views[filename]:
+                del self.views[filename]
+        del self.history[:excess]
+        self.dropped += excess
+        views_dropped_total.inc(amount=excess)
+    
+    def pending_history(self, session_id):
+        """Еще не записанные просмотры сессии, новые первыми"""
+        with self.lock:
+            return [filename for sid, filename, _ in reversed(self.history) if sid == session_id]
+    
+    def flush(self):
+        """Записывает накопленные просмотры одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                views, history = self.views, self.history
+                self.views, self.history = {}, []
+            if not history:
+                return 0
+            
+            conn = get_db()
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany('INSERT INTO video_history (session_id, filename, watched_at) VALUES (?, ?, ?)',
+                                 history)
+                conn.executemany('UPDATE videos SET views = views + ? WHERE filename = ?',
+                                 [(count, filename) for filename, count in views.items()])
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                # Возвращаем просмотры в буфер, чтобы записать их в следующий раз.
+                # Пока БД недоступна, буфер не растет дальше max_pending
+                with self.lock:
+                    for filename, count in views.items():
+                        self.views[filename] = self.views.get(filename, 0) + count
+                    self.history[:0] = history
+                    self.trim()
+                    pending, dropped = len(self.history), self.dropped
+                print(f"Ошибка при записи просмотров: {e} (в буфере {pending}, всего отброшено {dropped})")
+                return 0
+            return len(history)
+    
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                release_db()
+    
+    def start(self):
+        """Запускает фоновую запись (вызывается при первом просмотре)"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.shutdown)
+    
+    def shutdown(self):
+        """Записывает остаток буфера при остановке сервера"""
+        try:
+            written = self.flush()
+            if written:
+                print(f"Записано просмотров при остановке: {written}")
+        finally:
+            release_db()
+
+view_aggregator = ViewAggregator(VIEW_FLUSH_INTERVAL, VIEW_FLUSH_THRESHOLD,
+                                 VIEW_DEDUPE_SECONDS, VIEW_DEDUPE_MAX_ENTRIES, VIEW_BUFFER_MAX_ENTRIES)
+
+def add_to_history(session_id, filename):
+    """Добавить видео в историю просмотров (запись в БД выполняется пачками в фоне)"""
+    return view_aggregator.record(session_id, filename)
 
 def get_watch_history(session_id, limit=10):
     """Получить историю просмотров"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    pending = view_aggregator.pending_history(session_id)
+    if len(pending) >= limit:
+        return pending[:limit]
+    limit -= len(pending)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT filename FROM video_history 
@@ -281,143 +2054,529 @@ def get_watch_history(session_id, limit=10):
         ORDER BY watched_at DESC 
         LIMIT ?
     ''', (session_id, limit))
-    result = [row[0] for row in cursor.fetchall()]
-    conn.close()
+    result = pending + [row[0] for row in cursor.fetchall()]
     return result
 
-def scan_videos_folder():
-    """Сканирование папки с видео и обновление базы данных с определением ориентации"""
-    print("=" * 60)
-    print("Сканирование папки с видео и определение ориентации...")
-    
-    # Проверяем, существует ли папка
-    if not os.path.exists(VIDEO_FOLDER):
-        print(f"ОШИБКА: Папка {VIDEO_FOLDER} не существует!")
-        return
-    
-    print(f"Сканируемая папка: {VIDEO_FOLDER}")
-    print(f"Файлы в папке: {os.listdir(VIDEO_FOLDER)[:10]}...")
+# Очистка истории просмотров.
+# Подробные строки старше HISTORY_RETENTION_DAYS и сверх HISTORY_MAX_PER_SESSION
+# на сессию сворачиваются в history_daily и удаляются небольшими пачками:
+# каждая пачка - короткая транзакция, блокировка записи надолго не занимается.
+# Строки, еще не учтенные рекомендациями, не удаляются.
+history_cleanup_thread = None
+
+def delete_history_batch(query, params):
+    """Сворачивает в итоги и удаляет пачку строк (id, filename, день), выбранных query.
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    В запрос, кроме params, передаются :watermark (отметка рекомендаций) и :limit.
+    Возвращает число удаленных строк.
+    """
+    conn = get_db()
     cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT value FROM app_state WHERE key = 'recommend_watermark'")
+        row = cursor.fetchone()
+        cursor.execute(query, dict(params, watermark=int(row[0]) if row else 0, limit=HISTORY_CLEANUP_BATCH))
+        rows = cursor.fetchall()
+        totals = {}
+        for _, filename, day in rows:
+            totals[day, filename] = totals.get((day, filename), 0) + 1
+        cursor.executemany('''
+            INSERT INTO history_daily (day, filename, views) VALUES (?, ?, ?)
+            ON CONFLICT(day, filename) DO UPDATE SET views = views + excluded.views
+        ''', [(day, filename, views) for (day, filename), views in totals.items()])
+        cursor.executemany('DELETE FROM video_history WHERE id = ?', [(row[0],) for row in rows])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+def delete_history_rows(query, params, progress=None):
+    """Удаляет пачками все строки, которые выбирает query. Возвращает число удаленных строк"""
+    deleted = 0
+    while True:
+        count = delete_history_batch(query, params)
+        deleted += count
+        if progress:
+            progress(count)
+        if count < HISTORY_CLEANUP_BATCH:
+            return deleted
+        time.sleep(HISTORY_CLEANUP_PAUSE)
+
+def incremental_vacuum():
+    """Возвращает системе свободные страницы БД по VACUUM_STEP_PAGES за шаг. Возвращает их число"""
+    conn = get_db()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    freed = 0
+    while True:
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free_pages:
+            return freed
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+        freed += min(free_pages, VACUUM_STEP_PAGES)
+        time.sleep(HISTORY_CLEANUP_PAUSE)
+
+def cleanup_history(progress=None):
+    """Полный проход очистки: старая история, лимит сессий, освобождение места"""
+    started = time.time()
+    expired = delete_history_rows('''
+        SELECT id, filename, date(watched_at) FROM video_history
+        WHERE id <= :watermark AND watched_at < datetime('now', :retention)
+        ORDER BY id LIMIT :limit
+    ''', {'retention': f'-{HISTORY_RETENTION_DAYS} days'}, progress)
     
-    # Получаем существующие файлы в базе
-    cursor.execute('SELECT filename FROM videos')
-    existing_files = {row[0] for row in cursor.fetchall()}
-    print(f"Существующих файлов в БД: {len(existing_files)}")
+    over_limit = get_db().execute('''
+        SELECT session_id FROM video_history GROUP BY session_id HAVING COUNT(*) > ?
+    ''', (HISTORY_MAX_PER_SESSION,)).fetchall()
+    trimmed = 0
+    for (session_id,) in over_limit:
+        # Самые старые строки сессии, кроме последних HISTORY_MAX_PER_SESSION
+        trimmed += delete_history_rows('''
+            SELECT id, filename, date(watched_at) FROM (
+                SELECT id, filename, watched_at FROM video_history
+                WHERE session_id = :session_id
+                ORDER BY watched_at DESC LIMIT -1 OFFSET :keep
+            ) WHERE id <= :watermark ORDER BY watched_at LIMIT :limit
+        ''', {'session_id': session_id, 'keep': HISTORY_MAX_PER_SESSION}, progress)
+    
+    # Навигация shorts давно неактивных сессий
+    conn = get_db()
+    conn.execute("DELETE FROM shorts_navigation WHERE updated_at < datetime('now', ?)",
+                 (f'-{SHORTS_FEED_PERSIST_DAYS} days',))
+    conn.commit()
     
-    # Получаем актуальные файлы в папке
-    current_files = set()
-    video_files = []
+    freed_pages = incremental_vacuum()
+    set_shared_state('history_cleanup_at', str(time.time()))
+    result = {'expired': expired, 'trimmed': trimmed, 'freed_pages': freed_pages}
+    if expired or trimmed or freed_pages:
+        print(f"Очистка истории: удалено старых {expired}, сверх лимита сессий {trimmed}, "
+              f"освобождено страниц {freed_pages} за {time.time() - started:.1f}с")
+    return result
+
+def run_history_cleanup():
+    try:
+        cleanup_history()
+    except Exception as e:
+        print(f"Ошибка при очистке истории: {e}")
+    finally:
+        release_db()
+
+@coordinator.leader_task
+def schedule_history_cleanup():
+    """Раз в HISTORY_CLEANUP_INTERVAL запускает очистку истории в отдельном потоке,
+    чтобы долгий проход не задерживал продление аренды"""
+    global history_cleanup_thread
+    if history_cleanup_thread is not None and history_cleanup_thread.is_alive():
+        return
+    if time.time() - float(get_shared_state('history_cleanup_at', '0')) < HISTORY_CLEANUP_INTERVAL:
+        return
+    history_cleanup_thread = threading.Thread(target=run_history_cleanup, daemon=True)
+    history_cleanup_thread.start()
+
+def get_daily_views(days, filename=None):
+    """Просмотры по дням за последние days дней: итоги удаленной истории плюс подробная история"""
+    since = f'-{days} days'
+    condition = 'AND filename = ?' if filename else ''
+    params = (filename,) if filename else ()
+    rows = get_db().execute(f'''
+        SELECT day, SUM(views) FROM (
+            SELECT day, views FROM history_daily WHERE day >= date('now', ?) {condition}
+            UNION ALL
+            SELECT date(watched_at), 1 FROM video_history WHERE watched_at >= date('now', ?) {condition}
+        ) GROUP BY day ORDER BY day
+    ''', (since, *params, since, *params)).fetchall()
+    return [{'day': day, 'views': views} for day, views in rows]
+
+def iter_video_files(watcher=None, failed_paths=None):
+    """Обходит папку с видео через os.scandir.
     
-    for file in os.listdir(VIDEO_FOLDER):
-        if '.' in file:
-            ext = file.rsplit('.', 1)[-1].lower()
-            if ext in ALLOWED_EXTENSIONS:
-                current_files.add(file)
-                video_files.append(file)
+    Возвращает (имя относительно VIDEO_FOLDER через "/", stat) для каждого видеофайла.
+    Скрытые файлы и папки (начинающиеся с точки) пропускаются.
+    Если сама VIDEO_FOLDER не читается, бросает OSError. Вложенные папки и файлы,
+    которые не удалось прочитать, добавляются в failed_paths (относительные имена).
+    """
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        absolute_dir = os.path.join(VIDEO_FOLDER, relative_dir) if relative_dir else VIDEO_FOLDER
+        if watcher is not None:
+            watcher.add_directory(absolute_dir)
+        try:
+            entries = os.scandir(absolute_dir)
+        except OSError as e:
+            if not relative_dir:
+                # Папка недоступна (не подключен диск, нет прав): без списка файлов сканировать нельзя
+                raise
+            print(f"  Не удалось прочитать папку {absolute_dir}: {e}")
+            if failed_paths is not None:
+                failed_paths.add(relative_dir)
+            continue
+        
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                relative_name = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if SCAN_RECURSIVE:
+                            pending.append(relative_name)
+                        continue
+                    if not allowed_file(entry.name):
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    if failed_paths is not None:
+                        failed_paths.add(relative_name)
+                    continue
+                yield relative_name, stat
+
+def is_under_paths(filename, paths):
+    """Лежит ли файл в одной из папок paths (или совпадает с одним из путей)"""
+    return any(filename == path or filename.startswith(path + '/') for path in paths)
+
+def get_file_fingerprint(stat):
+    """Отпечаток файла для определения изменений: (размер, время изменения, inode)"""
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+# Два прохода сканера не должны идти одновременно (фоновый и ручной): внутри
+# процесса их разделяет блокировка, между процессами - аренда scan
+scan_lock = threading.Lock()
+
+def scan_videos_folder(watcher=None, progress=None):
+    """Сканирование папки с видео и обновление базы данных с определением ориентации.
     
-    print(f"Найдено видеофайлов в папке: {len(video_files)}")
+    Проверяются только отпечатки файлов (размер, время изменения, inode),
+    видео заново анализируются только если файл новый или изменился.
+    Все изменения одного прохода записываются одной транзакцией.
+    Процессы сканируют по очереди (аренда scan). Возвращает словарь со
+    статистикой прохода или None, если папку сейчас сканирует другой процесс.
+    progress вызывается между этапами и может прервать проход (отмена задачи).
+    """
+    result = {'new': 0, 'updated': 0, 'deleted': 0, 'unsettled': 0}
     
-    # Добавляем новые файлы с автоматическим определением ориентации
-    new_files = current_files - existing_files
-    print(f"Новых файлов для добавления: {len(new_files)}")
+    # Проверяем, существует ли папка
+    if not os.path.exists(VIDEO_FOLDER):
+        print(f"ОШИБКА: Папка {VIDEO_FOLDER} не существует!")
+        return result
     
-    for filename in new_files:
-        # Автоматически определяем ориентацию и размеры
-        orientation, width, height, duration = detect_video_info(filename)
+    with scan_lock:
+        if not coordinator.acquire('scan'):
+            print("Сканирование уже идет в другом процессе")
+            return None
+        def renew(message):
+            # Долгий проход продлевает аренду, иначе ее может забрать другой процесс
+            if not coordinator.acquire('scan'):
+                raise RuntimeError('аренду сканирования забрал другой процесс')
+            if progress:
+                progress(message=message)
         
-        # Создаем отображаемое имя
         try:
-            display_name = unquote(filename)
-        except:
-            display_name = filename
-        
-        cursor.execute('''
-            INSERT OR IGNORE INTO videos (filename, orientation, display_name, width, height, duration)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (filename, orientation, display_name, width, height, duration))
-        print(f"  Добавлено: {filename} - {orientation} ({width}x{height}) - {duration}сек")
-    
-    # Для существующих файлов проверяем и обновляем информацию
-    for filename in existing_files:
-        if filename in current_files:  # Проверяем, что файл все еще существует
-            # Проверяем, есть ли информация о размерах и длительности
-            cursor.execute('SELECT width, height, duration FROM videos WHERE filename = ?', (filename,))
-            result = cursor.fetchone()
+            started = time.time()
+            conn = get_db()
+            cursor = conn.cursor()
+            
+            # Получаем существующие файлы и их отпечатки двумя запросами
+            cursor.execute('SELECT filename, width, height, duration FROM videos')
+            existing_files = {row[0]: row[1:] for row in cursor.fetchall()}
+            cursor.execute('SELECT filename, size, mtime_ns, inode FROM video_files')
+            fingerprints = {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+            
+            current_files = set()
+            new_files = []  # (filename, fingerprint)
+            changed_files = []  # (filename, fingerprint), нужно заново проанализировать
+            fingerprint_only = []  # (filename, fingerprint), данные в БД уже полные
+            settle_time = time.time() - SCAN_SETTLE_SECONDS
+            failed_paths = set()
+            
+            for filename, stat in iter_video_files(watcher, failed_paths):
+                current_files.add(filename)
+                fingerprint = get_file_fingerprint(stat)
+                if fingerprints.get(filename) == fingerprint:
+                    continue
+            
+                # Файл еще копируется: посмотрим на него на следующем проходе
+                if stat.st_mtime > settle_time:
+                    result['unsettled'] += 1
+                    continue
+            
+                if filename not in existing_files:
+                    new_files.append((filename, fingerprint))
+                elif filename not in fingerprints and all(existing_files[filename]):
+                    # Видео уже было в базе до появления отпечатков: анализ не нужен
+                    fingerprint_only.append((filename, fingerprint))
+                else:
+                    changed_files.append((filename, fingerprint))
+            
+            filename_index.sync(current_files)
+            renew('Файлы перечислены')
+            deleted_files = set(existing_files) - current_files
+            stale_fingerprints = set(fingerprints) - current_files
+            if failed_paths:
+                # Файлы в непрочитанных папках могли остаться на месте: их просмотры и оценки не трогаем
+                if not current_files:
+                    print(f"  Папки не прочитаны ({len(failed_paths)}), удаление видео из базы пропущено")
+                    deleted_files = set()
+                    stale_fingerprints = set()
+                else:
+                    deleted_files = {f for f in deleted_files if not is_under_paths(f, failed_paths)}
+                    stale_fingerprints = {f for f in stale_fingerprints if not is_under_paths(f, failed_paths)}
+            
+            if not (new_files or changed_files or fingerprint_only or deleted_files or stale_fingerprints):
+                return result
             
-            if result and (result[0] == 0 or result[1] == 0 or result[2] == 0):
-                # Если информация неполная, обновляем
-                orientation, width, height, duration = detect_video_info(filename)
-                if orientation != "unknown":
+            # Анализируем файлы параллельно до начала транзакции, чтобы не держать блокировку записи
+            probed = {}
+            to_probe = [filename for filename, _ in new_files + changed_files]
+            if to_probe:
+                def save_probed(batch):
+                    probed.update(batch)
+                    renew(f'Проанализировано {len(probed)} из {len(to_probe)}')
+                probe_videos(to_probe, save_probed)
+            
+            # Последняя точка отмены: после нее изменения записываются целиком
+            renew('Запись изменений')
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for filename, fingerprint in new_files:
+                    orientation, width, height, duration = probed[filename]
+                    # Создаем отображаемое имя
+                    try:
+                        display_name = unquote(os.path.basename(filename))
+                    except:
+                        display_name = os.path.basename(filename)
                     cursor.execute('''
-                        UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ? WHERE filename = ?
-                    ''', (orientation, width, height, duration, filename))
-                    print(f"  Обновлено: {filename} - {orientation} ({width}x{height}) - {duration}сек")
+                        INSERT OR IGNORE INTO videos (filename, orientation, display_name, width, height, duration)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (filename, orientation, display_name, width, height, duration))
+                    print(f"  Добавлено: {filename} - {orientation} ({width}x{height}) - {duration}сек")
+            
+                for filename, fingerprint in changed_files:
+                    orientation, width, height, duration = probed[filename]
+                    if orientation != "unknown":
+                        cursor.execute('''
+                            UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ?,
+                                updated_at = CURRENT_TIMESTAMP
+                            WHERE filename = ?
+                        ''', (orientation, width, height, duration, filename))
+                        print(f"  Обновлено: {filename} - {orientation} ({width}x{height}) - {duration}сек")
+            
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO video_files (filename, size, mtime_ns, inode, scanned_at)
+                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ''', [(filename,) + fingerprint for filename, fingerprint in new_files + changed_files + fingerprint_only])
+            
+                # Удаляем удаленные файлы
+                for filename in deleted_files:
+                    cursor.execute('DELETE FROM videos WHERE filename = ?', (filename,))
+                    print(f"  Удалено: {filename}")
+                cursor.executemany('DELETE FROM video_files WHERE filename = ?',
+                                   [(filename,) for filename in stale_fingerprints])
+                cursor.executemany('DELETE FROM probe_cache WHERE filename = ?',
+                                   [(filename,) for filename in deleted_files | stale_fingerprints])
+                cursor.executemany('DELETE FROM optimized_files WHERE filename = ?',
+                                   [(filename,) for filename in deleted_files | stale_fingerprints])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            
+            result['new'] = len(new_files)
+            result['updated'] = len(changed_files)
+            result['deleted'] = len(deleted_files)
+            for filename in deleted_files:
+                remove_hls_package(filename)
+            # Новые MP4/MOV проверяем на moov в конце файла
+            for filename, _ in new_files:
+                schedule_faststart(filename)
+            if new_files or changed_files or deleted_files:
+                invalidate_catalog()
+            scan_seconds.observe(time.time() - started)
+            for kind in ('new', 'updated', 'deleted'):
+                if result[kind]:
+                    scan_changes_total.inc(kind, amount=result[kind])
+            print(f"Сканирование завершено за {time.time() - started:.1f}с. "
+                  f"Новых файлов: {result['new']}, измененных: {result['updated']}, удаленных: {result['deleted']}")
+            return result
+        finally:
+            coordinator.release('scan')
+
+# Отслеживание изменений в папке через inotify (только Linux).
+# На других системах сканер просто периодически проверяет отпечатки файлов.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ONLYDIR = 0x01000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+class InotifyWatcher:
+    """Ожидание изменений в папке с видео через inotify"""
     
-    # Удаляем удаленные файлы
-    deleted_files = existing_files - current_files
-    for filename in deleted_files:
-        cursor.execute('DELETE FROM videos WHERE filename = ?', (filename,))
-        print(f"  Удалено: {filename}")
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watched = set()
     
-    conn.commit()
-    conn.close()
-    print(f"Сканирование завершено. Новых файлов: {len(new_files)}, удаленных: {len(deleted_files)}")
-    print("=" * 60)
+    def add_directory(self, path):
+        """Подписывается на изменения в папке (повторные вызовы игнорируются)"""
+        if path in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), INOTIFY_MASK | IN_ONLYDIR)
+        if wd >= 0:
+            self.watched.add(path)
+    
+    def wait(self, timeout):
+        """Ждет изменений не дольше timeout секунд; возвращает True, если они были"""
+        deadline = time.monotonic() + timeout
+        # Изменения скрытых файлов (загрузки частями, перепаковка) сканирование не запускают
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            if self.drain():
+                break
+        
+        # Собираем пачку событий, пока изменения продолжаются
+        while True:
+            readable, _, _ = select.select([self.fd], [], [], SCAN_DEBOUNCE_SECONDS)
+            if not readable:
+                return True
+            self.drain()
+    
+    def drain(self):
+        """Вычитывает накопившиеся события; возвращает True, если среди них есть не скрытые файлы"""
+        relevant = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return relevant
+            if not data:
+                return relevant
+            offset = 0
+            while offset + 16 <= len(data):
+                _, mask, _, name_length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + name_length].rstrip(b'\0')
+                offset += 16 + name_length
+                if not name.startswith(b'.'):
+                    relevant = True
+                if mask & IN_DELETE_SELF:
+                    # Папка удалена: при следующем проходе подписки обновятся
+                    self.watched.clear()
+
+def create_folder_watcher():
+    """Создает наблюдатель за папкой или возвращает None (тогда используется опрос)"""
+    if not platform.system() == 'Linux':
+        return None
+    try:
+        watcher = InotifyWatcher()
+        print("Изменения в папке с видео отслеживаются через inotify")
+        return watcher
+    except Exception as e:
+        print(f"inotify недоступен ({e}), папка будет проверяться каждые {SCAN_POLL_INTERVAL} секунд")
+        return None
 
 @app.route('/admin/redetect_orientations', methods=['POST'])
 def admin_redetect_orientations():
-    """Принудительное переопределение ориентации всех видео"""
-    global admin_access
-    if not admin_access:
+    """Принудительное переопределение ориентации всех видео (фоновая задача)"""
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
-    # Получаем все видео
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT filename FROM videos')
-    all_videos = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    
-    # Переопределяем ориентацию для каждого видео
-    updated_count = 0
-    for filename in all_videos:
-        orientation, width, height, duration = detect_video_info(filename)
-        if orientation != "unknown":
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ? WHERE filename = ?', 
-                          (orientation, width, height, duration, filename))
-            conn.commit()
-            conn.close()
-            updated_count += 1
-    
-    log_admin_action("Переопределение ориентаций", 
-                    f"Обновлено {updated_count} видео")
-    flash(f'Ориентация переопределена для {updated_count} видео')
+    # force=1 анализирует файлы заново, не глядя в кэш
+    job_id, created = job_manager.submit('redetect_orientations', force=request.values.get('force') == '1')
+    flash_job_started(job_id, created)
     
     return redirect(url_for('admin'))
 
 def background_scanner():
     """Фоновая задача для сканирования папки с видео"""
+    watcher = create_folder_watcher()
     while True:
+        # Сканирует только ведущий процесс; если аренду перехватил другой, ждем ее возвращения
+        if not coordinator.leader:
+            time.sleep(LEASE_RENEW_INTERVAL)
+            continue
+        result = None
         try:
-            scan_videos_folder()
+            result = scan_videos_folder(watcher)
+            cleanup_stale_uploads()
         except Exception as e:
             print(f"Ошибка при сканировании папки: {e}")
             import traceback
             traceback.print_exc()
-        time.sleep(1800)  # 30 минут
+        finally:
+            release_db()
+        
+        if result and result['unsettled']:
+            # Часть файлов еще копируется, проверим их чуть позже
+            time.sleep(SCAN_SETTLE_SECONDS)
+        elif watcher is not None:
+            watcher.wait(SCAN_WATCH_INTERVAL)
+        else:
+            time.sleep(SCAN_POLL_INTERVAL)
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def detect_video_info(filename):
-    """Автоматически определяет ориентацию, размеры и длительность видео"""
-    video_path = os.path.join(VIDEO_FOLDER, filename)
-    
+def detect_video_info(filename, force=False):
+    """Автоматически определяет ориентацию, размеры и длительность видео (с кэшем результатов)"""
+    results = {}
+    probe_videos([filename], results.update, force=force)
+    return results[filename]
+
+def classify_orientation(width, height):
+    """Определяет ориентацию по размерам кадра"""
+    # УЛУЧШЕННЫЙ АЛГОРИТМ ОПРЕДЕЛЕНИЯ ОРИЕНТАЦИИ
+    if width <= 0 or height <= 0:
+        return "unknown"
+    aspect_ratio = width / height
+    # Вертикальное видео: высота значительно больше ширины
+    if aspect_ratio < 0.75:  # Более строгий критерий: 3:4 или уже
+        return "vertical"
+    # Горизонтальное видео: ширина значительно больше высоты
+    if aspect_ratio > 1.33:  # Более строгий критерий: 4:3 или шире
+        return "horizontal"
+    # Квадратное или почти квадратное видео
+    return "square"
+
+def parse_frame_rate(value):
+    """Преобразует частоту кадров ffprobe ("30000/1001") в число"""
+    try:
+        if '/' in value:
+            numerator, denominator = value.split('/', 1)
+            return float(numerator) / float(denominator) if float(denominator) else 0
+        return float(value)
+    except (TypeError, ValueError):
+        return 0
+
+def make_probe_result(orientation="unknown", width=0, height=0, duration=0, fps=0, frame_count=0,
+                      codec=None, rotation=0, backend=None):
+    """Собирает результат анализа видео в словарь"""
+    return {
+        'orientation': orientation,
+        'width': width,
+        'height': height,
+        'duration': duration,
+        'fps': fps,
+        'frame_count': frame_count,
+        'codec': codec,
+        'rotation': rotation,
+        'backend': backend,
+    }
+
+def probe_video_file(video_path, filename):
+    """Анализирует файл видео (выполняется и в процессах пула, поэтому не обращается к БД)"""
     print(f"Определение ориентации для: {filename}")
     
     # Сначала пробуем использовать OpenCV, так как он проще
@@ -430,6 +2589,11 @@ def detect_video_info(filename):
                 height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
                 fps = cap.get(cv2.CAP_PROP_FPS)
                 frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+                codec = ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip('\0 ') or None
+                rotation = 0
+                if hasattr(cv2, 'CAP_PROP_ORIENTATION_META'):
+                    rotation = int(cap.get(cv2.CAP_PROP_ORIENTATION_META))
                 
                 if fps > 0:
                     duration = frame_count / fps
@@ -438,23 +2602,13 @@ def detect_video_info(filename):
                 
                 cap.release()
                 
-                # УЛУЧШЕННЫЙ АЛГОРИТМ ОПРЕДЕЛЕНИЯ ОРИЕНТАЦИИ
                 aspect_ratio = width / height if height > 0 else 1
-                
                 print(f"  Размеры: {width}x{height}, соотношение: {aspect_ratio:.2f}")
                 
-                # Вертикальное видео: высота значительно больше ширины
-                if aspect_ratio < 0.75:  # Более строгий критерий: 3:4 или уже
-                    orientation = "vertical"
-                # Горизонтальное видео: ширина значительно больше высоты
-                elif aspect_ratio > 1.33:  # Более строгий критерий: 4:3 или шире
-                    orientation = "horizontal"
-                # Квадратное или почти квадратное видео
-                else:
-                    orientation = "square"
-                
+                orientation = classify_orientation(width, height)
                 print(f"  Определена ориентация: {orientation}")
-                return orientation, width, height, duration
+                return make_probe_result(orientation, width, height, duration, fps, frame_count,
+                                         codec, rotation, 'opencv')
         except Exception as e:
             print(f"  Ошибка при использовании OpenCV для {filename}: {e}")
     
@@ -472,7 +2626,8 @@ def detect_video_info(filename):
             video_path
         ]
         
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='ignore', env=env)
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='ignore', env=env,
+                                timeout=PROBE_TIMEOUT)
         
         if result.returncode == 0 and result.stdout:
             info = json.loads(result.stdout)
@@ -487,6 +2642,21 @@ def detect_video_info(filename):
             if video_stream:
                 width = video_stream.get('width', 0)
                 height = video_stream.get('height', 0)
+                fps = parse_frame_rate(video_stream.get('avg_frame_rate') or video_stream.get('r_frame_rate'))
+                try:
+                    frame_count = int(video_stream.get('nb_frames', 0))
+                except ValueError:
+                    frame_count = 0
+                
+                # Поворот хранится либо в теге rotate, либо в матрице отображения
+                rotation = 0
+                try:
+                    rotation = int(video_stream.get('tags', {}).get('rotate', 0))
+                    for side_data in video_stream.get('side_data_list', []):
+                        if 'rotation' in side_data:
+                            rotation = int(side_data['rotation'])
+                except (TypeError, ValueError):
+                    pass
                 
                 # Пытаемся получить длительность из формата или потока
                 duration_str = info.get('format', {}).get('duration')
@@ -498,21 +2668,10 @@ def detect_video_info(filename):
                 else:
                     duration = 0
                 
-                # УЛУЧШЕННЫЙ АЛГОРИТМ ОПРЕДЕЛЕНИЯ ОРИЕНТАЦИИ
-                if width > 0 and height > 0:
-                    aspect_ratio = width / height
-                    
-                    if aspect_ratio < 0.75:  # Более строгий критерий
-                        orientation = "vertical"
-                    elif aspect_ratio > 1.33:  # Более строгий критерий
-                        orientation = "horizontal"
-                    else:
-                        orientation = "square"
-                else:
-                    orientation = "unknown"
-                
-                print(f"  FFprobe: {orientation} ({width}x{height}, соотношение: {aspect_ratio:.2f}) - {duration:.2f}сек")
-                return orientation, width, height, duration
+                orientation = classify_orientation(width, height)
+                print(f"  FFprobe: {orientation} ({width}x{height}) - {duration:.2f}сек")
+                return make_probe_result(orientation, width, height, duration, fps, frame_count,
+                                         video_stream.get('codec_name'), rotation, 'ffprobe')
     except Exception as e:
         print(f"  Ошибка при использовании ffprobe для {filename}: {e}")
     
@@ -526,21 +2685,350 @@ def detect_video_info(filename):
         for keyword in vertical_keywords:
             if keyword in filename_lower:
                 print(f"  По ключевым словам определена вертикальная ориентация")
-                return "vertical", 1080, 1920, 0
+                return make_probe_result("vertical", 1080, 1920, backend='filename')
+        
+        for keyword in horizontal_keywords:
+            if keyword in filename_lower:
+                print(f"  По ключевым словам определена горизонтальная ориентация")
+                return make_probe_result("horizontal", 1920, 1080, backend='filename')
+    except:
+        pass
+    
+    print(f"  Не удалось определить информацию для видео")
+    return make_probe_result()
+
+PROBE_CACHE_COLUMNS = ('orientation', 'width', 'height', 'duration', 'fps', 'frame_count', 'codec', 'rotation', 'backend')
+
+def load_probe_cache(keys):
+    """Возвращает сохраненные результаты анализа для файлов, которые не менялись"""
+    cached = {}
+    if not keys:
+        return cached
+    conn = get_db()
+    cursor = conn.cursor()
+    filenames = list(keys)
+    # Читаем частями, чтобы не упереться в ограничение числа параметров SQLite
+    for start in range(0, len(filenames), 500):
+        chunk = filenames[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT filename, size, mtime_ns, {', '.join(PROBE_CACHE_COLUMNS)}
+            FROM probe_cache WHERE filename IN ({placeholders})
+        ''', chunk)
+        for row in cursor.fetchall():
+            if keys[row[0]] == (row[1], row[2]):
+                cached[row[0]] = dict(zip(PROBE_CACHE_COLUMNS, row[3:]))
+    return cached
+
+def save_probe_cache(entries):
+    """Сохраняет результаты анализа: [(filename, (size, mtime_ns), результат)]"""
+    if not entries:
+        return
+    conn = get_db()
+    conn.executemany(f'''
+        INSERT OR REPLACE INTO probe_cache (filename, size, mtime_ns, {', '.join(PROBE_CACHE_COLUMNS)}, probed_at)
+        VALUES (?, ?, ?, {', '.join('?' * len(PROBE_CACHE_COLUMNS))}, CURRENT_TIMESTAMP)
+    ''', [(filename,) + key + tuple(info[column] for column in PROBE_CACHE_COLUMNS) for filename, key, info in entries])
+    conn.commit()
+
+def get_probe_cache_key(filename):
+    """Ключ кэша анализа: размер и время изменения файла (None, если файл недоступен)"""
+    try:
+        stat = os.stat(os.path.join(VIDEO_FOLDER, filename))
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+def is_rotational_disk(path):
+    """Проверяет, лежит ли путь на HDD (только Linux; None - если неизвестно)"""
+    try:
+        st = os.stat(path)
+        device = f"/sys/dev/block/{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+    except (OSError, AttributeError):
+        return None
+    # Для раздела флаг хранится у родительского устройства
+    for flag_path in (os.path.join(device, 'queue', 'rotational'),
+                      os.path.join(device, '..', 'queue', 'rotational')):
+        try:
+            with open(flag_path) as f:
+                return f.read().strip() == '1'
+        except OSError:
+            continue
+    return None
+
+def get_probe_workers():
+    """Сколько файлов анализировать одновременно"""
+    workers = PROBE_WORKERS or os.cpu_count() or 2
+    if is_rotational_disk(VIDEO_FOLDER):
+        # На HDD одновременное чтение многих файлов только замедляет работу
+        workers = min(workers, PROBE_IO_CONCURRENCY)
+    return max(1, workers)
+
+def create_probe_pool(workers):
+    """Создает пул процессов для анализа видео"""
+    # spawn: дочерние процессы не наследуют потоки и соединения с БД сервера
+    return multiprocessing.get_context('spawn').Pool(workers)
+
+def probe_videos(filenames, on_batch, batch_size=PROBE_BATCH_SIZE, force=False):
+    """Анализирует видео параллельно и передает результаты пачками в on_batch.
+    
+    Неизменившиеся файлы берутся из кэша, force=True анализирует их заново.
+    """
+    started = time.time()
+    stats = {'files': len(filenames), 'cached': 0, 'timeouts': 0, 'seconds': 0.0, 'files_per_second': 0.0}
+    keys = {filename: get_probe_cache_key(filename) for filename in filenames}
+    cached = {} if force else load_probe_cache({f: key for f, key in keys.items() if key is not None})
+    to_probe = [filename for filename in filenames if filename not in cached]
+    stats['cached'] = len(cached)
+    workers = min(get_probe_workers(), len(to_probe))
+    batch = []
+    cache_entries = []
+    
+    def flush():
+        save_probe_cache(cache_entries)
+        cache_entries.clear()
+        on_batch(batch[:])
+        batch.clear()
+    
+    def emit(filename, info, store=True):
+        # Результаты зависших и упавших проверок не кэшируем: в следующий раз попробуем снова
+        if store and keys[filename] is not None:
+            cache_entries.append((filename, keys[filename], info))
+        batch.append((filename, (info['orientation'], info['width'], info['height'], info['duration'])))
+        if len(batch) >= batch_size:
+            flush()
+    
+    for filename, info in cached.items():
+        emit(filename, info, store=False)
+    
+    if workers <= 1:
+        # Для одного файла запуск пула дороже самого анализа
+        for filename in to_probe:
+            emit(filename, probe_video_file(os.path.join(VIDEO_FOLDER, filename), filename))
+    else:
+        pending = list(reversed(to_probe))
+        in_flight = {}  # filename -> (результат, крайний срок)
+        pool = create_probe_pool(workers)
+        try:
+            while pending or in_flight:
+                # В работе не больше файлов, чем процессов: таймаут отсчитывается от начала анализа
+                while pending and len(in_flight) < workers:
+                    filename = pending.pop()
+                    async_result = pool.apply_async(probe_video_file, (os.path.join(VIDEO_FOLDER, filename), filename))
+                    in_flight[filename] = (async_result, time.monotonic() + PROBE_TIMEOUT)
+                
+                finished = [filename for filename, (async_result, _) in in_flight.items() if async_result.ready()]
+                for filename in finished:
+                    async_result, _ = in_flight.pop(filename)
+                    try:
+                        info = async_result.get()
+                    except Exception as e:
+                        print(f"  Ошибка при анализе {filename}: {e}")
+                        emit(filename, make_probe_result(), store=False)
+                        continue
+                    # Исключение из on_batch (например, отмена задачи) прерывает анализ
+                    emit(filename, info)
+                
+                now = time.monotonic()
+                hung = [filename for filename, (_, deadline) in in_flight.items() if deadline < now]
+                if hung:
+                    # Зависший процесс нельзя остановить отдельно: пересоздаем пул,
+                    # а остальные незавершенные файлы отправляем заново
+                    for filename in hung:
+                        del in_flight[filename]
+                        print(f"  Превышено время анализа ({PROBE_TIMEOUT}с): {filename}")
+                        stats['timeouts'] += 1
+                        emit(filename, make_probe_result(), store=False)
+                    pool.terminate()
+                    pool.join()
+                    pending.extend(in_flight)
+                    in_flight.clear()
+                    pool = create_probe_pool(workers)
+                elif not finished:
+                    time.sleep(0.05)
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    if batch:
+        flush()
+    
+    stats['seconds'] = time.time() - started
+    probe_run_seconds.observe(stats['seconds'])
+    cache_requests_total.inc('probe', 'hit', amount=stats['cached'])
+    cache_requests_total.inc('probe', 'miss', amount=len(to_probe))
+    probe_files_total.inc('cached', amount=stats['cached'])
+    probe_files_total.inc('probed', amount=len(to_probe) - stats['timeouts'])
+    probe_files_total.inc('timeout', amount=stats['timeouts'])
+    if stats['seconds'] > 0:
+        stats['files_per_second'] = stats['files'] / stats['seconds']
+    print(f"Проанализировано файлов: {stats['files']} за {stats['seconds']:.1f}с "
+          f"({stats['files_per_second']:.1f} файлов/с, из кэша: {stats['cached']}, "
+          f"процессов: {workers}, зависло: {stats['timeouts']})")
+    return stats
+
+# Семафор ограничивает число одновременных декодирований кадров для превью
+thumbnail_semaphore = threading.BoundedSemaphore(2)
+
+def get_thumbnail_key(filename, file_path):
+    """Возвращает ключ превью: хэш имени файла и версию по размеру и дате изменения"""
+    stat = os.stat(file_path)
+    name_hash = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:24]
+    version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:12]
+    return name_hash, version
+
+def get_thumbnail_cache_path(name_hash, version):
+    """Путь к файлу превью в кэше (с разбиением по подпапкам)"""
+    return os.path.join(THUMBNAIL_FOLDER, name_hash[:2], f"{name_hash}-{version}.jpg")
+
+def get_thumbnail_failure_path(name_hash, version):
+    """Отметка в кэше превью: для этой версии файла кадр получить не удалось.
+    
+    Отметка видна всем процессам и удаляется вместе с превью файла (remove_thumbnails),
+    поэтому для нового содержимого файла попытка повторяется.
+    """
+    return os.path.join(THUMBNAIL_FOLDER, name_hash[:2], f"{name_hash}-{version}.failed")
+
+def is_recent_thumbnail_failure(failure_path):
+    try:
+        return time.time() - os.path.getmtime(failure_path) < THUMBNAIL_RETRY_SECONDS
+    except OSError:
+        return False
+
+def extract_thumbnail_frame(video_path, output_path):
+    """Извлекает один кадр из видео и сохраняет его как JPEG"""
+    # Сначала пробуем OpenCV, как и в detect_video_info
+    if OPENCV_AVAILABLE:
+        try:
+            cap = cv2.VideoCapture(video_path)
+            if cap.isOpened():
+                frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                fps = cap.get(cv2.CAP_PROP_FPS)
+                
+                # Берем кадр на 10% длительности, но не дальше 5 секунд от начала
+                target_frame = int(frame_count * 0.1)
+                if fps > 0:
+                    target_frame = min(target_frame, int(fps * 5))
+                if target_frame > 0:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, target_frame)
+                
+                ok, frame = cap.read()
+                if not ok:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    ok, frame = cap.read()
+                cap.release()
+                
+                if ok and frame is not None:
+                    height, width = frame.shape[:2]
+                    if width > THUMBNAIL_WIDTH:
+                        new_height = int(height * THUMBNAIL_WIDTH / width)
+                        frame = cv2.resize(frame, (THUMBNAIL_WIDTH, new_height), interpolation=cv2.INTER_AREA)
+                    ok, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+                    if ok:
+                        with open(output_path, 'wb') as f:
+                            f.write(buffer.tobytes())
+                        return True
+        except Exception as e:
+            print(f"  Ошибка при создании превью через OpenCV для {video_path}: {e}")
+    
+    # Пытаемся использовать ffmpeg
+    for seek in ('3', '0'):
+        try:
+            cmd = [
+                'ffmpeg', '-v', 'quiet', '-y',
+                '-ss', seek,
+                '-i', video_path,
+                '-frames:v', '1',
+                '-vf', f'scale={THUMBNAIL_WIDTH}:-2',
+                '-f', 'image2',
+                output_path
+            ]
+            result = subprocess.run(cmd, capture_output=True, timeout=60)
+            if result.returncode == 0 and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                return True
+        except Exception as e:
+            print(f"  Ошибка при создании превью через ffmpeg для {video_path}: {e}")
+            break
+    
+    return False
+
+def get_thumbnail(filename, file_path):
+    """Возвращает (путь к превью, версия), создавая превью при необходимости"""
+    name_hash, version = get_thumbnail_key(filename, file_path)
+    thumb_path = get_thumbnail_cache_path(name_hash, version)
+    
+    if os.path.exists(thumb_path):
+        cache_requests_total.inc('thumbnail', 'hit')
+        return thumb_path, version
+    failure_path = get_thumbnail_failure_path(name_hash, version)
+    if is_recent_thumbnail_failure(failure_path):
+        cache_requests_total.inc('thumbnail', 'failed')
+        return None
+    
+    cache_requests_total.inc('thumbnail', 'miss')
+    with thumbnail_semaphore:
+        # Превью могло быть создано другим потоком, пока мы ждали
+        if os.path.exists(thumb_path):
+            return thumb_path, version
         
-        for keyword in horizontal_keywords:
-            if keyword in filename_lower:
-                print(f"  По ключевым словам определена горизонтальная ориентация")
-                return "horizontal", 1920, 1080, 0
-    except:
-        pass
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        tmp_path = f"{thumb_path}.{threading.get_ident()}.tmp"
+        try:
+            if not extract_thumbnail_frame(file_path, tmp_path):
+                open(failure_path, 'wb').close()
+                # Остается одна отметка на файл: отметки и превью прежних версий удаляются
+                remove_thumbnails(filename, keep=failure_path)
+                return None
+            os.replace(tmp_path, thumb_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
     
-    print(f"  Не удалось определить информацию для видео")
-    return "unknown", 0, 0, 0
+    # Удаляем превью для старых версий этого файла
+    remove_thumbnails(filename, keep=thumb_path)
+    return thumb_path, version
+
+def remove_thumbnails(filename, keep=None):
+    """Удаляет закэшированные превью видео"""
+    name_hash = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:24]
+    folder = os.path.join(THUMBNAIL_FOLDER, name_hash[:2])
+    if not os.path.isdir(folder):
+        return
+    for file in os.listdir(folder):
+        path = os.path.join(folder, file)
+        if file.startswith(name_hash + '-') and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+@app.template_global()
+def thumbnail_url(filename):
+    """URL превью с версией файла, чтобы браузер мог кэшировать его надолго"""
+    file_path = get_video_file_path(filename)
+    if file_path is None:
+        return url_for('serve_thumbnail', filename=filename)
+    try:
+        _, version = get_thumbnail_key(filename, file_path)
+    except OSError:
+        return url_for('serve_thumbnail', filename=filename)
+    return url_for('serve_thumbnail', filename=filename, v=version)
+
+@app.template_filter('duration')
+def format_duration(seconds):
+    """Форматирует длительность в вид м:сс или ч:мм:сс"""
+    if not seconds:
+        return '--:--'
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
 
 def get_videos():
     """Получает видео из базы данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT filename, display_name 
@@ -549,13 +3037,153 @@ def get_videos():
         ORDER BY created_at DESC
     ''')
     videos = cursor.fetchall()
-    conn.close()
     return videos
 
-def get_other_videos(current_filename):
+def get_other_videos(current_filename, limit=None):
     """Получает список видео, исключая текущее"""
-    videos = get_videos()
-    return [v for v in videos if v[0] != current_filename]
+    catalog = get_catalog()
+    if catalog is not None:
+        videos = ((video.filename, video.display_name) for video in catalog.videos)
+    else:
+        videos = get_videos()
+    other_videos = []
+    for video in videos:
+        if video[0] == current_filename:
+            continue
+        other_videos.append(video)
+        if limit is not None and len(other_videos) >= limit:
+            break
+    return other_videos
+
+# Рекомендации "смотрят вместе с этим видео".
+# Новые строки video_history обрабатываются по порядку id (с отметкой
+# recommend_watermark в app_state): каждый просмотр связывается с несколькими
+# предыдущими просмотрами той же сессии. Счетчики пар копятся в video_cowatch,
+# а лучшие соседи пересчитываются только для затронутых видео.
+def count_cowatch_pairs(cursor, rows):
+    """Пары видео, просмотренных в одной сессии друг за другом, для строк (id, сессия, файл, время)"""
+    pairs = {}
+    recent = {}
+    for row_id, session_id, filename, watched_at in rows:
+        previous = recent.get(session_id)
+        if previous is None:
+            # Начало окна берем из уже обработанной истории сессии
+            cursor.execute('''
+                SELECT filename, CAST(strftime('%s', watched_at) AS INTEGER) FROM video_history
+                WHERE session_id = ? AND id < ?
+                ORDER BY watched_at DESC LIMIT ?
+            ''', (session_id, row_id, RECOMMEND_WINDOW))
+            previous = deque(reversed(cursor.fetchall()), maxlen=RECOMMEND_WINDOW)
+            recent[session_id] = previous
+        others = {other for other, other_at in previous if watched_at - other_at <= RECOMMEND_WINDOW_SECONDS}
+        # Возврат к недавно просмотренному видео новых пар не дает
+        if filename not in others:
+            for other in others:
+                pairs[filename, other] = pairs.get((filename, other), 0) + 1
+                pairs[other, filename] = pairs.get((other, filename), 0) + 1
+        previous.append((filename, watched_at))
+    return pairs
+
+def update_video_neighbors(cursor, filenames):
+    """Пересчитывает лучших соседей для перечисленных видео"""
+    for filename in filenames:
+        cursor.execute('DELETE FROM video_neighbors WHERE filename = ?', (filename,))
+        cursor.execute('''
+            INSERT INTO video_neighbors (filename, rank, neighbor, score)
+            SELECT filename, ROW_NUMBER() OVER (ORDER BY count DESC, neighbor), neighbor, count
+            FROM video_cowatch WHERE filename = ?
+            ORDER BY count DESC, neighbor LIMIT ?
+        ''', (filename, RECOMMEND_NEIGHBORS))
+
+def update_recommendations(batch_size=RECOMMEND_BATCH_SIZE):
+    """Учитывает следующую пачку новых просмотров. Возвращает число обработанных строк истории"""
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # Отметка читается и сдвигается в одной транзакции: пачку не обработают дважды
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute("SELECT value FROM app_state WHERE key = 'recommend_watermark'")
+        row = cursor.fetchone()
+        cursor.execute('''
+            SELECT id, session_id, filename, CAST(strftime('%s', watched_at) AS INTEGER) FROM video_history
+            WHERE id > ? ORDER BY id LIMIT ?
+        ''', (int(row[0]) if row else 0, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            conn.rollback()
+            return 0
+        
+        pairs = count_cowatch_pairs(cursor, rows)
+        cursor.executemany('''
+            INSERT INTO video_cowatch (filename, neighbor, count) VALUES (?, ?, ?)
+            ON CONFLICT(filename, neighbor) DO UPDATE SET count = count + excluded.count
+        ''', [(filename, neighbor, count) for (filename, neighbor), count in pairs.items()])
+        update_video_neighbors(cursor, {filename for filename, _ in pairs})
+        cursor.execute('''
+            INSERT INTO app_state (key, value) VALUES ('recommend_watermark', ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (str(rows[-1][0]),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(rows)
+
+@coordinator.leader_task
+def process_recommendations():
+    """Дообрабатывает новые просмотры (ведущий процесс, при каждом продлении аренды)"""
+    update_recommendations()
+
+def rebuild_recommendations(progress=None):
+    """Пересчитывает соседей заново по всей истории просмотров. Возвращает число строк истории"""
+    conn = get_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM video_cowatch')
+        conn.execute('DELETE FROM video_neighbors')
+        conn.execute("DELETE FROM app_state WHERE key = 'recommend_watermark'")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    total = conn.execute('SELECT COUNT(*) FROM video_history').fetchone()[0]
+    done = 0
+    while True:
+        processed = update_recommendations()
+        if not processed:
+            return done
+        done += processed
+        if progress:
+            progress(done, total)
+
+def get_recommendations(filename, limit):
+    """Рекомендации к видео: соседи по совместным просмотрам, затем популярные и новые видео"""
+    conn = get_db()
+    recommendations = conn.execute('''
+        SELECT n.neighbor, v.display_name FROM video_neighbors n
+        JOIN videos v ON v.filename = n.neighbor
+        WHERE n.filename = ? AND v.banned = 0
+        ORDER BY n.rank LIMIT ?
+    ''', (filename, limit)).fetchall()
+    if len(recommendations) >= limit:
+        return recommendations
+    
+    # Видео без истории совместных просмотров: дополняем популярными, затем новыми
+    exclude = {filename}.union(video[0] for video in recommendations)
+    popular = conn.execute('''
+        SELECT p.filename, v.display_name FROM popular_videos p
+        JOIN videos v ON v.filename = p.filename
+        WHERE v.banned = 0
+        ORDER BY p.views DESC, p.filename
+    ''').fetchall()
+    for video in popular + get_other_videos(filename, limit=limit + len(exclude)):
+        if len(recommendations) >= limit:
+            break
+        if video[0] not in exclude:
+            exclude.add(video[0])
+            recommendations.append(tuple(video[:2]))
+    return recommendations
 
 def safe_filename(filename):
     """Создает безопасное имя файла, сохраняя кириллицу и другие символы"""
@@ -590,30 +3218,33 @@ def get_unique_filename(directory, filename):
 
 def is_video_banned(filename):
     """Проверяет, забанено ли видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    catalog = get_catalog()
+    if catalog is not None:
+        return filename in catalog.banned
+    
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT banned FROM videos WHERE filename = ?', (filename,))
     result = cursor.fetchone()
-    conn.close()
     return result and result[0] == 1
 
 def ban_video(filename, reason=""):
     """Блокирует видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('UPDATE videos SET banned = 1 WHERE filename = ?', (filename,))
     cursor.execute('INSERT OR REPLACE INTO banned_videos (filename, reason) VALUES (?, ?)', (filename, reason))
     conn.commit()
-    conn.close()
+    invalidate_catalog()
 
 def unban_video(filename):
     """Разблокирует видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('UPDATE videos SET banned = 0 WHERE filename = ?', (filename,))
     cursor.execute('DELETE FROM banned_videos WHERE filename = ?', (filename,))
     conn.commit()
-    conn.close()
+    invalidate_catalog()
 
 def delete_video(filename):
     """Удаляет видео"""
@@ -622,15 +3253,21 @@ def delete_video(filename):
         file_path = os.path.join(VIDEO_FOLDER, filename)
         if os.path.exists(file_path):
             os.remove(file_path)
+        filename_index.remove(filename)
+        remove_thumbnails(filename)
+        remove_hls_package(filename)
         
         # Удаляем из базы данных
-        conn = sqlite3.connect(DATABASE_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM videos WHERE filename = ?', (filename,))
         cursor.execute('DELETE FROM banned_videos WHERE filename = ?', (filename,))
         cursor.execute('DELETE FROM video_ratings WHERE filename = ?', (filename,))
+        cursor.execute('DELETE FROM video_files WHERE filename = ?', (filename,))
+        cursor.execute('DELETE FROM probe_cache WHERE filename = ?', (filename,))
+        cursor.execute('DELETE FROM optimized_files WHERE filename = ?', (filename,))
         conn.commit()
-        conn.close()
+        invalidate_catalog()
         return True
     except Exception as e:
         print(f"Ошибка при удалении видео: {e}")
@@ -644,6 +3281,9 @@ def rename_video_file(old_filename, new_filename):
         
         if os.path.exists(old_path):
             os.rename(old_path, new_path)
+            filename_index.rename(old_filename, new_filename)
+            remove_thumbnails(old_filename)
+            remove_hls_package(old_filename)
             return True
         return False
     except Exception as e:
@@ -652,7 +3292,9 @@ def rename_video_file(old_filename, new_filename):
 
 def update_video_filename_in_database(old_filename, new_filename):
     """Обновляет имя файла в базе данных"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    # Сначала записываем накопленные просмотры, чтобы они перешли к новому имени
+    view_aggregator.flush()
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -668,77 +3310,131 @@ def update_video_filename_in_database(old_filename, new_filename):
         # Обновляем рейтинги
         cursor.execute('UPDATE video_ratings SET filename = ? WHERE filename = ?', (new_filename, old_filename))
         
+        # Обновляем отпечаток файла, чтобы сканер не анализировал его заново
+        cursor.execute('UPDATE video_files SET filename = ? WHERE filename = ?', (new_filename, old_filename))
+        cursor.execute('UPDATE probe_cache SET filename = ? WHERE filename = ?', (new_filename, old_filename))
+        cursor.execute('UPDATE optimized_files SET filename = ? WHERE filename = ?', (new_filename, old_filename))
+        
+        # Переносим совместные просмотры: если у нового имени уже есть такая пара, счетчики складываются
+        cursor.execute('''
+            INSERT INTO video_cowatch (filename, neighbor, count)
+            SELECT ?, neighbor, count FROM video_cowatch WHERE filename = ? AND neighbor != ?
+            ON CONFLICT(filename, neighbor) DO UPDATE SET count = count + excluded.count
+        ''', (new_filename, old_filename, new_filename))
+        cursor.execute('''
+            INSERT INTO video_cowatch (filename, neighbor, count)
+            SELECT filename, ?, count FROM video_cowatch WHERE neighbor = ? AND filename NOT IN (?, ?)
+            ON CONFLICT(filename, neighbor) DO UPDATE SET count = count + excluded.count
+        ''', (new_filename, old_filename, old_filename, new_filename))
+        cursor.execute('DELETE FROM video_cowatch WHERE ? IN (filename, neighbor)', (old_filename,))
+        
+        # Пересчитываем соседей у всех видео, в списках которых было одно из имен
+        cursor.execute('SELECT DISTINCT filename FROM video_neighbors WHERE neighbor IN (?, ?)',
+                       (old_filename, new_filename))
+        affected = {row[0] for row in cursor.fetchall()} - {old_filename}
+        cursor.execute('DELETE FROM video_neighbors WHERE filename = ?', (old_filename,))
+        update_video_neighbors(cursor, affected | {new_filename})
+        
         conn.commit()
+        invalidate_catalog()
         return True
     except Exception as e:
         print(f"Ошибка при обновлении базы данных: {e}")
         conn.rollback()
         return False
-    finally:
-        conn.close()
 
 def get_video_stats():
-    """Получает статистику по видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    """Получает статистику по видео из агрегатов, которые поддерживают триггеры"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Общее количество видео
-    cursor.execute('SELECT COUNT(*) FROM videos')
-    total_videos = cursor.fetchone()[0]
-    
-    # Забаненные видео
-    cursor.execute('SELECT COUNT(*) FROM videos WHERE banned = 1')
-    banned_videos = cursor.fetchone()[0]
-    
-    # Вертикальные видео
-    cursor.execute('SELECT COUNT(*) FROM videos WHERE orientation = "vertical"')
-    vertical_videos = cursor.fetchone()[0]
-    
-    # Горизонтальные видео
-    cursor.execute('SELECT COUNT(*) FROM videos WHERE orientation = "horizontal"')
-    horizontal_videos = cursor.fetchone()[0]
-    
-    # Неопределенные видео
-    cursor.execute('SELECT COUNT(*) FROM videos WHERE orientation = "unknown"')
-    unknown_videos = cursor.fetchone()[0]
-    
-    # Общее количество просмотров
-    cursor.execute('SELECT SUM(views) FROM videos')
-    total_views = cursor.fetchone()[0] or 0
+    cursor.execute(f"SELECT {', '.join(VIDEO_STATS_COLUMNS)} FROM video_stats_summary WHERE id = 1")
+    row = cursor.fetchone()
+    stats = dict(zip(VIDEO_STATS_COLUMNS, row)) if row else compute_video_stats(cursor)
     
     # Популярные видео
-    cursor.execute('SELECT filename, views FROM videos ORDER BY views DESC LIMIT 5')
+    cursor.execute('SELECT filename, views FROM popular_videos ORDER BY views DESC, filename')
     popular_videos = cursor.fetchall()
     
-    # Общее количество лайков и дизлайков
-    cursor.execute('SELECT SUM(likes), SUM(dislikes) FROM videos')
-    likes_dislikes = cursor.fetchone()
-    total_likes = likes_dislikes[0] or 0
-    total_dislikes = likes_dislikes[1] or 0
-    
-    # Общая длительность всех видео
-    cursor.execute('SELECT SUM(duration) FROM videos')
-    total_duration = cursor.fetchone()[0] or 0
-    total_duration_hours = total_duration / 3600
-    
-    conn.close()
-    
     return {
-        'total_videos': total_videos,
-        'banned_videos': banned_videos,
-        'vertical_videos': vertical_videos,
-        'horizontal_videos': horizontal_videos,
-        'unknown_videos': unknown_videos,
-        'total_views': total_views,
-        'total_likes': total_likes,
-        'total_dislikes': total_dislikes,
-        'total_duration_hours': round(total_duration_hours, 2),
+        'total_videos': stats['total_videos'],
+        'banned_videos': stats['banned_videos'],
+        'vertical_videos': stats['vertical_videos'],
+        'horizontal_videos': stats['horizontal_videos'],
+        'unknown_videos': stats['unknown_videos'],
+        'total_views': stats['total_views'],
+        'total_likes': stats['total_likes'],
+        'total_dislikes': stats['total_dislikes'],
+        'total_duration_hours': round(stats['total_duration'] / 3600, 2),
         'popular_videos': popular_videos
     }
 
+def verify_video_stats(rebuild=False):
+    """Проверяет агрегаты статистики и при rebuild=True пересчитывает их, если есть расхождения"""
+    conn = get_db()
+    cursor = conn.cursor()
+    problems = check_video_stats(cursor, POPULAR_VIDEOS_LIMIT)
+    if problems and rebuild:
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            rebuild_video_stats(cursor, POPULAR_VIDEOS_LIMIT)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return problems
+
+@app.cli.command('check-stats')
+@click.option('--rebuild', is_flag=True, help='Пересчитать агрегаты, если они расходятся с таблицей videos')
+def check_stats_command(rebuild):
+    """Сверяет агрегаты статистики админки с таблицей videos"""
+    init_database()
+    problems = verify_video_stats(rebuild)
+    if not problems:
+        print("Агрегаты статистики совпадают с таблицей videos")
+        return
+    print(f"Найдено расхождений: {len(problems)}")
+    for problem in problems:
+        print(f"  {problem}")
+    if rebuild:
+        print("Агрегаты пересчитаны")
+
+@app.cli.command('cleanup-history')
+def cleanup_history_command():
+    """Сворачивает и удаляет старую историю просмотров, освобождает место в БД"""
+    init_database()
+    result = cleanup_history()
+    print(f"Удалено старых просмотров: {result['expired']}, сверх лимита сессий: {result['trimmed']}, "
+          f"освобождено страниц: {result['freed_pages']}")
+
+@app.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+    """Переводит базу в режим auto_vacuum = INCREMENTAL (полный VACUUM, сервер лучше остановить)"""
+    init_database()
+    conn = get_db()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        size = os.path.getsize(DATABASE_PATH)
+        print(f"Перестройка базы ({size / 1024 ** 2:.0f} МБ), нужно столько же свободного места на диске...")
+        started = time.time()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        print(f"Готово за {time.time() - started:.1f}с")
+    else:
+        print("База уже в режиме auto_vacuum = INCREMENTAL")
+    conn.execute("DELETE FROM app_state WHERE key = 'incremental_vacuum'")
+    conn.commit()
+
+@app.cli.command('rebuild-recommendations')
+def rebuild_recommendations_command():
+    """Пересчитывает рекомендации по всей истории просмотров"""
+    init_database()
+    processed = rebuild_recommendations(lambda done, total: print(f"  Обработано {done} из {total}"))
+    count = get_db().execute('SELECT COUNT(DISTINCT filename) FROM video_neighbors').fetchone()[0]
+    print(f"Рекомендации пересчитаны: просмотров {processed}, видео с соседями {count}")
+
 def get_all_videos_with_info():
     """Получает все видео с дополнительной информацией"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT filename, orientation, banned, views, likes, dislikes, created_at, duration, width, height 
@@ -746,12 +3442,11 @@ def get_all_videos_with_info():
         ORDER BY created_at DESC
     ''')
     videos = cursor.fetchall()
-    conn.close()
     return videos
 
 def get_banned_videos():
     """Получает список забаненных видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT v.filename, v.orientation, v.views, b.reason, b.banned_at 
@@ -760,141 +3455,230 @@ def get_banned_videos():
         ORDER BY b.banned_at DESC
     ''')
     videos = cursor.fetchall()
-    conn.close()
     return videos
 
 def log_admin_action(action, details):
     """Логирует действия администратора"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('INSERT INTO admin_logs (action, details) VALUES (?, ?)', (action, details))
     conn.commit()
-    conn.close()
 
 def get_admin_logs(limit=50):
     """Получает логи администратора"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM admin_logs ORDER BY performed_at DESC LIMIT ?', (limit,))
     logs = cursor.fetchall()
-    conn.close()
     return logs
 
 def force_reorientation(filename, orientation):
     """Принудительно устанавливает ориентацию видео"""
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('UPDATE videos SET orientation = ? WHERE filename = ?', (orientation, filename))
     conn.commit()
-    conn.close()
+    invalidate_catalog()
 
-def get_system_info():
-    """Получает информацию о системе"""
+def get_disk_usage(path):
+    """Место на диске с папкой: (всего, занято, свободно, процент занятого), в байтах"""
     try:
-        # Информация о диске
-        # Замените эту строку:
-        # disk_usage = psutil.disk_usage(VIDEO_FOLDER)
-        # На этот блок:
-        try:
-            # Пытаемся использовать стандартный метод
-            disk_usage = psutil.disk_usage(VIDEO_FOLDER)
-        except SystemError:
-            # Если возникает ошибка Python 3.12+, используем обходной путь
-            import ctypes
-            import os
-            import sys
-
+        # Пытаемся использовать стандартный метод
+        usage = psutil.disk_usage(path)
+        return usage.total, usage.used, usage.free, usage.percent
+    except SystemError:
+        # Если возникает ошибка Python 3.12+, используем обходной путь
+        import sys
+        
+        if sys.platform == 'win32':
             # Получаем диск из пути к папке с видео (например, 'E:\\')
-            drive = os.path.splitdrive(VIDEO_FOLDER)[0]
-
-            if sys.platform == 'win32':
-                # Используем WinAPI GetDiskFreeSpaceEx для Windows
-                free_bytes = ctypes.c_ulonglong()
-                total_bytes = ctypes.c_ulonglong()
-                ctypes.windll.kernel32.GetDiskFreeSpaceExW(
-                    ctypes.c_wchar_p(drive),
-                    None,
-                    ctypes.pointer(total_bytes),
-                    ctypes.pointer(free_bytes)
-                )
-
-                disk_total_gb = total_bytes.value / (1024**3)
-                disk_free_gb = free_bytes.value / (1024**3)
-                disk_used_gb = disk_total_gb - disk_free_gb
-                disk_percent = (disk_used_gb / disk_total_gb * 100) if disk_total_gb > 0 else 0
-
-                # Создаем объект, похожий на namedtuple от psutil
-                class SimpleDiskUsage:
-                    def __init__(self, total, used, free, percent):
-                        self.total = total
-                        self.used = used
-                        self.free = free
-                        self.percent = percent
-
-                disk_usage = SimpleDiskUsage(
-                    total=disk_total_gb * (1024**3),  # Возвращаем в байтах для совместимости
-                    used=disk_used_gb * (1024**3),
-                    free=disk_free_gb * (1024**3),
-                    percent=disk_percent
-                )
-            else:
-                # Для Linux/Mac используем команду df
-                import subprocess
-                result = subprocess.run(['df', '-k', VIDEO_FOLDER], 
-                                      capture_output=True, text=True)
-                lines = result.stdout.strip().split('\n')
-                if len(lines) > 1:
-                    parts = lines[1].split()
-                    if len(parts) >= 5:
-                        total_kb = int(parts[1])
-                        used_kb = int(parts[2])
-                        free_kb = int(parts[3])
-                        percent = int(parts[4].replace('%', ''))
-
-                        class SimpleDiskUsage:
-                            def __init__(self, total, used, free, percent):
-                                self.total = total * 1024  # Конвертируем в байты
-                                self.used = used * 1024
-                                self.free = free * 1024
-                                self.percent = percent
-
-                        disk_usage = SimpleDiskUsage(total_kb, used_kb, free_kb, percent)
-                    else:
-                        raise Exception("Не удалось получить информацию о диске")
-                else:
-                    raise Exception("Не удалось получить информацию о диске")
-        disk_total_gb = disk_usage.total / (1024**3)
-        disk_used_gb = disk_usage.used / (1024**3)
-        disk_free_gb = disk_usage.free / (1024**3)
-        disk_percent = disk_usage.percent
+            drive = os.path.splitdrive(path)[0]
+            # Используем WinAPI GetDiskFreeSpaceEx для Windows
+            free_bytes = ctypes.c_ulonglong()
+            total_bytes = ctypes.c_ulonglong()
+            ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+                ctypes.c_wchar_p(drive),
+                None,
+                ctypes.pointer(total_bytes),
+                ctypes.pointer(free_bytes)
+            )
+            total, free = total_bytes.value, free_bytes.value
+            percent = ((total - free) / total * 100) if total > 0 else 0
+            return total, total - free, free, round(percent, 1)
         
-        # Информация о памяти
+        # Для Linux/Mac используем команду df
+        result = subprocess.run(['df', '-k', path], capture_output=True, text=True)
+        lines = result.stdout.strip().split('\n')
+        if len(lines) > 1:
+            parts = lines[1].split()
+            if len(parts) >= 5:
+                total_kb, used_kb, free_kb = int(parts[1]), int(parts[2]), int(parts[3])
+                return total_kb * 1024, used_kb * 1024, free_kb * 1024, int(parts[4].replace('%', ''))
+        raise Exception("Не удалось получить информацию о диске")
+
+class SystemSampler:
+    """Фоновый сбор показателей системы в кольцевой буфер.
+    
+    Страницы администратора читают готовые значения из буфера и не ждут
+    замера загрузки процессора и ответа df.
+    """
+    
+    def __init__(self, interval, history):
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.info = None
+        # Процесс определяется в start(): после fork у рабочего процесса свой pid
+        self.pid = None
+        self.process = None
+        self.last_counters = None
+        self.last_disk = None
+        self.last_disk_time = 0.0
+    
+    def get_info(self):
+        """Неизменные сведения о сервере определяются один раз"""
+        self.start()
+        if self.info is None:
+            from importlib import metadata
+            hostname = socket.gethostname()
+            try:
+                local_ip = socket.gethostbyname(hostname)
+            except OSError:
+                local_ip = "Не удалось определить"
+            self.info = {
+                'hostname': hostname,
+                'local_ip': local_ip,
+                'platform': platform.platform(),
+                'python_version': platform.python_version(),
+                'flask_version': metadata.version('flask'),
+                'cpu_count': psutil.cpu_count(),
+                'boot_time': psutil.boot_time(),
+                'started_at': self.process.create_time(),
+                'pid': self.process.pid,
+            }
+        return self.info
+    
+    def sample(self):
+        """Снимает один замер и добавляет его в буфер"""
+        now = time.time()
+        # cpu_percent(None) считает загрузку с прошлого вызова и не блокирует
+        cpu_percent = psutil.cpu_percent(interval=None)
         memory = psutil.virtual_memory()
-        memory_total_gb = memory.total / (1024**3)
-        memory_used_gb = memory.used / (1024**3)
-        memory_percent = memory.percent
+        net = psutil.net_io_counters()
+        try:
+            disk_io = psutil.disk_io_counters()
+        except Exception:
+            disk_io = None
         
-        # Информация о CPU
-        cpu_percent = psutil.cpu_percent(interval=1)
+        # Место на диске меняется медленно, а запасной путь запускает df: проверяем раз в минуту
+        if self.last_disk is None or now - self.last_disk_time >= 60:
+            try:
+                self.last_disk = get_disk_usage(VIDEO_FOLDER)
+            except Exception as e:
+                print(f"Ошибка при получении информации о диске: {e}")
+                self.last_disk = (0, 0, 0, 0)
+            self.last_disk_time = now
+        disk_total, disk_used, disk_free, disk_percent = self.last_disk
         
-        # IP адрес
-        hostname = socket.gethostname()
-        try:
-            local_ip = socket.gethostbyname(hostname)
-        except:
-            local_ip = "Не удалось определить"
+        counters = (now, net.bytes_recv if net else 0, net.bytes_sent if net else 0,
+                    disk_io.read_bytes if disk_io else 0, disk_io.write_bytes if disk_io else 0)
+        rates = [0.0, 0.0, 0.0, 0.0]
+        if self.last_counters is not None:
+            elapsed = counters[0] - self.last_counters[0]
+            if elapsed > 0:
+                rates = [max(0, current - previous) / elapsed
+                         for current, previous in zip(counters[1:], self.last_counters[1:])]
+        self.last_counters = counters
         
-        return {
-            'disk_total': round(disk_total_gb, 2),
-            'disk_used': round(disk_used_gb, 2),
-            'disk_free': round(disk_free_gb, 2),
-            'disk_percent': disk_percent,
-            'memory_total': round(memory_total_gb, 2),
-            'memory_used': round(memory_used_gb, 2),
-            'memory_percent': memory_percent,
+        with self.process.oneshot():
+            process = {
+                'process_cpu_percent': self.process.cpu_percent(interval=None),
+                'process_memory': self.process.memory_info().rss,
+                'process_threads': self.process.num_threads(),
+                'process_fds': self.process.num_fds() if hasattr(self.process, 'num_fds') else 0,
+            }
+        
+        entry = {
+            'time': now,
             'cpu_percent': cpu_percent,
-            'hostname': hostname,
-            'local_ip': local_ip,
+            'memory_total': memory.total,
+            'memory_used': memory.used,
+            'memory_percent': memory.percent,
+            'disk_total': disk_total,
+            'disk_used': disk_used,
+            'disk_free': disk_free,
+            'disk_percent': disk_percent,
+            'net_recv_rate': rates[0],
+            'net_sent_rate': rates[1],
+            'disk_read_rate': rates[2],
+            'disk_write_rate': rates[3],
+            **process,
+        }
+        with self.lock:
+            self.samples.append(entry)
+        return entry
+    
+    def run(self):
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Ошибка при сборе показателей системы: {e}")
+            time.sleep(self.interval)
+    
+    def start(self):
+        """Поток запускается при первом обращении (и заново в процессе, созданном через fork)"""
+        with self.lock:
+            if self.pid == os.getpid() and self.thread is not None:
+                return
+            if self.pid != os.getpid():
+                # Поток и замеры главного процесса после fork не переходят
+                self.pid = os.getpid()
+                self.process = psutil.Process()
+                self.info = None
+                self.samples.clear()
+                self.last_counters = None
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+    
+    def latest(self):
+        """Последний замер. До первого замера фонового потока снимает его сразу"""
+        self.start()
+        with self.lock:
+            if self.samples:
+                return self.samples[-1]
+        return self.sample()
+    
+    def series(self, seconds=None):
+        """Замеры за последние seconds секунд в виде столбцов для графиков"""
+        self.start()
+        with self.lock:
+            samples = list(self.samples)
+        if seconds:
+            since = time.time() - seconds
+            samples = [sample for sample in samples if sample['time'] >= since]
+        keys = samples[0].keys() if samples else ()
+        return {key: [sample[key] for sample in samples] for key in keys}
+
+system_sampler = SystemSampler(SYSTEM_SAMPLE_INTERVAL, SYSTEM_SAMPLE_HISTORY)
+
+def get_system_info():
+    """Получает информацию о системе из последнего замера"""
+    try:
+        sample = system_sampler.latest()
+        info = system_sampler.get_info()
+        return {
+            'disk_total': round(sample['disk_total'] / (1024**3), 2),
+            'disk_used': round(sample['disk_used'] / (1024**3), 2),
+            'disk_free': round(sample['disk_free'] / (1024**3), 2),
+            'disk_percent': sample['disk_percent'],
+            'memory_total': round(sample['memory_total'] / (1024**3), 2),
+            'memory_used': round(sample['memory_used'] / (1024**3), 2),
+            'memory_percent': sample['memory_percent'],
+            'cpu_percent': sample['cpu_percent'],
+            'hostname': info['hostname'],
+            'local_ip': info['local_ip'],
             'video_folder': VIDEO_FOLDER
         }
     except Exception as e:
@@ -915,55 +3699,795 @@ def get_system_info():
             'video_folder': VIDEO_FOLDER
         }
 
+@app.before_request
+def start_request_metrics():
+    """Засекает время запроса и обнуляет счетчики запросов к БД"""
+    request_metrics.started = time.perf_counter()
+    request_metrics.db_queries = 0
+    request_metrics.db_seconds = 0.0
+
 @app.before_request
 def before_request():
     """Инициализация сессии перед каждым запросом"""
     if 'session_id' not in session:
         session['session_id'] = os.urandom(16).hex()
 
+@app.after_request
+def record_request_metrics(response):
+    """Записывает время запроса, число запросов к БД и объем отданного видео"""
+    started = getattr(request_metrics, 'started', None)
+    if started is None:
+        return response
+    request_metrics.started = None
+    endpoint = request.endpoint or 'unmatched'
+    http_request_seconds.observe(time.perf_counter() - started, endpoint)
+    http_requests_total.inc(endpoint, request.method, str(response.status_code))
+    http_request_db_queries.observe(request_metrics.db_queries, endpoint)
+    http_request_db_seconds.observe(request_metrics.db_seconds, endpoint)
+    # Тело видео отдается уже после выхода из обработчика, поэтому считаем по Content-Length
+    if endpoint == 'serve_video' and request.method == 'GET' and response.content_length:
+        video_bytes_served.inc(amount=response.content_length)
+    return response
+
 @app.route('/')
 def index():
     search_term = request.args.get('search', '').strip()
+    sort_by = request.args.get('sort', 'created_at')
+    sort_order = request.args.get('order', 'desc')
+    if sort_by not in SORT_COLUMNS:
+        sort_by = 'created_at'
+    if sort_order not in ('asc', 'desc'):
+        sort_order = 'desc'
     
     if search_term:
-        videos = search_videos_with_orientation(search_term)
+        videos, search_cursor = search_videos(search_term)
+        return render_template('index.html', 
+                             videos=videos, 
+                             search_cursor=search_cursor,
+                             search_term=search_term)
+    
+    # Первый блок: 12 горизонтальных (4 строки) и 6 вертикальных видео,
+    # остальные блоки страница подгружает через /api/videos при прокрутке
+    horizontal_videos, horizontal_cursor = get_videos_page(
+        limit=12, orientation='horizontal', sort_by=sort_by, sort_order=sort_order)
+    vertical_videos, vertical_cursor = get_videos_page(
+        limit=6, orientation='vertical', sort_by=sort_by, sort_order=sort_order)
+    
+    return render_template('index.html', 
+                         videos=horizontal_videos + vertical_videos, 
+                         horizontal_videos=horizontal_videos,
+                         vertical_videos=vertical_videos,
+                         horizontal_cursor=horizontal_cursor,
+                         vertical_cursor=vertical_cursor,
+                         sort_by=sort_by,
+                         sort_order=sort_order,
+                         search_term=search_term)
+
+@app.route('/api/videos')
+def api_videos():
+    """API для постраничного получения списка видео"""
+    cursor = request.args.get('cursor') or None
+    search_term = request.args.get('q', '').strip()
+    orientation = request.args.get('orientation') or None
+    sort_by = request.args.get('sort', 'created_at')
+    sort_order = request.args.get('order', 'desc')
+    
+    try:
+        limit = int(request.args.get('limit', PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    
+    if orientation not in (None, 'vertical', 'horizontal'):
+        return jsonify({'error': 'Invalid orientation'}), 400
+    if sort_by not in SORT_COLUMNS:
+        return jsonify({'error': 'Invalid sort'}), 400
+    if sort_order not in ('asc', 'desc'):
+        return jsonify({'error': 'Invalid order'}), 400
+    
+    try:
+        if search_term:
+            videos, next_cursor = search_videos(search_term, cursor, limit, orientation)
+        else:
+            videos, next_cursor = get_videos_page(cursor, limit, orientation, sort_by, sort_order)
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'videos': [video_to_json(video) for video in videos],
+        'next_cursor': next_cursor
+    })
+
+def video_to_json(video):
+    """Представление строки (filename, display_name, orientation, duration) для API"""
+    filename, display_name, orientation, duration = video[:4]
+    if orientation == 'vertical':
+        watch_url = url_for('vertical_video', filename=filename)
+    else:
+        watch_url = url_for('watch_video', filename=filename)
+    return {
+        'filename': filename,
+        'display_name': display_name or filename,
+        'orientation': orientation,
+        'duration': duration or 0,
+        'duration_text': format_duration(duration),
+        'watch_url': watch_url,
+        'thumbnail_url': thumbnail_url(filename)
+    }
+#def index():
+#    search_term = request.args.get('search', '').strip()
+#    
+#    if search_term:
+#        videos = search_videos_with_orientation(search_term)
+#        return render_template('index.html', 
+#                             videos=videos, 
+#                             search_term=search_term,
+#                             show_separately=False)
+#    else:
+#        # Без поиска разделяем видео
+#        videos = get_videos_with_orientation()
+#        
+#        # Разделяем на горизонтальные и вертикальные
+#        horizontal_videos = []
+#        vertical_videos = []
+#        
+#        for video in videos:
+#            filename, display_name, orientation = video
+#            if orientation == 'vertical':
+#                vertical_videos.append(video)
+#            else:
+#                horizontal_videos.append(video)
+#        
+#        return render_template('index.html', 
+#                             horizontal_videos=horizontal_videos,
+#                             vertical_videos=vertical_videos,
+#                             search_term=search_term,
+#                             show_separately=True)
+
+# Подготовка адаптивных потоков (HLS).
+# Видео высокого разрешения перекодируются в фоне в несколько качеств,
+# плеер сам выбирает подходящее по скорости сети. Пока HLS-версии нет,
+# видео отдается напрямую через serve_video.
+
+def get_hls_key(filename, stat):
+    """Имя папки HLS-версии: хэш имени файла и версия по размеру и дате изменения"""
+    name_hash = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+    version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode('utf-8')).hexdigest()[:8]
+    return f"{name_hash}-{version}"
+
+def get_hls_plan(width, height, codec):
+    """Список качеств для видео: (имя, меньшая сторона кадра, битрейт видео, битрейт звука)"""
+    short_side = min(width, height)
+    plan = [rendition for rendition in HLS_RENDITIONS if rendition[1] < short_side]
+    # Исходное качество: H.264 копируем без перекодирования (битрейт None),
+    # остальные кодеки перекодируем с постоянным качеством (битрейт 0)
+    plan.append(('source', short_side, None if codec in ('h264', 'avc1') else 0, 160_000))
+    return plan
+
+def build_hls_command(file_path, output_dir, short_side, video_bitrate, audio_bitrate):
+    """Команда ffmpeg для одного качества"""
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-i', file_path, '-map', '0:v:0', '-map', '0:a:0?']
+    if video_bitrate is None:
+        cmd += ['-c:v', 'copy']
+    else:
+        # Меньшая сторона кадра приводится к short_side независимо от ориентации
+        scale = (f"scale='if(gte(iw,ih),-2,{short_side})':'if(gte(iw,ih),{short_side},-2)'")
+        cmd += ['-vf', scale, '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+                '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})']
+        if video_bitrate:
+            cmd += ['-b:v', str(video_bitrate), '-maxrate', str(int(video_bitrate * 1.1)),
+                    '-bufsize', str(video_bitrate * 2)]
+        else:
+            cmd += ['-crf', '20']
+    cmd += ['-c:a', 'aac', '-b:a', str(audio_bitrate), '-ac', '2',
+            '-f', 'hls', '-hls_time', str(HLS_SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(output_dir, 'seg_%05d.ts'),
+            os.path.join(output_dir, 'index.m3u8')]
+    return cmd
+
+def measure_hls_bandwidth(output_dir):
+    """Пиковый битрейт качества по размерам сегментов (для BANDWIDTH в плейлисте)"""
+    peak = 0
+    segment_duration = None
+    with open(os.path.join(output_dir, 'index.m3u8'), encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                segment_duration = float(line[8:].split(',', 1)[0] or 0)
+            elif line and not line.startswith('#') and segment_duration:
+                size = os.path.getsize(os.path.join(output_dir, line))
+                peak = max(peak, int(size * 8 / segment_duration))
+                segment_duration = None
+    return peak
+
+def get_folder_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+def remove_hls_package(filename):
+    """Удаляет HLS-версию видео с диска и из базы"""
+    conn = get_db()
+    row = conn.execute('SELECT key FROM hls_packages WHERE filename = ?', (filename,)).fetchone()
+    if row is None:
+        return
+    if row[0]:
+        shutil.rmtree(os.path.join(HLS_FOLDER, row[0]), ignore_errors=True)
+    conn.execute('DELETE FROM hls_packages WHERE filename = ?', (filename,))
+    conn.commit()
+
+def enforce_hls_budget(keep=None):
+    """Удаляет давно не открывавшиеся HLS-версии, пока они не уместятся в HLS_DISK_BUDGET"""
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT filename, key, bytes FROM hls_packages
+        WHERE status = 'ready'
+        ORDER BY last_access DESC
+    ''').fetchall()
+    total = 0
+    for filename, key, size in rows:
+        total += size or 0
+        if total > HLS_DISK_BUDGET and filename != keep:
+            print(f"HLS: освобождаем место, удаляем {filename}")
+            shutil.rmtree(os.path.join(HLS_FOLDER, key), ignore_errors=True)
+            conn.execute('DELETE FROM hls_packages WHERE filename = ?', (filename,))
+            total -= size or 0
+    conn.commit()
+
+def package_video(filename):
+    """Готовит HLS-версию видео: несколько качеств в отдельных папках"""
+    conn = get_db()
+    file_path = get_video_file_path(filename)
+    video = conn.execute('SELECT width, height FROM videos WHERE filename = ?', (filename,)).fetchone()
+    if file_path is None or not os.path.isfile(file_path) or video is None:
+        remove_hls_package(filename)
+        return
+    
+    stat = os.stat(file_path)
+    key = get_hls_key(filename, stat)
+    width, height = video
+    codec = conn.execute('SELECT codec FROM probe_cache WHERE filename = ?', (filename,)).fetchone()
+    plan = get_hls_plan(width or 0, height or 0, codec[0] if codec else None)
+    previous = conn.execute('SELECT key FROM hls_packages WHERE filename = ?', (filename,)).fetchone()
+    conn.execute("UPDATE hls_packages SET status = 'processing' WHERE filename = ?", (filename,))
+    conn.commit()
+    
+    print(f"HLS: подготовка {filename} ({', '.join(name for name, *_ in plan)})")
+    started = time.time()
+    work_dir = os.path.join(HLS_FOLDER, f".{key}.tmp")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        renditions = []
+        for name, short_side, video_bitrate, audio_bitrate in plan:
+            output_dir = os.path.join(work_dir, name)
+            os.makedirs(output_dir)
+            subprocess.run(build_hls_command(file_path, output_dir, short_side, video_bitrate, audio_bitrate),
+                           capture_output=True, check=True, timeout=HLS_TRANSCODE_TIMEOUT)
+            # Размер кадра в плейлисте: меньшая сторона равна short_side
+            scale = short_side / min(width, height)
+            renditions.append({
+                'name': name,
+                'width': int(width * scale) // 2 * 2,
+                'height': int(height * scale) // 2 * 2,
+                'bandwidth': measure_hls_bandwidth(output_dir),
+            })
+        final_dir = os.path.join(HLS_FOLDER, key)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(work_dir, final_dir)
+    except Exception as e:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        error = e.stderr.decode('utf-8', 'ignore')[-500:] if isinstance(e, subprocess.CalledProcessError) else str(e)
+        print(f"HLS: ошибка при подготовке {filename}: {error}")
+        conn.execute('''
+            UPDATE hls_packages SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE filename = ?
+        ''', (error, filename))
+        conn.commit()
+        return
+    
+    if previous and previous[0] and previous[0] != key:
+        shutil.rmtree(os.path.join(HLS_FOLDER, previous[0]), ignore_errors=True)
+    size = get_folder_size(final_dir)
+    conn.execute('''
+        INSERT OR REPLACE INTO hls_packages
+        (filename, key, source_size, source_mtime_ns, status, renditions, bytes, error, finished_at, last_access)
+        VALUES (?, ?, ?, ?, 'ready', ?, ?, NULL, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ''', (filename, key, stat.st_size, stat.st_mtime_ns, json.dumps(renditions), size))
+    conn.commit()
+    print(f"HLS: {filename} готово за {time.time() - started:.0f}с, {size / 1024 / 1024:.1f} МБ")
+    enforce_hls_budget(keep=filename)
+
+class BackgroundQueue:
+    """Очередь обработки видео в фоновых потоках. Видео, уже стоящее в очереди, повторно не добавляется"""
+    
+    def __init__(self, name, handler, workers=1):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+    
+    def submit(self, filename):
+        with self.lock:
+            if filename in self.pending:
+                return False
+            self.pending.add(filename)
+            # Потоки запускаются при первой задаче
+            if not self.threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self.run, daemon=True)
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(filename)
+        return True
+    
+    def run(self):
+        while True:
+            filename = self.queue.get()
+            try:
+                self.handler(filename)
+            except Exception as e:
+                print(f"{self.name}: ошибка обработки {filename}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(filename)
+                release_db()
+
+class HlsPackager(BackgroundQueue):
+    """Очередь подготовки HLS-версий"""
+    
+    def __init__(self, workers):
+        super().__init__('HLS', package_video, workers)
+    
+    def enqueue(self, filename, stat):
+        """Ставит видео в очередь. Возвращает False, если оно уже там"""
+        if filename in self.pending:
+            return False
+        conn = get_db()
+        dead_owner, params = coordinator.dead_owner_clause('hls_packages.owner')
+        # Видео, которое уже готовит живой процесс (этот или другой), повторно не ставим
+        cursor = conn.execute(f'''
+            INSERT INTO hls_packages (filename, source_size, source_mtime_ns, status, owner)
+            VALUES (?, ?, ?, 'queued', ?)
+            ON CONFLICT(filename) DO UPDATE SET status = 'queued', source_size = excluded.source_size,
+                source_mtime_ns = excluded.source_mtime_ns, owner = excluded.owner
+            WHERE hls_packages.status NOT IN ('queued', 'processing') OR {dead_owner}
+        ''', (filename, stat.st_size, stat.st_mtime_ns, coordinator.token, *params))
+        conn.commit()
+        if cursor.rowcount == 0:
+            return False
+        return self.submit(filename)
+    
+    def resume(self):
+        """Забирает себе видео, подготовка которых прервалась остановкой процесса-владельца"""
+        conn = get_db()
+        dead_owner, params = coordinator.dead_owner_clause()
+        conn.execute(f"UPDATE hls_packages SET owner = ? WHERE status IN ('queued', 'processing') AND {dead_owner}",
+                     (coordinator.token, *params))
+        conn.commit()
+        rows = conn.execute("SELECT filename FROM hls_packages WHERE status IN ('queued', 'processing') AND owner = ?",
+                            (coordinator.token,)).fetchall()
+        for (filename,) in rows:
+            self.submit(filename)
+
+hls_packager = HlsPackager(HLS_WORKERS)
+coordinator.leader_task(hls_packager.resume)
+
+def is_hls_available():
+    """HLS готовится только при наличии ffmpeg"""
+    return HLS_ENABLED and shutil.which('ffmpeg') is not None
+
+def get_hls_url(filename, file_path):
+    """URL адаптивного потока, если он готов. Иначе ставит подходящее видео в очередь и возвращает None"""
+    if not HLS_ENABLED:
+        return None
+    conn = get_db()
+    row = conn.execute('''
+        SELECT status, source_size, source_mtime_ns FROM hls_packages WHERE filename = ?
+    ''', (filename,)).fetchone()
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    up_to_date = row is not None and (row[1], row[2]) == (stat.st_size, stat.st_mtime_ns)
+    if up_to_date and row[0] == 'ready':
+        return url_for('serve_hls_master', filename=filename)
+    
+    # Новое видео или файл изменился: готовим (заново), если разрешение достаточно высокое
+    if not up_to_date and is_hls_available():
+        size = get_video_dimensions(filename)
+        if size and min(size) >= HLS_MIN_SOURCE_HEIGHT:
+            hls_packager.enqueue(filename, stat)
+    return None
+
+def get_video_dimensions(filename):
+    """Размеры кадра (ширина, высота) незабаненного видео или None"""
+    catalog = get_catalog()
+    if catalog is not None:
+        video = catalog.by_filename.get(filename)
+        return (video.width or 0, video.height or 0) if video else None
+    
+    row = get_db().execute('SELECT width, height FROM videos WHERE filename = ? AND banned = 0',
+                           (filename,)).fetchone()
+    return (row[0] or 0, row[1] or 0) if row else None
+
+@app.template_global()
+def hls_js_url():
+    """URL hls.js, если он положен в static (нужен браузерам без встроенной поддержки HLS)"""
+    if os.path.exists(os.path.join(app.static_folder, 'hls.min.js')):
+        return url_for('static', filename='hls.min.js')
+    return None
+
+@app.route('/hls/master/<path:filename>')
+def serve_hls_master(filename):
+    """Общий плейлист HLS со всеми качествами видео"""
+    if is_video_banned(filename):
+        return jsonify({'error': 'Video is banned'}), 403
+    
+    conn = get_db()
+    row = conn.execute('''
+        SELECT key, renditions FROM hls_packages WHERE filename = ? AND status = 'ready'
+    ''', (filename,)).fetchone()
+    if row is None:
+        return jsonify({'error': 'HLS not available'}), 404
+    key, renditions = row
+    
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in json.loads(renditions):
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']},"
+                     f"RESOLUTION={rendition['width']}x{rendition['height']}")
+        lines.append(url_for('serve_hls_file', key=key, rendition=rendition['name'], name='index.m3u8'))
+    
+    # Время последнего открытия нужно для вытеснения старых версий
+    conn.execute('UPDATE hls_packages SET last_access = CURRENT_TIMESTAMP WHERE filename = ?', (filename,))
+    conn.commit()
+    
+    response = Response('\n'.join(lines) + '\n', mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/hls/<key>/<rendition>/<name>')
+def serve_hls_file(key, rendition, name):
+    """Плейлист качества и сегменты HLS"""
+    if not re.fullmatch(r'\w+', rendition):
+        return jsonify({'error': 'Not found'}), 404
+    conn = get_db()
+    row = conn.execute("SELECT filename FROM hls_packages WHERE key = ? AND status = 'ready'", (key,)).fetchone()
+    if row is None or is_video_banned(row[0]):
+        return jsonify({'error': 'Not found'}), 404
+    
+    mimetype = 'application/vnd.apple.mpegurl' if name.endswith('.m3u8') else 'video/mp2t'
+    response = send_from_directory(os.path.abspath(os.path.join(HLS_FOLDER, key, rendition)), name,
+                                   mimetype=mimetype)
+    # Папка HLS-версии содержит версию исходного файла, поэтому ее можно кэшировать надолго
+    response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}, immutable'
+    return response
+
+@app.route('/admin/hls/package', methods=['POST'])
+def admin_hls_package():
+    """Поставить в очередь подготовку HLS для одного или всех подходящих видео"""
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    if not is_hls_available():
+        return jsonify({'error': 'ffmpeg не найден'}), 400
+    
+    filename = request.values.get('filename')
+    catalog = get_catalog()
+    if filename:
+        candidates = [filename]
+    elif catalog is not None:
+        candidates = [video.filename for video in catalog.videos
+                      if min(video.width or 0, video.height or 0) >= HLS_MIN_SOURCE_HEIGHT]
     else:
-        videos = get_videos_with_orientation()
+        candidates = [row[0] for row in get_db().execute('''
+            SELECT filename FROM videos
+            WHERE banned = 0 AND MIN(COALESCE(width, 0), COALESCE(height, 0)) >= ?
+        ''', (HLS_MIN_SOURCE_HEIGHT,))]
+    
+    queued = 0
+    for candidate in candidates:
+        file_path = get_video_file_path(candidate)
+        if file_path and os.path.isfile(file_path) and hls_packager.enqueue(candidate, os.stat(file_path)):
+            queued += 1
+    
+    log_admin_action("Подготовка HLS", f"В очереди: {queued} видео")
+    return jsonify({'success': True, 'queued': queued})
+
+@app.route('/admin/hls/status')
+def admin_hls_status():
+    """Состояние HLS-версий: количество по статусам и занятое место"""
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    conn = get_db()
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM hls_packages GROUP BY status').fetchall())
+    used = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM hls_packages WHERE status = 'ready'").fetchone()[0]
+    return jsonify({
+        'available': is_hls_available(),
+        'statuses': counts,
+        'bytes': used,
+        'budget': HLS_DISK_BUDGET,
+        'queue': hls_packager.queue.qsize(),
+    })
+
+# Перенос moov в начало файла (fast start).
+# Если индекс MP4/MOV (атом moov) записан в конце файла, браузер должен сначала
+# дочитать хвост файла и только потом начать показ. Такие файлы перепаковываются
+# без перекодирования (ffmpeg -c copy -movflags +faststart) и подменяются на месте.
+
+def has_trailing_moov(path):
+    """Проверяет по атомам верхнего уровня, что moov записан после mdat"""
+    seen_mdat = False
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            atom_size, atom_type = struct.unpack('>I4s', f.read(8))
+            header_size = 8
+            if atom_size == 1:
+                # 64-битный размер атома (файл может оборваться посреди заголовка)
+                if offset + 16 > file_size:
+                    return False
+                atom_size = struct.unpack('>Q', f.read(8))[0]
+                header_size = 16
+            elif atom_size == 0:
+                # Атом до конца файла
+                atom_size = file_size - offset
+            if atom_size < header_size:
+                return False
+            if atom_type == b'moov':
+                return seen_mdat
+            if atom_type == b'mdat':
+                seen_mdat = True
+            offset += atom_size
+    return False
+
+def record_faststart_result(filename, status, stat, original_size=None, error=None):
+    conn = get_db()
+    conn.execute('''
+        INSERT OR REPLACE INTO optimized_files (filename, status, original_size, size, mtime_ns, error, checked_at)
+        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (filename, status, original_size or stat.st_size, stat.st_size, stat.st_mtime_ns, error))
+    conn.commit()
+
+def optimize_video_file(filename):
+    """Перепаковывает файл с moov в конце так, чтобы он начинал играть сразу"""
+    file_path = get_video_file_path(filename)
+    if file_path is None or not os.path.isfile(file_path):
+        return
+    stat = os.stat(file_path)
+    conn = get_db()
+    row = conn.execute('SELECT size, mtime_ns FROM optimized_files WHERE filename = ?', (filename,)).fetchone()
+    if row is not None and tuple(row) == (stat.st_size, stat.st_mtime_ns):
+        # Эта версия файла уже проверена
+        return
+    
+    if not has_trailing_moov(file_path):
+        record_faststart_result(filename, 'skipped', stat)
+        return
+    
+    print(f"Fast start: перепаковка {filename}")
+    started = time.time()
+    directory, name = os.path.split(file_path)
+    # Временный файл скрыт от сканера (начинается с точки)
+    temp_path = os.path.join(directory, f".faststart-{name}")
+    output_format = 'mov' if name.lower().endswith('.mov') else 'mp4'
+    cmd = ['ffmpeg', '-y', '-v', 'error', '-i', file_path, '-map', '0', '-dn', '-c', 'copy',
+           '-movflags', '+faststart', '-f', output_format, temp_path]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=FASTSTART_TIMEOUT)
+        if has_trailing_moov(temp_path):
+            raise RuntimeError('moov остался в конце файла')
+        
+        # Подменяем файл под блокировкой сканера, чтобы он не принял его за новую версию
+        with scan_lock:
+            current = os.stat(file_path)
+            if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                raise RuntimeError('файл изменился во время перепаковки')
+            os.replace(temp_path, file_path)
+            new_stat = os.stat(file_path)
+            
+            # Содержимое видео не изменилось: переносим отпечатки на новую версию файла
+            conn.execute('''
+                UPDATE video_files SET size = ?, mtime_ns = ?, inode = ?, scanned_at = CURRENT_TIMESTAMP
+                WHERE filename = ?
+            ''', (new_stat.st_size, new_stat.st_mtime_ns, new_stat.st_ino, filename))
+            conn.execute('''
+                UPDATE probe_cache SET size = ?, mtime_ns = ?
+                WHERE filename = ? AND size = ? AND mtime_ns = ?
+            ''', (new_stat.st_size, new_stat.st_mtime_ns, filename, stat.st_size, stat.st_mtime_ns))
+            conn.execute('''
+                UPDATE hls_packages SET source_size = ?, source_mtime_ns = ?
+                WHERE filename = ? AND source_size = ? AND source_mtime_ns = ?
+            ''', (new_stat.st_size, new_stat.st_mtime_ns, filename, stat.st_size, stat.st_mtime_ns))
+            conn.execute('UPDATE videos SET updated_at = CURRENT_TIMESTAMP WHERE filename = ?', (filename,))
+            conn.commit()
+            record_faststart_result(filename, 'optimized', new_stat, original_size=stat.st_size)
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        error = e.stderr.decode('utf-8', 'ignore')[-500:] if isinstance(e, subprocess.CalledProcessError) else str(e)
+        print(f"Fast start: ошибка при перепаковке {filename}: {error}")
+        record_faststart_result(filename, 'failed', stat, error=error)
+        return
+    
+    remove_thumbnails(filename)
+    print(f"Fast start: {filename} готово за {time.time() - started:.0f}с")
+
+faststart_queue = BackgroundQueue('Fast start', optimize_video_file)
+
+def schedule_faststart(filename):
+    """Ставит MP4/MOV в очередь проверки и перепаковки"""
+    if not FASTSTART_ENABLED or shutil.which('ffmpeg') is None:
+        return False
+    if filename.rsplit('.', 1)[-1].lower() not in FASTSTART_EXTENSIONS:
+        return False
+    return faststart_queue.submit(filename)
+
+# MIME-типы видеофайлов по расширению
+VIDEO_MIME_TYPES = {
+    'mp4': 'video/mp4',
+    'avi': 'video/x-msvideo',
+    'mov': 'video/quicktime',
+    'mkv': 'video/x-matroska',
+    'webm': 'video/webm'
+}
+
+def get_video_etag(stat):
+    """Сильный ETag по идентичности файла: inode, размер и время изменения"""
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def get_requested_ranges(size, etag, last_modified):
+    """Диапазоны байт из заголовка Range.
+    
+    Возвращает None, если нужно отдать весь файл, и пустой список, если диапазон недопустим.
+    """
+    requested = request.range
+    if requested is None or requested.units != 'bytes':
+        return None
+    
+    # If-Range: диапазон действует, только если у клиента та же версия файла
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            # Для If-Range допустимо только сильное сравнение ETag
+            if if_range != f'"{etag}"':
+                return None
+        elif parse_date(if_range) != last_modified:
+            return None
+    
+    # Слишком много диапазонов обходятся дороже, чем весь файл
+    if len(requested.ranges) > STREAM_MAX_RANGES:
+        return None
+    
+    # Сначала переводим диапазоны от конца файла (bytes=-N) в абсолютные смещения, затем сортируем
+    absolute = []
+    for begin, end in requested.ranges:
+        if begin < 0:
+            absolute.append((max(size + begin, 0), size))
+        else:
+            absolute.append((begin, min(end if end is not None else size, size)))
+    
+    ranges = []
+    for start, stop in sorted(absolute):
+        if start >= stop:
+            continue
+        # Объединяем пересекающиеся и соседние диапазоны
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], stop))
+        else:
+            ranges.append((start, stop))
+    return ranges
+
+def read_file_range(file, start, length):
+    """Читает участок файла частями по STREAM_CHUNK_SIZE"""
+    file.seek(start)
+    while length > 0:
+        chunk = file.read(min(STREAM_CHUNK_SIZE, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+def iter_multipart_ranges(file, parts, closing):
+    """Тело ответа multipart/byteranges: заголовок части и ее байты"""
+    for header, start, stop in parts:
+        yield header
+        yield from read_file_range(file, start, stop - start)
+    yield closing
+
+def get_file_body(file, start, length, size):
+    """Тело ответа для одного диапазона: через sendfile сервера, если возможно, иначе по частям"""
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        # file_wrapper отдает файл до конца, поэтому годится для диапазонов до конца файла.
+        # gunicorn отправляет через sendfile ровно Content-Length байт, ему подходит любой диапазон.
+        to_end = start + length == size
+        if to_end or request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn'):
+            file.seek(start)
+            return file_wrapper(file, STREAM_CHUNK_SIZE)
+    # Тело-генератор при direct_passthrough отдается серверу как есть, без call_on_close:
+    # файл закрывает close() самого тела, который сервер вызывает в конце ответа
+    return ClosingIterator(read_file_range(file, start, length), file.close)
+
+class VideoStreamFile(io.FileIO):
+    """Видеофайл, открытый для отдачи. Пока он открыт, отдача считается активной.
+    
+    Обертка над самим файлом, а не над телом ответа, сохраняет sendfile сервера.
+    """
+    
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        video_streams_in_flight.inc()
+    
+    def close(self):
+        if not self.closed:
+            video_streams_in_flight.dec()
+        super().close()
+
+def stream_video_file(file_path, mime_type):
+    """Отдает видеофайл с поддержкой диапазонов, условных запросов и кэширования"""
+    file = VideoStreamFile(file_path)
+    try:
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        etag = get_video_etag(stat)
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), timezone.utc)
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': f'"{etag}"',
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': f'public, max-age={VIDEO_MAX_AGE}',
+        }
+        
+        # Условный запрос: у клиента уже есть эта версия файла
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = request.if_modified_since is not None and last_modified <= request.if_modified_since
+        if not_modified:
+            file.close()
+            return Response(status=304, headers=headers)
+        
+        ranges = get_requested_ranges(size, etag, last_modified)
+        if ranges is None:
+            status = 200
+            headers['Content-Length'] = str(size)
+            body = get_file_body(file, 0, size, size)
+        elif not ranges:
+            file.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        elif len(ranges) == 1:
+            status = 206
+            start, stop = ranges[0]
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            headers['Content-Length'] = str(stop - start)
+            body = get_file_body(file, start, stop - start, size)
+        else:
+            status = 206
+            boundary = os.urandom(12).hex()
+            parts = [(f'\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n'
+                      f'Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n'.encode('latin-1'), start, stop)
+                     for start, stop in ranges]
+            closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+            headers['Content-Length'] = str(sum(len(header) + stop - start for header, start, stop in parts) + len(closing))
+            mime_type = f'multipart/byteranges; boundary={boundary}'
+            body = ClosingIterator(iter_multipart_ranges(file, parts, closing), file.close)
+    except Exception:
+        file.close()
+        raise
     
-    return render_template('index.html', 
-                         videos=videos, 
-                         search_term=search_term)
-#def index():
-#    search_term = request.args.get('search', '').strip()
-#    
-#    if search_term:
-#        videos = search_videos_with_orientation(search_term)
-#        return render_template('index.html', 
-#                             videos=videos, 
-#                             search_term=search_term,
-#                             show_separately=False)
-#    else:
-#        # Без поиска разделяем видео
-#        videos = get_videos_with_orientation()
-#        
-#        # Разделяем на горизонтальные и вертикальные
-#        horizontal_videos = []
-#        vertical_videos = []
-#        
-#        for video in videos:
-#            filename, display_name, orientation = video
-#            if orientation == 'vertical':
-#                vertical_videos.append(video)
-#            else:
-#                horizontal_videos.append(video)
-#        
-#        return render_template('index.html', 
-#                             horizontal_videos=horizontal_videos,
-#                             vertical_videos=vertical_videos,
-#                             search_term=search_term,
-#                             show_separately=True)
+    response = Response(body, status=status, headers=headers, content_type=mime_type, direct_passthrough=True)
+    response.call_on_close(file.close)
+    return response
 
-@app.route('/video/<filename>', endpoint='serve_video')  # Добавьте endpoint явно
+@app.route('/video/<path:filename>', endpoint='serve_video')  # Добавьте endpoint явно
 def serve_video(filename):  # Изменено с video на serve_video
     """Маршрут для отдачи видеофайлов"""
     # Проверяем, не забанено ли видео
@@ -977,24 +4501,34 @@ def serve_video(filename):  # Изменено с video на serve_video
     
     # Определяем MIME-тип
     ext = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
-    mime_types = {
-        'mp4': 'video/mp4',
-        'avi': 'video/x-msvideo',
-        'mov': 'video/quicktime',
-        'mkv': 'video/x-matroska',
-        'webm': 'video/webm'
-    }
+    mime_type = VIDEO_MIME_TYPES.get(ext, 'application/octet-stream')
+    
+    return stream_video_file(file_path, mime_type)
+
+@app.route('/thumb/<path:filename>')
+def serve_thumbnail(filename):
+    """Маршрут для отдачи превью видео"""
+    if is_video_banned(filename):
+        return jsonify({'error': 'Video is banned'}), 403
+    
+    file_path = get_video_file_path(filename)
+    if file_path is None or not os.path.exists(file_path):
+        return jsonify({'error': 'Video not found'}), 404
     
-    mime_type = mime_types.get(ext, 'application/octet-stream')
+    thumbnail = get_thumbnail(filename, file_path)
+    if thumbnail is None:
+        return jsonify({'error': 'Thumbnail not available'}), 404
+    thumb_path, version = thumbnail
     
-    return send_file(
-        file_path,
-        mimetype=mime_type,
-        as_attachment=False,
-        conditional=True
-    )
+    response = send_file(thumb_path, mimetype='image/jpeg', conditional=True, etag=version)
+    if request.args.get('v') == version:
+        # URL содержит версию файла, поэтому его можно кэшировать навсегда
+        response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-@app.route('/watch/<filename>')
+@app.route('/watch/<path:filename>')
 def watch_video(filename):
     # Проверяем, не забанено ли видео
     if is_video_banned(filename):
@@ -1013,25 +4547,27 @@ def watch_video(filename):
     except:
         display_name = filename
     
-    # Добавляем в историю просмотров
-    add_to_history(session['session_id'], filename)
-    
     # Получаем ориентацию видео из базы данных
     orientation = get_video_orientation(filename)
     
     # Если видео вертикальное - перенаправляем на специальную страницу
+    # (просмотр будет засчитан там, чтобы не считать его дважды)
     if orientation == 'vertical':
         return redirect(url_for('vertical_video', filename=filename))
     
-    # Получаем список других видео для рекомендаций (только для горизонтальных)
-    other_videos = get_other_videos(filename)
+    # Добавляем в историю просмотров
+    add_to_history(session['session_id'], filename)
+    
+    # Рекомендации по совместным просмотрам (только для горизонтальных)
+    other_videos = get_recommendations(filename, limit=5)  # Ограничиваем до 5 рекомендаций
     
     return render_template('watch.html', 
                          filename=filename,
                          display_name=display_name,
-                         other_videos=other_videos[:5])  # Ограничиваем до 5 рекомендаций
+                         hls_url=get_hls_url(filename, file_path),
+                         other_videos=other_videos)
 
-@app.route('/vertical/<filename>')
+@app.route('/vertical/<path:filename>')
 def vertical_video(filename):
     # Проверяем, не забанено ли видео
     if is_video_banned(filename):
@@ -1050,17 +4586,28 @@ def vertical_video(filename):
     except:
         display_name = filename
     
-    # Добавляем в историю просмотров
-    add_to_history(session['session_id'], filename)
-    
     # Проверяем, что видео действительно вертикальное
     orientation = get_video_orientation(filename)
     if orientation != 'vertical':
         return redirect(url_for('watch_video', filename=filename))
     
-    return render_template('vertical_watch.html', 
+    # Добавляем в историю просмотров
+    add_to_history(session['session_id'], filename)
+    
+    # Запоминаем видео в ленте shorts этой сессии
+    shorts_feeds.visit(session['session_id'], filename)
+    
+    # Подсказки браузеру: превью и страницы следующих видео ленты
+    upcoming = [item for item in map(short_to_json, upcoming_shorts(session['session_id'], SHORTS_PRELOAD_COUNT))
+                if item is not None]
+    
+    response = make_response(render_template('vertical_watch.html', 
                          filename=filename,
-                         display_name=display_name)
+                         display_name=display_name,
+                         hls_url=get_hls_url(filename, file_path)))
+    if upcoming:
+        response.headers['Link'] = shorts_preload_links(upcoming)
+    return response
 
 @app.route('/api/random_vertical_video')
 def random_vertical_video():
@@ -1075,32 +4622,411 @@ def random_vertical_video():
         except:
             pass
     
-    # Исключаем текущее видео из списка
-    if current_filename and current_filename in vertical_videos:
-        vertical_videos = [v for v in vertical_videos if v != current_filename]
-    
-    if vertical_videos:
-        random_video = random.choice(vertical_videos)
+    # Выбираем случайное видео, исключая текущее
+    random_video = pick_random_video(vertical_videos, exclude=current_filename)
+    if random_video:
         return jsonify({'filename': random_video})
     else:
         return jsonify({'error': 'No vertical videos found'}), 404
 
+def get_current_filename_arg():
+    """Имя текущего видео из параметра запроса current"""
+    current_filename = request.args.get('current')
+    if current_filename:
+        try:
+            current_filename = unquote(current_filename)
+        except:
+            pass
+    return current_filename
+
+@app.route('/api/shorts/next')
+def shorts_next():
+    """API ленты shorts: следующее видео без повторов"""
+    filename = next_short(session['session_id'], get_current_filename_arg())
+    if filename:
+        return jsonify({'filename': filename, 'url': url_for('vertical_video', filename=filename)})
+    return jsonify({'error': 'No vertical videos found'}), 404
+
+@app.route('/api/shorts/batch')
+def shorts_batch():
+    """API ленты shorts: следующие n видео с данными для предзагрузки.
+    
+    Курсор ленты не сдвигается: /api/shorts/next и переход по url вернут эти же
+    видео в том же порядке.
+    """
+    count = max(1, min(request.args.get('n', SHORTS_PRELOAD_COUNT, type=int), SHORTS_BATCH_MAX))
+    videos = upcoming_shorts(session['session_id'], count, get_current_filename_arg())
+    items = [item for item in map(short_to_json, videos) if item is not None]
+    response = jsonify({'items': items, 'preload': SHORTS_PRELOAD_COUNT, 'prefetch_bytes': SHORTS_PREFETCH_BYTES})
+    if items:
+        response.headers['Link'] = shorts_preload_links(items)
+    return response
+
+@app.route('/api/shorts/prev')
+def shorts_prev():
+    """API ленты shorts: предыдущее просмотренное видео"""
+    filename = previous_short(session['session_id'], get_current_filename_arg())
+    if filename:
+        return jsonify({'filename': filename, 'url': url_for('vertical_video', filename=filename)})
+    return jsonify({'error': 'No previous video'}), 404
+
 @app.route('/api/vertical_videos_list')
 def vertical_videos_list():
     """API для получения списка всех вертикальных видео в алфавитном порядке"""
-    vertical_videos = get_all_vertical_videos()
-    # Сортируем видео по алфавиту
-    sorted_videos = sorted(vertical_videos)
+    catalog = get_catalog()
+    if catalog is not None:
+        # Снимок каталога уже хранит отсортированный список
+        sorted_videos = list(catalog.vertical_sorted)
+    else:
+        # Сортируем видео по алфавиту
+        sorted_videos = sorted(get_all_vertical_videos())
     return jsonify({'videos': sorted_videos})
 
+# Фоновые задачи администратора.
+# Долгие операции (сканирование, переопределение ориентаций) выполняются в
+# ограниченном пуле потоков, а их состояние и прогресс хранятся в таблице jobs,
+# поэтому страница администратора показывает их и после перезагрузки.
+
+JOB_COLUMNS = ('id', 'type', 'status', 'params', 'done', 'total', 'message', 'result', 'error',
+               'cancel_requested', 'created_at', 'started_at', 'finished_at')
+
+class JobCancelled(Exception):
+    """Задача остановлена по запросу администратора"""
+
+class JobContext:
+    """Передается обработчику задачи: запись прогресса и проверка отмены"""
+    
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.done = 0
+        self.total = 0
+        self.message = None
+        self.last_saved = 0.0
+    
+    def progress(self, done=None, total=None, message=None, advance=0):
+        """Обновляет счетчики. В БД пишет не чаще JOB_PROGRESS_INTERVAL. Бросает JobCancelled при отмене"""
+        if done is not None:
+            self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        self.done += advance
+        if time.monotonic() - self.last_saved >= JOB_PROGRESS_INTERVAL or (self.total and self.done >= self.total):
+            self.save()
+        self.check_cancelled()
+    
+    def save(self):
+        conn = get_db()
+        conn.execute('UPDATE jobs SET done = ?, total = ?, message = ? WHERE id = ?',
+                     (self.done, self.total, self.message, self.job_id))
+        conn.commit()
+        self.last_saved = time.monotonic()
+    
+    def check_cancelled(self):
+        # Флаг читается из БД: отменить задачу можно из любого процесса
+        row = get_db().execute('SELECT cancel_requested FROM jobs WHERE id = ?', (self.job_id,)).fetchone()
+        if row and row[0]:
+            raise JobCancelled()
+
+class JobManager:
+    """Запускает задачи в ограниченном пуле потоков. Незавершенной может быть только одна задача каждого типа"""
+    
+    def __init__(self, workers):
+        self.handlers = {}  # тип -> (название, обработчик, допустимые флаги)
+        self.queue = BackgroundQueue('Задачи', self.run, workers)
+    
+    def register(self, job_type, title, flags=()):
+        """Декоратор обработчика задачи. Обработчик получает JobContext и флаги, возвращает результат для JSON"""
+        def decorator(handler):
+            self.handlers[job_type] = (title, handler, flags)
+            return handler
+        return decorator
+    
+    def submit(self, job_type, **params):
+        """Ставит задачу в очередь. Возвращает (id, True) или (id уже идущей задачи того же типа, False)"""
+        if job_type not in self.handlers:
+            raise ValueError(f'Неизвестный тип задачи: {job_type}')
+        conn = get_db()
+        try:
+            cursor = conn.execute("INSERT INTO jobs (type, status, params, owner) VALUES (?, 'queued', ?, ?)",
+                                  (job_type, json.dumps(params), coordinator.token))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            row = conn.execute("SELECT id FROM jobs WHERE type = ? AND status IN ('queued', 'running')",
+                               (job_type,)).fetchone()
+            if row is None:
+                raise
+            return row[0], False
+        job_id = cursor.lastrowid
+        self.prune()
+        self.queue.submit(job_id)
+        return job_id, True
+    
+    def run(self, job_id):
+        conn = get_db()
+        cursor = conn.execute("UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'queued'",
+                              (job_id,))
+        conn.commit()
+        if cursor.rowcount == 0:
+            # Задачу отменили, пока она ждала в очереди
+            return
+        job_type, params = conn.execute('SELECT type, params FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        title, handler, _ = self.handlers[job_type]
+        context = JobContext(job_id)
+        result = error = None
+        print(f"Задача {job_id} ({title}) запущена")
+        try:
+            result = handler(context, **json.loads(params or '{}'))
+            status = 'done'
+        except JobCancelled:
+            conn.rollback()
+            status = 'cancelled'
+        except Exception as e:
+            conn.rollback()
+            import traceback
+            traceback.print_exc()
+            status, error = 'failed', str(e)
+        conn.execute('''
+            UPDATE jobs SET status = ?, done = ?, total = ?, message = ?, result = ?, error = ?,
+                finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, context.done, context.total, context.message,
+              json.dumps(result) if result is not None else None, error, job_id))
+        conn.commit()
+        print(f"Задача {job_id} ({title}): {status}")
+    
+    def cancel(self, job_id):
+        """Просит задачу остановиться. Ожидающая задача отменяется сразу. Возвращает False, если задача уже завершена"""
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'queued'
+        ''', (job_id,))
+        cancelled = cursor.rowcount
+        cursor.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        cancelled += cursor.rowcount
+        conn.commit()
+        return cancelled > 0
+    
+    def prune(self):
+        """Удаляет старые завершенные задачи сверх JOB_HISTORY_LIMIT"""
+        conn = get_db()
+        conn.execute('''
+            DELETE FROM jobs WHERE status NOT IN ('queued', 'running')
+            AND id NOT IN (SELECT id FROM jobs ORDER BY id DESC LIMIT ?)
+        ''', (JOB_HISTORY_LIMIT,))
+        conn.commit()
+    
+    def resume(self):
+        """Забирает себе и перезапускает задачи, процесс-владелец которых остановился"""
+        conn = get_db()
+        dead_owner, params = coordinator.dead_owner_clause()
+        conn.execute(f'''
+            UPDATE jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+            WHERE status IN ('queued', 'running') AND cancel_requested = 1 AND {dead_owner}
+        ''', params)
+        conn.execute(f"UPDATE jobs SET status = 'queued', owner = ? WHERE status IN ('queued', 'running') AND {dead_owner}",
+                     (coordinator.token, *params))
+        conn.commit()
+        rows = conn.execute("SELECT id FROM jobs WHERE status = 'queued' AND owner = ? ORDER BY id",
+                            (coordinator.token,)).fetchall()
+        for (job_id,) in rows:
+            self.queue.submit(job_id)
+
+job_manager = JobManager(JOB_WORKERS)
+coordinator.leader_task(job_manager.resume)
+
+def get_job(job_id):
+    conn = get_db()
+    row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+def get_jobs(limit=50):
+    conn = get_db()
+    rows = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(zip(JOB_COLUMNS, row)) for row in rows]
+
+def job_to_json(job):
+    title = job_manager.handlers.get(job['type'], (job['type'],))[0]
+    return {
+        'id': job['id'],
+        'type': job['type'],
+        'title': title,
+        'status': job['status'],
+        'params': json.loads(job['params'] or '{}'),
+        'done': job['done'],
+        'total': job['total'],
+        'message': job['message'],
+        'result': json.loads(job['result']) if job['result'] else None,
+        'error': job['error'],
+        'cancel_requested': bool(job['cancel_requested']),
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+    }
+
+def flash_job_started(job_id, created):
+    if created:
+        flash(f'Задача #{job_id} запущена, прогресс в разделе "Задачи"')
+    else:
+        flash(f'Такая задача уже выполняется (#{job_id})')
+
+@job_manager.register('rescan', 'Сканирование папки с видео')
+def job_rescan(context):
+    context.progress(message='Сканирование папки')
+    # Пока папку сканирует другой процесс, ждем: изменения после его начала он мог не увидеть
+    while True:
+        result = scan_videos_folder(progress=context.progress)
+        if result is not None:
+            return result
+        context.progress(message='Ожидание сканирования в другом процессе')
+        time.sleep(1)
+
+@job_manager.register('redetect_orientations', 'Переопределение ориентаций', flags=('force',))
+def job_redetect_orientations(context, force=False):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT filename FROM videos')
+    all_videos = [row[0] for row in cursor.fetchall()]
+    context.progress(0, len(all_videos), 'Анализ видео')
+    
+    # Переопределяем ориентацию для каждого видео, записывая результаты пачками
+    updated_count = 0
+    
+    def save_batch(batch):
+        nonlocal updated_count
+        rows = [(orientation, width, height, duration, filename)
+                for filename, (orientation, width, height, duration) in batch if orientation != "unknown"]
+        cursor.executemany('UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ? WHERE filename = ?', rows)
+        conn.commit()
+        updated_count += len(rows)
+        # При отмене исключение прерывает probe_videos, пул процессов останавливается
+        context.progress(advance=len(batch))
+    
+    try:
+        stats = probe_videos(all_videos, save_batch, force=force)
+    finally:
+        invalidate_catalog()
+    
+    log_admin_action("Переопределение ориентаций", 
+                    f"Обновлено {updated_count} видео, {stats['files_per_second']:.1f} файлов/с")
+    return {'updated': updated_count, 'files_per_second': round(stats['files_per_second'], 1),
+            'cached': stats['cached'], 'timeouts': stats['timeouts']}
+
+@job_manager.register('fix_orientations', 'Исправление ориентаций', flags=('force',))
+def job_fix_orientations(context, force=False):
+    with db_lock:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT filename, orientation FROM videos')
+        current_orientations = dict(cursor.fetchall())
+    context.progress(0, len(current_orientations), 'Анализ видео')
+    
+    # Исправляем ориентацию для каждого видео
+    fixed_count = 0
+    
+    def save_batch(batch):
+        nonlocal fixed_count
+        rows = []
+        for filename, (orientation, width, height, duration) in batch:
+            # Если ориентация определена и отличается от текущей
+            current_orientation = current_orientations[filename]
+            if orientation != "unknown" and orientation != current_orientation:
+                rows.append((orientation, width, height, duration, filename))
+                print(f"Исправлена ориентация: {filename} - было '{current_orientation}', стало '{orientation}'")
+        if rows:
+            with db_lock:
+                cursor.executemany('UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ? WHERE filename = ?', rows)
+                conn.commit()
+            fixed_count += len(rows)
+        context.progress(advance=len(batch))
+    
+    try:
+        probe_videos(list(current_orientations), save_batch, force=force)
+    finally:
+        if fixed_count:
+            invalidate_catalog()
+    return {'fixed': fixed_count}
+
+@job_manager.register('check_stats', 'Проверка статистики', flags=('rebuild',))
+def job_check_stats(context, rebuild=False):
+    context.progress(message='Сверка агрегатов с таблицей videos')
+    problems = verify_video_stats(rebuild)
+    if problems:
+        log_admin_action("Проверка статистики", f"Расхождений: {len(problems)}" + (", пересчитано" if rebuild else ""))
+    return {'problems': len(problems), 'rebuilt': bool(problems and rebuild)}
+
+@job_manager.register('rebuild_recommendations', 'Пересчет рекомендаций')
+def job_rebuild_recommendations(context):
+    context.progress(message='Обработка истории просмотров')
+    processed = rebuild_recommendations(lambda done, total: context.progress(done, total))
+    log_admin_action("Пересчет рекомендаций", f"Обработано просмотров: {processed}")
+    return {'processed': processed}
+
+@job_manager.register('cleanup_history', 'Очистка истории просмотров')
+def job_cleanup_history(context):
+    context.progress(message='Удаление старой истории')
+    result = cleanup_history(lambda count: context.progress(advance=count))
+    log_admin_action("Очистка истории просмотров",
+                     f"Удалено старых {result['expired']}, сверх лимита сессий {result['trimmed']}")
+    return result
+
+@app.route('/admin/jobs', methods=['GET', 'POST'])
+def admin_jobs():
+    """Список последних задач (GET) или запуск новой (POST: type и флаги задачи)"""
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if request.method == 'GET':
+        limit = min(max(request.args.get('limit', 50, type=int), 1), JOB_HISTORY_LIMIT)
+        return jsonify({
+            'jobs': [job_to_json(job) for job in get_jobs(limit)],
+            'types': {job_type: title for job_type, (title, _, _) in job_manager.handlers.items()},
+        })
+    
+    data = request.get_json(silent=True) or request.form
+    job_type = data.get('type')
+    if job_type not in job_manager.handlers:
+        return jsonify({'error': 'Неизвестный тип задачи'}), 400
+    flags = job_manager.handlers[job_type][2]
+    params = {flag: data.get(flag) in (True, 1, '1', 'true', 'on') for flag in flags if flag in data}
+    job_id, created = job_manager.submit(job_type, **params)
+    if created:
+        log_admin_action("Запуск задачи", f"#{job_id} {job_manager.handlers[job_type][0]}")
+    return jsonify({'created': created, 'job': job_to_json(get_job(job_id))}), 202 if created else 200
+
+@app.route('/admin/jobs/<int:job_id>')
+def admin_job_status(job_id):
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    return jsonify(job_to_json(job))
+
+@app.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+def admin_job_cancel(job_id):
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    if get_job(job_id) is None:
+        return jsonify({'error': 'Задача не найдена'}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({'error': 'Задача уже завершена'}), 409
+    log_admin_action("Отмена задачи", f"#{job_id}")
+    return jsonify({'success': True, 'job': job_to_json(get_job(job_id))})
+
 @app.route('/settings')
 def settings():
     return render_template('settings.html')
 
 @app.route('/admin')
 def admin():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return redirect(url_for('settings'))
     
     # Получаем статистику и список видео для админки
@@ -1117,18 +5043,68 @@ def admin():
                          logs=logs,
                          system_info=system_info)
 
+@app.route('/admin/console')
+def admin_console():
+    if not has_admin_access():
+        return redirect(url_for('settings'))
+    return render_template('console.html', system_info=get_system_info())
+
+@app.route('/admin/system/metrics')
+def admin_system_metrics():
+    """Показатели системы: последний замер и ряды замеров за seconds секунд для графиков"""
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    seconds = request.args.get('seconds', type=float)
+    return jsonify({
+        'info': system_sampler.get_info(),
+        'interval': SYSTEM_SAMPLE_INTERVAL,
+        'latest': system_sampler.latest(),
+        'series': system_sampler.series(seconds),
+    })
+
+@app.route('/admin/stats/daily')
+def admin_daily_views():
+    """Просмотры по дням за days дней (всего или одного видео filename)"""
+    if not has_admin_access():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    
+    days = min(max(request.args.get('days', 30, type=int), 1), 3660)
+    return jsonify({'days': get_daily_views(days, request.args.get('filename'))})
+
+def get_catalog_size():
+    snapshot = catalog_cache.snapshot
+    return len(snapshot.videos) if snapshot is not None else 0
+
+Gauge('nantube_catalog_videos', 'Видео в кэше каталога', callback=get_catalog_size)
+Gauge('nantube_shorts_feeds', 'Лент shorts в памяти', callback=lambda: len(shorts_feeds.feeds))
+Gauge('nantube_pending_views', 'Просмотров, еще не записанных в БД', callback=lambda: len(view_aggregator.history))
+Gauge('nantube_db_pool_idle', 'Свободных соединений в пуле БД', callback=db_pool.qsize)
+Gauge('nantube_hls_queue', 'Видео в очереди подготовки HLS', callback=lambda: len(hls_packager.pending))
+Gauge('nantube_faststart_queue', 'Видео в очереди перепаковки', callback=lambda: len(faststart_queue.pending))
+Gauge('nantube_upload_queue', 'Загрузок в очереди обработки', callback=lambda: len(upload_queue.pending))
+Gauge('nantube_job_queue', 'Задач администратора в очереди и в работе', callback=lambda: len(job_manager.queue.pending))
+
+@app.route('/metrics')
+def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    if not METRICS_ENABLED:
+        return jsonify({'error': 'Not found'}), 404
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/grant_admin')
 def grant_admin():
-    global admin_access
-    admin_access = True
+    set_shared_state('admin_access', '1')
     log_admin_action("Вход в админ-панель", f"Сессия: {session['session_id']}")
     flash('Админский доступ предоставлен!')
     return redirect(url_for('admin'))
 
 @app.route('/admin/ban_video', methods=['POST'])
 def admin_ban_video():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
     filename = request.form.get('filename')
@@ -1143,8 +5119,7 @@ def admin_ban_video():
 
 @app.route('/admin/unban_video', methods=['POST'])
 def admin_unban_video():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
     filename = request.form.get('filename')
@@ -1158,8 +5133,7 @@ def admin_unban_video():
 
 @app.route('/admin/delete_video', methods=['POST'])
 def admin_delete_video():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
     filename = request.form.get('filename')
@@ -1175,8 +5149,7 @@ def admin_delete_video():
 
 @app.route('/admin/rename_video', methods=['POST'])
 def admin_rename_video():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
     old_filename = request.form.get('old_filename')
@@ -1197,6 +5170,12 @@ def admin_rename_video():
         old_ext = os.path.splitext(old_filename)[1]
         new_filename += old_ext
     
+    # Файл из вложенной папки остается в своей папке
+    new_filename = safe_filename(os.path.basename(new_filename))
+    old_folder = os.path.dirname(old_filename)
+    if old_folder:
+        new_filename = f"{old_folder}/{new_filename}"
+    
     # Проверяем, что файл с новым именем не существует
     new_file_path = os.path.join(VIDEO_FOLDER, new_filename)
     if os.path.exists(new_file_path):
@@ -1220,8 +5199,7 @@ def admin_rename_video():
 
 @app.route('/admin/force_reorientation', methods=['POST'])
 def admin_force_reorientation():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
     filename = request.form.get('filename')
@@ -1237,15 +5215,13 @@ def admin_force_reorientation():
 
 @app.route('/admin/clear_logs', methods=['POST'])
 def admin_clear_logs():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
-    conn = sqlite3.connect(DATABASE_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM admin_logs')
     conn.commit()
-    conn.close()
     
     log_admin_action("Очистка логов", "Все логи администратора очищены")
     flash('Логи администратора очищены')
@@ -1254,44 +5230,25 @@ def admin_clear_logs():
 
 @app.route('/admin/rescan_videos', methods=['POST'])
 def admin_rescan_videos():
-    global admin_access
-    if not admin_access:
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
-    # Запускаем сканирование в отдельном потоке
-    threading.Thread(target=scan_videos_folder, daemon=True).start()
-    
-    log_admin_action("Принудительное сканирование видео", "Запущено сканирование папки с видео")
-    flash('Сканирование видео запущено')
+    # Сканирование идет фоновой задачей: повторное нажатие не запускает второе
+    job_id, created = job_manager.submit('rescan')
+    if created:
+        log_admin_action("Принудительное сканирование видео", "Запущено сканирование папки с видео")
+    flash_job_started(job_id, created)
     
     return redirect(url_for('admin'))
 
 @app.route('/api/previous_vertical_video')
 def previous_vertical_video():
     """API для получения предыдущего вертикального видео из истории"""
-    current_filename = request.args.get('current')
-    if current_filename:
-        try:
-            current_filename = unquote(current_filename)
-        except:
-            pass
-    
-    # Получаем историю просмотров
-    history = get_watch_history(session['session_id'])
-    
-    if current_filename in history:
-        current_index = history.index(current_filename)
-        if current_index > 0:
-            previous_video = history[current_index - 1]
-            return jsonify({'filename': previous_video})
-    
-    # Если предыдущего видео нет, возвращаем случайное
-    vertical_videos = get_all_vertical_videos()
-    if vertical_videos:
-        random_video = random.choice(vertical_videos)
-        return jsonify({'filename': random_video})
-    else:
-        return jsonify({'error': 'No vertical videos found'}), 404
+    # Предыдущее видео из навигации shorts этой сессии (без обращения к БД)
+    previous_video = previous_short(session['session_id'], get_current_filename_arg())
+    if previous_video:
+        return jsonify({'filename': previous_video})
+    return jsonify({'error': 'No previous video'}), 404
 
 def get_local_ip():
     try:
@@ -1307,6 +5264,254 @@ def get_local_ip():
 def help_NanBelle():
     return render_template('help.html')
 
+# Загрузка файлов частями с возможностью продолжения.
+# Клиент создает загрузку (init), отправляет куски по порядку со смещением и CRC32 (chunk),
+# после обрыва связи узнает принятый объем (status) и продолжает с него,
+# а в конце просит обработать файл (complete). Анализ и запись в БД выполняются в фоне.
+
+# Запросы одной загрузки могут прийти в разные процессы, поэтому переходы между
+# состояниями делаются одним UPDATE с проверкой прежнего состояния:
+# uploading -> receiving (пишется кусок) -> uploading -> processing -> done/failed
+
+UPLOAD_COLUMNS = ('id', 'original_name', 'size', 'received', 'orientation', 'status', 'filename', 'error')
+
+def get_upload_temp_path(upload_id):
+    """Временный файл загрузки в папке с видео (скрыт от сканера)"""
+    return os.path.join(VIDEO_FOLDER, f".upload-{upload_id}.part")
+
+def get_upload(upload_id):
+    conn = get_db()
+    row = conn.execute(f'SELECT {", ".join(UPLOAD_COLUMNS)} FROM uploads WHERE id = ?', (upload_id,)).fetchone()
+    return dict(zip(UPLOAD_COLUMNS, row)) if row else None
+
+def create_upload(original_name, size, orientation):
+    """Создает загрузку и пустой временный файл"""
+    upload_id = os.urandom(16).hex()
+    open(get_upload_temp_path(upload_id), 'wb').close()
+    conn = get_db()
+    conn.execute('''
+        INSERT INTO uploads (id, original_name, size, received, orientation, status, session_id)
+        VALUES (?, ?, ?, 0, ?, 'uploading', ?)
+    ''', (upload_id, original_name, size, orientation, session.get('session_id')))
+    conn.commit()
+    return upload_id
+
+def start_upload_processing(upload_id):
+    """Передает полностью принятый файл на фоновую обработку.
+    
+    Возвращает False, если загрузка не принята полностью или ее уже завершил другой запрос.
+    """
+    conn = get_db()
+    cursor = conn.execute('''
+        UPDATE uploads SET status = 'processing', owner = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'uploading' AND received = size
+    ''', (coordinator.token, upload_id))
+    conn.commit()
+    if cursor.rowcount == 0:
+        return False
+    upload_queue.submit(upload_id)
+    return True
+
+def move_to_unique_name(path, directory, filename):
+    """Переносит файл в папку под свободным именем и возвращает это имя.
+    
+    Ссылка не создается поверх существующего файла, поэтому два процесса
+    не могут занять одно имя: проигравший просто берет следующее.
+    """
+    while True:
+        unique_filename = get_unique_filename(directory, filename)
+        try:
+            os.link(path, os.path.join(directory, unique_filename))
+        except FileExistsError:
+            continue
+        os.remove(path)
+        return unique_filename
+
+def process_upload(upload_id):
+    """Фоновая обработка загруженного файла: перенос на место, анализ, запись в БД"""
+    upload = get_upload(upload_id)
+    if upload is None or upload['status'] != 'processing':
+        return
+    conn = get_db()
+    try:
+        # Сохраняем оригинальное название с поддержкой кириллицы
+        original_name = upload['original_name']
+        unique_filename = move_to_unique_name(get_upload_temp_path(upload_id), VIDEO_FOLDER, original_name)
+        filename_index.add(unique_filename)
+        
+        # Определяем информацию о видео
+        detected_orientation, width, height, duration = detect_video_info(unique_filename)
+        
+        # Используем выбранную ориентацию или определенную автоматически
+        if upload['orientation'] in (None, '', 'auto'):
+            final_orientation = detected_orientation
+        else:
+            final_orientation = upload['orientation']
+        
+        # Сохраняем информацию в базе данных
+        conn.execute('''
+            INSERT OR REPLACE INTO videos 
+            (filename, orientation, display_name, width, height, duration, banned, views, likes, dislikes)
+            VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 0)
+        ''', (unique_filename, final_orientation, original_name, width, height, duration))
+        conn.execute('''
+            UPDATE uploads SET status = 'done', filename = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (unique_filename, upload_id))
+        conn.commit()
+        invalidate_catalog()
+        schedule_faststart(unique_filename)
+        
+        log_admin_action("Загрузка видео", f"Файл: {unique_filename}, Ориентация: {final_orientation}, Размеры: {width}x{height}, Длительность: {duration}сек")
+    except Exception as e:
+        conn.rollback()
+        print(f"Ошибка при обработке загрузки {upload_id}: {e}")
+        conn.execute('''
+            UPDATE uploads SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        ''', (str(e), upload_id))
+        conn.commit()
+
+upload_queue = BackgroundQueue('Загрузка', process_upload)
+
+@coordinator.leader_task
+def resume_uploads():
+    """Забирает себе загрузки, обработка которых прервалась остановкой процесса-владельца"""
+    conn = get_db()
+    dead_owner, params = coordinator.dead_owner_clause()
+    # Кусок, который писал остановившийся процесс, клиент отправит заново
+    conn.execute(f"UPDATE uploads SET status = 'uploading' WHERE status = 'receiving' AND {dead_owner}", params)
+    conn.execute(f"UPDATE uploads SET owner = ? WHERE status = 'processing' AND {dead_owner}",
+                 (coordinator.token, *params))
+    conn.commit()
+    rows = conn.execute("SELECT id FROM uploads WHERE status = 'processing' AND owner = ?",
+                        (coordinator.token,)).fetchall()
+    for (upload_id,) in rows:
+        upload_queue.submit(upload_id)
+
+def cleanup_stale_uploads():
+    """Удаляет брошенные загрузки и старые записи о завершенных"""
+    conn = get_db()
+    expired = conn.execute('''
+        SELECT id FROM uploads
+        WHERE status IN ('uploading', 'receiving', 'done', 'failed') AND updated_at < datetime('now', ?)
+    ''', (f'-{UPLOAD_EXPIRE_HOURS} hours',)).fetchall()
+    for (upload_id,) in expired:
+        temp_path = get_upload_temp_path(upload_id)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    conn.executemany('DELETE FROM uploads WHERE id = ?', expired)
+    conn.commit()
+    if expired:
+        print(f"Удалено устаревших загрузок: {len(expired)}")
+
+def upload_to_json(upload):
+    result = {
+        'upload_id': upload['id'],
+        # Запись куска - внутреннее состояние, клиенту загрузка видна как продолжающаяся
+        'status': 'uploading' if upload['status'] == 'receiving' else upload['status'],
+        'offset': upload['received'],
+        'size': upload['size'],
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+    }
+    if upload['status'] == 'done':
+        result['filename'] = upload['filename']
+        result['watch_url'] = url_for('watch_video', filename=upload['filename'])
+    elif upload['status'] == 'failed':
+        result['error'] = upload['error']
+    return result
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    """Начало загрузки частями: {filename, size, orientation}"""
+    data = request.get_json(silent=True) or {}
+    original_name = str(data.get('filename', ''))
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Не указан размер файла'}), 400
+    
+    if not original_name or not allowed_file(original_name):
+        return jsonify({'error': 'Недопустимый тип файла. Разрешены: mp4, avi, mov, mkv, webm'}), 400
+    if size <= 0 or size > UPLOAD_MAX_SIZE:
+        return jsonify({'error': 'Недопустимый размер файла'}), 400
+    
+    upload_id = create_upload(original_name, size, data.get('orientation', 'auto'))
+    return jsonify(upload_to_json(get_upload(upload_id))), 201
+
+@app.route('/upload/<upload_id>')
+def upload_status(upload_id):
+    """Состояние загрузки: сколько принято (для продолжения) и результат обработки"""
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    return jsonify(upload_to_json(upload))
+
+@app.route('/upload/<upload_id>/chunk', methods=['PUT'])
+def upload_chunk(upload_id):
+    """Прием куска файла: смещение в параметре offset, CRC32 (hex) в заголовке X-Chunk-CRC32"""
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    if upload['status'] != 'uploading':
+        return jsonify(upload_to_json(upload)), 409
+    
+    try:
+        offset = int(request.args['offset'])
+        expected_crc = int(request.headers['X-Chunk-CRC32'], 16)
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Нужны offset и X-Chunk-CRC32'}), 400
+    length = request.content_length
+    if length is None or length > UPLOAD_CHUNK_SIZE or offset + length > upload['size']:
+        return jsonify({'error': 'Недопустимый размер куска'}), 400
+    
+    # Кусок пишет только запрос, который перевел загрузку в receiving с ожидаемого смещения
+    conn = get_db()
+    cursor = conn.execute('''
+        UPDATE uploads SET status = 'receiving', owner = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND status = 'uploading' AND received = ?
+    ''', (coordinator.token, upload_id, offset))
+    conn.commit()
+    if cursor.rowcount == 0:
+        return jsonify(upload_to_json(get_upload(upload_id))), 409
+    
+    received = offset
+    try:
+        crc = 0
+        written = 0
+        with open(get_upload_temp_path(upload_id), 'r+b') as f:
+            f.seek(offset)
+            while written < length:
+                block = request.stream.read(min(1024 * 1024, length - written))
+                if not block:
+                    break
+                crc = zlib.crc32(block, crc)
+                f.write(block)
+                written += len(block)
+            # Отбрасываем все, что лежит после принятых данных (остатки оборванной попытки)
+            if written != length or crc != expected_crc:
+                f.truncate(offset)
+                return jsonify({'error': 'Кусок поврежден или передан не полностью', 'offset': offset}), 400
+            f.truncate(offset + written)
+        received = offset + written
+    finally:
+        conn.execute('''
+            UPDATE uploads SET status = 'uploading', received = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'receiving'
+        ''', (received, upload_id))
+        conn.commit()
+    return jsonify({'offset': received})
+
+@app.route('/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
+    """Завершение загрузки: файл принят полностью, запускаем обработку"""
+    # Обработку запускает только один из повторных запросов, в том числе из разных процессов
+    start_upload_processing(upload_id)
+    upload = get_upload(upload_id)
+    if upload is None:
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    if upload['status'] in ('uploading', 'receiving'):
+        return jsonify(upload_to_json(upload)), 409
+    return jsonify(upload_to_json(upload)), 202
+
 @app.route('/upload', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
@@ -1322,35 +5527,17 @@ def upload_file():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
-            # Сохраняем оригинальное название с поддержкой кириллицы
-            original_name = file.filename
-            unique_filename = get_unique_filename(VIDEO_FOLDER, original_name)
-            
-            file_path = os.path.join(VIDEO_FOLDER, unique_filename)
-            file.save(file_path)
-            
-            # Определяем информацию о видео
-            detected_orientation, width, height, duration = detect_video_info(unique_filename)
-            
-            # Используем выбранную ориентацию или определенную автоматически
-            if orientation == 'auto':
-                final_orientation = detected_orientation
-            else:
-                final_orientation = orientation
-            
-            # Сохраняем информацию в базе данных
-            conn = sqlite3.connect(DATABASE_PATH)
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO videos 
-                (filename, orientation, display_name, width, height, duration, banned, views, likes, dislikes)
-                VALUES (?, ?, ?, ?, ?, ?, 0, 0, 0, 0)
-            ''', (unique_filename, final_orientation, original_name, width, height, duration))
+            # Обычная отправка формы (без JavaScript): сохраняем целиком, обрабатываем в фоне
+            upload_id = create_upload(file.filename, None, orientation)
+            temp_path = get_upload_temp_path(upload_id)
+            file.save(temp_path)
+            size = os.path.getsize(temp_path)
+            conn = get_db()
+            conn.execute('UPDATE uploads SET size = ?, received = ? WHERE id = ?', (size, size, upload_id))
             conn.commit()
-            conn.close()
+            start_upload_processing(upload_id)
             
-            log_admin_action("Загрузка видео", f"Файл: {unique_filename}, Ориентация: {final_orientation}, Размеры: {width}x{height}, Длительность: {duration}сек")
-            flash('Файл успешно загружен и проанализирован')
+            flash('Файл загружен, анализ выполняется в фоне')
             return redirect(url_for('index'))
         else:
             flash('Недопустимый тип файла. Разрешены: mp4, avi, mov, mkv, webm')
@@ -1359,50 +5546,36 @@ def upload_file():
 
 @app.route('/admin/fix_orientations', methods=['POST'])
 def admin_fix_orientations():
-    """Исправление ориентации видео, которые неправильно определены"""
-    global admin_access
-    if not admin_access:
+    """Исправление ориентации видео, которые неправильно определены (фоновая задача)"""
+    if not has_admin_access():
         return jsonify({'error': 'Доступ запрещен'}), 403
     
-    # Получаем все видео
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-        cursor.execute('SELECT filename, orientation FROM videos')
-        all_videos = cursor.fetchall()
-        conn.close()
-    
-    # Исправляем ориентацию для каждого видео
-    fixed_count = 0
-    for filename, current_orientation in all_videos:
-        # Определяем правильную ориентацию
-        orientation, width, height, duration = detect_video_info(filename)
-        
-        # Если ориентация определена и отличается от текущей
-        if orientation != "unknown" and orientation != current_orientation:
-            with db_lock:
-                conn = sqlite3.connect(DATABASE_PATH)
-                cursor = conn.cursor()
-                cursor.execute('UPDATE videos SET orientation = ?, width = ?, height = ?, duration = ? WHERE filename = ?', 
-                              (orientation, width, height, duration, filename))
-                conn.commit()
-                conn.close()
-                fixed_count += 1
-                print(f"Исправлена ориентация: {filename} - было '{current_orientation}', стало '{orientation}'")
+    job_id, created = job_manager.submit('fix_orientations', force=request.values.get('force') == '1')
+    flash_job_started(job_id, created)
     
-    # log_admin_action("Исправление ориентаций", 
-    #                 f"Исправлено {fixed_count} видео")
-    flash(f'Ориентация исправлена для {fixed_count} видео')
+    return redirect(url_for('admin'))
+
+def start_worker_services():
+    """Фоновая работа процесса: аренды, сканер (у ведущего), сбор показателей.
     
-    return redirect(url_for('index'))  # Возвращаем на главную страницу
+    Вызывается в каждом процессе, который обслуживает запросы (после fork).
+    """
+    reload_filename_index()
+    release_db()
+    coordinator.start()
+    atexit.register(coordinator.shutdown)
+    system_sampler.start()
 
 if __name__ == '__main__':
     # Инициализация базы данных
     init_database()
+    revoke_admin_access()
     
-    # Запуск фонового сканирования
-    scanner_thread = threading.Thread(target=background_scanner, daemon=True)
-    scanner_thread.start()
+    # Режим разработки. Для работы в сети запускайте serve.py (несколько процессов)
+    # Перезагрузчик отладчика запускает сервер в дочернем процессе: фоновую работу стартуем только в нем
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Ведущий процесс сканирует папку и продолжает задачи, загрузки и HLS, прерванные при прошлой остановке
+        start_worker_services()
     
     local_ip = get_local_ip()
     print("=" * 60)
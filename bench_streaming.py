@@ -0,0 +1,195 @@
+"""Сравнение скорости отдачи видео: новый serve_video против прежнего send_file.
+
+Создает временную папку с тестовым файлом, запускает сервер и нагружает его
+множеством клиентов, которые запрашивают случайные диапазоны байт.
+
+Запуск:
+    python bench_streaming.py --clients 32 --seconds 10
+    python bench_streaming.py --server gunicorn   # sendfile через wsgi.file_wrapper
+"""
+import argparse
+import http.client
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import send_file, jsonify
+from werkzeug.serving import make_server
+
+import app as nantube
+
+BENCH_FILENAME = 'bench.mp4'
+
+
+def add_legacy_route():
+    """Прежняя реализация serve_video для сравнения"""
+    @nantube.app.route('/bench_legacy/<path:filename>')
+    def bench_legacy_video(filename):
+        if nantube.is_video_banned(filename):
+            return jsonify({'error': 'Video is banned'}), 403
+        file_path = nantube.get_video_file_path(filename)
+        if file_path is None or not os.path.exists(file_path):
+            return jsonify({'error': 'Video not found'}), 404
+        return send_file(file_path, mimetype='video/mp4', as_attachment=False, conditional=True)
+
+
+def prepare_library(work_dir, size_mb):
+    """Создает тестовую библиотеку с одним файлом и базу данных"""
+    nantube.VIDEO_FOLDER = os.path.join(work_dir, 'videos')
+    nantube.DATABASE_PATH = os.path.join(work_dir, 'bench.db')
+    nantube.THUMBNAIL_FOLDER = os.path.join(work_dir, 'thumbnails')
+    nantube.SCAN_SETTLE_SECONDS = 0
+    os.makedirs(nantube.VIDEO_FOLDER)
+
+    block = os.urandom(1024 * 1024)
+    with open(os.path.join(nantube.VIDEO_FOLDER, BENCH_FILENAME), 'wb') as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+    nantube.init_database()
+    nantube.scan_videos_folder()
+    nantube.release_db()
+    return size_mb * 1024 * 1024
+
+
+def start_werkzeug(port):
+    server = make_server('127.0.0.1', port, nantube.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def start_gunicorn(port, threads):
+    """Запускает gunicorn (gthread) в дочернем процессе"""
+    import multiprocessing
+    from gunicorn.app.base import BaseApplication
+
+    class BenchApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'127.0.0.1:{port}')
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('workers', 1)
+            self.cfg.set('threads', threads)
+            self.cfg.set('loglevel', 'warning')
+
+        def load(self):
+            return nantube.app
+
+    process = multiprocessing.get_context('fork').Process(target=BenchApplication().run, daemon=True)
+    process.start()
+    # Ждем, пока сервер начнет принимать соединения
+    for _ in range(100):
+        try:
+            http.client.HTTPConnection('127.0.0.1', port, timeout=1).connect()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    def stop():
+        process.terminate()
+        process.join()
+    return stop
+
+
+def run_clients(port, path, size, clients, seconds, range_size):
+    """Нагружает сервер запросами случайных диапазонов и собирает статистику"""
+    deadline = time.monotonic() + seconds
+    latencies = []
+    totals = {'bytes': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def client():
+        rnd = random.Random()
+        conn = None
+        local_latencies = []
+        local_bytes = 0
+        local_errors = 0
+        while time.monotonic() < deadline:
+            start = rnd.randrange(0, size - range_size)
+            headers = {'Range': f'bytes={start}-{start + range_size - 1}'}
+            started = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                if response.status != 206 or len(body) != range_size:
+                    local_errors += 1
+                if response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                if conn is not None:
+                    conn.close()
+                conn = None
+                continue
+            local_latencies.append(time.perf_counter() - started)
+            local_bytes += len(body)
+        if conn is not None:
+            conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            totals['bytes'] += local_bytes
+            totals['errors'] += local_errors
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed,
+        'mb_per_s': totals['bytes'] / elapsed / (1024 * 1024),
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+        'errors': totals['errors'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк отдачи видео')
+    parser.add_argument('--clients', type=int, default=32, help='Число одновременных клиентов')
+    parser.add_argument('--seconds', type=float, default=10, help='Длительность каждого прогона')
+    parser.add_argument('--size-mb', type=int, default=256, help='Размер тестового файла (МБ)')
+    parser.add_argument('--range-kb', type=int, default=1024, help='Размер запрашиваемого диапазона (КБ)')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn'), default='werkzeug')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='nantube-bench-')
+    try:
+        size = prepare_library(work_dir, args.size_mb)
+        add_legacy_route()
+        if args.server == 'gunicorn':
+            stop = start_gunicorn(args.port, args.clients)
+        else:
+            stop = start_werkzeug(args.port)
+
+        try:
+            print(f"Сервер: {args.server}, клиентов: {args.clients}, файл: {args.size_mb} МБ, "
+                  f"диапазон: {args.range_kb} КБ, {args.seconds:.0f}с на прогон")
+            print(f"{'Реализация':<12} {'Запросов/с':>11} {'МБ/с':>9} {'p50, мс':>9} {'p95, мс':>9} {'Ошибок':>7}")
+            for name, path in (('send_file', f'/bench_legacy/{BENCH_FILENAME}'),
+                               ('serve_video', f'/video/{BENCH_FILENAME}')):
+                result = run_clients(args.port, path, size, args.clients, args.seconds, args.range_kb * 1024)
+                print(f"{name:<12} {result['rps']:>11.1f} {result['mb_per_s']:>9.1f} "
+                      f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['errors']:>7}")
+        finally:
+            stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
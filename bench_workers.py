@@ -0,0 +1,148 @@
+"""Масштабирование по числу процессов: запросов в секунду при 1, 2, 4... процессах serve.py.
+
+Создает временную библиотеку из пустых файлов, для каждого числа процессов
+запускает serve.py и нагружает его клиентами из отдельных процессов
+(чтобы сами клиенты не упирались в GIL).
+
+Запуск:
+    python bench_workers.py --workers 1 2 4 --clients 32 --seconds 10
+    python bench_workers.py --paths / /api/videos?limit=48
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import app as nantube
+
+DEFAULT_PATHS = ['/api/videos', '/api/videos?sort_by=views', '/api/vertical_videos_list', '/?search=video']
+
+
+def prepare_library(work_dir, videos):
+    """Создает папку с пустыми видео и базу данных, уже заполненную сканером"""
+    video_folder = os.path.join(work_dir, 'videos')
+    database = os.path.join(work_dir, 'bench.db')
+    os.makedirs(video_folder)
+    for i in range(videos):
+        # Ориентация определяется по имени: без OpenCV файлы не анализируются
+        name = f'video {i:05d} shorts.mp4' if i % 3 == 0 else f'video {i:05d}.mp4'
+        with open(os.path.join(video_folder, name), 'wb') as f:
+            f.write(b'\0' * 1024)
+
+    nantube.VIDEO_FOLDER = video_folder
+    nantube.DATABASE_PATH = database
+    nantube.SCAN_SETTLE_SECONDS = 0
+    nantube.init_database()
+    nantube.scan_videos_folder()
+    nantube.close_db_connections()
+    return video_folder, database
+
+
+def start_server(port, workers, server, video_folder, database):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers), '--server', server,
+         '--video-folder', video_folder, '--database', database, '--quiet'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Ждем, пока сервер начнет отвечать
+    for _ in range(200):
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/api/videos?limit=1')
+            if conn.getresponse().status == 200:
+                break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        process.terminate()
+        raise RuntimeError('Сервер не запустился')
+    return process
+
+
+def run_client(port, paths, deadline):
+    """Один клиент с постоянным соединением: возвращает задержки и число ошибок"""
+    rnd = random.Random()
+    latencies = []
+    errors = 0
+    conn = None
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', rnd.choice(paths))
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+            if response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+            continue
+        latencies.append(time.perf_counter() - started)
+    if conn is not None:
+        conn.close()
+    return latencies, errors
+
+
+def run_load(port, paths, clients, seconds):
+    deadline = time.time() + seconds
+    with multiprocessing.Pool(clients) as pool:
+        results = pool.starmap(run_client, [(port, paths, deadline)] * clients)
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    return {
+        'rps': len(latencies) / seconds,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+        'errors': sum(errors for _, errors in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк масштабирования по процессам')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Числа процессов для сравнения')
+    parser.add_argument('--clients', type=int, default=32, help='Число одновременных клиентов (процессов)')
+    parser.add_argument('--seconds', type=float, default=10, help='Длительность каждого прогона')
+    parser.add_argument('--videos', type=int, default=2000, help='Размер тестовой библиотеки')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS, help='Запрашиваемые адреса')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'fork'), default='auto')
+    parser.add_argument('--port', type=int, default=5098)
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='nantube-bench-')
+    try:
+        video_folder, database = prepare_library(work_dir, args.videos)
+        print(f"Сервер: {args.server}, клиентов: {args.clients}, видео: {args.videos}, "
+              f"ядер: {os.cpu_count()}, {args.seconds:.0f}с на прогон")
+        print(f"{'Процессов':>9} {'Запросов/с':>11} {'Ускорение':>10} {'p50, мс':>9} {'p95, мс':>9} {'Ошибок':>7}")
+        baseline = None
+        for workers in args.workers:
+            process = start_server(args.port, workers, args.server, video_folder, database)
+            try:
+                # Прогрев: снимки каталога и шаблоны в каждом процессе
+                run_load(args.port, args.paths, args.clients, 1)
+                result = run_load(args.port, args.paths, args.clients, args.seconds)
+            finally:
+                process.terminate()
+                process.wait()
+            baseline = baseline or result['rps']
+            print(f"{workers:>9} {result['rps']:>11.1f} {result['rps'] / baseline:>9.2f}x "
+                  f"{result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['errors']:>7}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
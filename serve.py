@@ -0,0 +1,175 @@
+"""Запуск NanTube для работы в сети: несколько процессов без отладчика.
+
+    python serve.py --workers 4
+    python serve.py --workers 4 --port 8000 --video-folder /srv/videos
+
+Если установлен gunicorn (Linux/macOS), процессы запускает он (gthread).
+Без gunicorn на Linux/macOS процессы создаются через fork и принимают
+соединения с общего сокета. На Windows fork нет: используется waitress,
+если он установлен, иначе один процесс с потоками.
+
+Общее состояние процессов хранится в SQLite (см. ProcessCoordinator в app.py):
+папку сканирует только один, ведущий, процесс.
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+import app as nantube
+
+
+def configure(args):
+    if args.video_folder:
+        nantube.VIDEO_FOLDER = args.video_folder
+    if args.database:
+        nantube.DATABASE_PATH = args.database
+
+
+def prepare_master():
+    """Миграции выполняются один раз до запуска процессов.
+
+    Соединения с БД закрываются: дочерние процессы не должны наследовать их через fork.
+    Админский доступ, выданный до перезапуска, сбрасывается.
+    """
+    nantube.init_database()
+    nantube.revoke_admin_access()
+    nantube.close_db_connections()
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class NanTubeApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('post_fork', lambda server, worker: nantube.start_worker_services())
+
+        def load(self):
+            return nantube.app
+
+    NanTubeApplication().run()
+
+
+def run_worker(args, listener):
+    """Дочерний процесс: свой поток на запрос, соединения принимаются с общего сокета"""
+    # SIGTERM от главного процесса завершает сервер так же, как Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        nantube.start_worker_services()
+        server = make_server(args.host, args.port, nantube.app, threaded=True, fd=listener.fileno())
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Записываем просмотры и ленты shorts, аренды отдаем сразу, не дожидаясь их истечения
+        nantube.view_aggregator.shutdown()
+        nantube.shorts_feeds.shutdown()
+        nantube.coordinator.shutdown()
+        os._exit(0)
+
+
+def run_prefork(args):
+    """Главный процесс создает сокет, запускает рабочие процессы и перезапускает упавшие"""
+    listener = socket.create_server((args.host, args.port), backlog=2048)
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(args, listener)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(args.workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Запущено процессов: {args.workers} (fork)")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"Процесс {pid} завершился (код {os.waitstatus_to_exitcode(status)}), запускаем новый")
+            time.sleep(1)
+            spawn()
+    listener.close()
+
+
+def run_single(args):
+    """Один процесс: waitress, если он установлен, иначе многопоточный сервер Werkzeug"""
+    nantube.start_worker_services()
+    try:
+        import waitress
+    except ImportError:
+        print("waitress не установлен, используется сервер Werkzeug (pip install waitress)")
+        make_server(args.host, args.port, nantube.app, threaded=True).serve_forever()
+        return
+    waitress.serve(nantube.app, host=args.host, port=args.port, threads=args.threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NanTube: запуск в нескольких процессах')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Число процессов')
+    parser.add_argument('--threads', type=int, default=16, help='Потоков на процесс (gunicorn и waitress)')
+    parser.add_argument('--server', choices=('auto', 'gunicorn', 'fork', 'single'), default='auto')
+    parser.add_argument('--video-folder', help='Папка с видео (вместо VIDEO_FOLDER из app.py)')
+    parser.add_argument('--database', help='Файл базы данных (вместо DATABASE_PATH из app.py)')
+    parser.add_argument('--quiet', action='store_true', help='Не писать в консоль каждый запрос')
+    args = parser.parse_args()
+
+    configure(args)
+    if args.quiet:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = args.server
+    if server == 'auto':
+        try:
+            import gunicorn  # noqa: F401
+            server = 'gunicorn'
+        except ImportError:
+            server = 'fork' if hasattr(os, 'fork') else 'single'
+    if server == 'fork' and not hasattr(os, 'fork'):
+        print("fork недоступен на этой системе, запускается один процесс")
+        server = 'single'
+
+    prepare_master()
+    print("=" * 60)
+    print(f"Сервер запускается ({server})...")
+    print(f"Главная: http://{nantube.get_local_ip()}:{args.port}")
+    print("=" * 60)
+    sys.stdout.flush()
+
+    if server == 'gunicorn':
+        run_gunicorn(args)
+    elif server == 'fork':
+        run_prefork(args)
+    else:
+        run_single(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Общие фикстуры: приложение с отдельной папкой видео и базой данных во временной папке"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as nantube_app  # noqa: E402
+
+
+@pytest.fixture
+def nantube(tmp_path, monkeypatch):
+    """Модуль app, настроенный на пустую библиотеку в tmp_path"""
+    nantube_app.close_db_connections()
+    monkeypatch.setattr(nantube_app, 'VIDEO_FOLDER', str(tmp_path / 'videos'))
+    monkeypatch.setattr(nantube_app, 'DATABASE_PATH', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(nantube_app, 'THUMBNAIL_FOLDER', str(tmp_path / 'thumbnails'))
+    monkeypatch.setattr(nantube_app, 'HLS_FOLDER', str(tmp_path / 'hls'))
+    monkeypatch.setattr(nantube_app, 'SCAN_SETTLE_SECONDS', 0)
+    monkeypatch.setattr(nantube_app, 'HLS_ENABLED', False)
+    monkeypatch.setattr(nantube_app, 'FASTSTART_ENABLED', False)
+    # Состояние в памяти процесса не должно переходить из теста в тест
+    monkeypatch.setattr(nantube_app, 'filename_index', nantube_app.FilenameIndex())
+    monkeypatch.setattr(nantube_app, 'shorts_feeds', nantube_app.ShortsFeedStore(
+        nantube_app.SHORTS_FEED_MAX_SESSIONS, nantube_app.SHORTS_FEED_IDLE_SECONDS, False, 3600))
+    monkeypatch.setattr(nantube_app, 'view_aggregator', nantube_app.ViewAggregator(
+        3600, nantube_app.VIEW_FLUSH_THRESHOLD, nantube_app.VIEW_DEDUPE_SECONDS, nantube_app.VIEW_DEDUPE_MAX_ENTRIES,
+        nantube_app.VIEW_BUFFER_MAX_ENTRIES))
+    cache = nantube_app.catalog_cache
+    monkeypatch.setattr(cache, 'snapshot', None)
+    monkeypatch.setattr(cache, 'shared_version', None)
+    monkeypatch.setattr(cache, 'checked_at', 0)
+    cache.version += 1
+
+    os.makedirs(nantube_app.VIDEO_FOLDER)
+    nantube_app.init_database()
+    yield nantube_app
+    # Буфер просмотров записывается в базу этого теста, а не при выходе из интерпретатора
+    nantube_app.view_aggregator.flush()
+    nantube_app.close_db_connections()
+
+
+@pytest.fixture
+def client(nantube):
+    return nantube.app.test_client()
+
+
+@pytest.fixture
+def admin_client(nantube, client):
+    nantube.set_shared_state('admin_access', '1')
+    return client
+
+
+def add_video(nantube, name, data=b'\0' * 1000):
+    """Создает файл видео в библиотеке (ориентация без OpenCV определяется по имени)"""
+    path = os.path.join(nantube.VIDEO_FOLDER, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
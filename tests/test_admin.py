@@ -0,0 +1,16 @@
+"""Админский доступ"""
+import serve
+
+
+def test_grant_is_shared_and_revoked_on_restart(nantube, client):
+    assert client.post('/admin/rescan_videos').status_code == 403
+    client.get('/grant_admin')
+    # Доступ виден всем клиентам и процессам через общую БД
+    other = nantube.app.test_client()
+    assert nantube.has_admin_access()
+    assert other.get('/admin').status_code == 200
+
+    # Перезапуск сервера (подготовка главного процесса в serve.py) сбрасывает доступ
+    serve.prepare_master()
+    assert not nantube.has_admin_access()
+    assert client.post('/admin/rescan_videos').status_code == 403
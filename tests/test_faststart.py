@@ -0,0 +1,125 @@
+"""Перепаковка MP4/MOV для быстрого старта: поиск moov и сохранность исходного файла"""
+import os
+import struct
+import subprocess
+
+import pytest
+
+import app
+from conftest import add_video
+
+
+def box(kind, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), kind) + payload
+
+
+def box64(kind, payload=b''):
+    return struct.pack('>I4sQ', 1, kind, 16 + len(payload)) + payload
+
+
+FTYP = box(b'ftyp', b'isom\0\0\2\0')
+MOOV = box(b'moov', box(b'mvhd', b'\0' * 100))
+MDAT = box(b'mdat', b'\1' * 1000)
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize('data, expected', [
+    (FTYP + MOOV + MDAT, False),
+    (FTYP + MDAT + MOOV, True),
+    (FTYP + box(b'free', b'\0' * 16) + MDAT + box(b'free') + MOOV, True),
+    # mdat с 64-битным размером
+    (FTYP + box64(b'mdat', b'\1' * 1000) + MOOV, True),
+    (FTYP + box64(b'mdat', b'\1' * 1000), False),
+    # mdat до конца файла (размер 0): moov после него быть не может
+    (FTYP + struct.pack('>I4s', 0, b'mdat') + b'\1' * 100 + MOOV, False),
+    # Обрыв: заголовок 64-битного размера не дописан, атом длиннее файла, размер меньше заголовка
+    (FTYP + MDAT + struct.pack('>I4s', 1, b'moov') + b'\0\0', False),
+    (FTYP + MDAT + struct.pack('>I4s', 500, b'moov'), True),
+    (FTYP + box(b'mdat')[:4] + b'md', False),
+    (FTYP + struct.pack('>I4s', 4, b'mdat') + MOOV, False),
+    (b'', False),
+], ids=['moov-first', 'moov-last', 'free-boxes', 'mdat-64bit', 'no-moov', 'mdat-to-eof',
+        'truncated-64bit-header', 'moov-past-eof', 'truncated-header', 'size-below-header', 'empty'])
+def test_has_trailing_moov(tmp_path, data, expected):
+    assert app.has_trailing_moov(write(tmp_path, data)) is expected
+
+
+@pytest.fixture
+def slow_start_video(nantube):
+    data = FTYP + MDAT + MOOV
+    add_video(nantube, 'clip.mp4', data)
+    nantube.scan_videos_folder()
+    return data
+
+
+def optimized_status(nantube):
+    return nantube.get_db().execute(
+        "SELECT status, error FROM optimized_files WHERE filename = 'clip.mp4'").fetchone()
+
+
+def folder_files(nantube):
+    return sorted(os.listdir(nantube.VIDEO_FOLDER))
+
+
+def read_video(nantube):
+    with open(os.path.join(nantube.VIDEO_FOLDER, 'clip.mp4'), 'rb') as f:
+        return f.read()
+
+
+def test_not_scheduled_without_ffmpeg(nantube, monkeypatch):
+    monkeypatch.setattr(nantube, 'FASTSTART_ENABLED', True)
+    monkeypatch.setattr(nantube.shutil, 'which', lambda name: None)
+    assert nantube.schedule_faststart('clip.mp4') is False
+
+
+def fake_ffmpeg(output=None, error=None):
+    """Подмена subprocess.run: пишет output во временный файл и/или бросает error"""
+    def run(cmd, **kwargs):
+        if output is not None:
+            with open(cmd[-1], 'wb') as f:
+                f.write(output)
+        if error is not None:
+            raise error
+        return subprocess.CompletedProcess(cmd, 0, b'', b'')
+    return run
+
+
+@pytest.mark.parametrize('run, message', [
+    (fake_ffmpeg(error=FileNotFoundError(2, 'No such file or directory', 'ffmpeg')), 'No such file'),
+    # ffmpeg упал, успев записать часть файла
+    (fake_ffmpeg(output=FTYP + MDAT[:100],
+                 error=subprocess.CalledProcessError(1, 'ffmpeg', stderr=b'Invalid data found')), 'Invalid data'),
+    # ffmpeg отработал, но moov все равно в конце
+    (fake_ffmpeg(output=FTYP + MDAT + MOOV), 'moov'),
+], ids=['ffmpeg-missing', 'ffmpeg-failed', 'moov-still-last'])
+def test_failed_remux_keeps_original(nantube, monkeypatch, slow_start_video, run, message):
+    monkeypatch.setattr(nantube.subprocess, 'run', run)
+    nantube.optimize_video_file('clip.mp4')
+
+    assert read_video(nantube) == slow_start_video
+    assert folder_files(nantube) == ['clip.mp4']
+    status, error = optimized_status(nantube)
+    assert status == 'failed'
+    assert message in error
+
+
+def test_remux_replaces_file_and_keeps_fingerprint(nantube, monkeypatch, slow_start_video):
+    remuxed = FTYP + MOOV + MDAT + b'\0'
+    monkeypatch.setattr(nantube.subprocess, 'run', fake_ffmpeg(output=remuxed))
+    nantube.optimize_video_file('clip.mp4')
+
+    assert read_video(nantube) == remuxed
+    assert folder_files(nantube) == ['clip.mp4']
+    assert optimized_status(nantube) == ('optimized', None)
+    # Сканер не считает перепакованный файл новой версией
+    assert nantube.scan_videos_folder() == {'new': 0, 'updated': 0, 'deleted': 0, 'unsettled': 0}
+
+    # Эта версия файла уже проверена: повторно ffmpeg не запускается
+    monkeypatch.setattr(nantube.subprocess, 'run', fake_ffmpeg(error=AssertionError('повторный запуск')))
+    nantube.optimize_video_file('clip.mp4')
+    assert optimized_status(nantube) == ('optimized', None)
@@ -0,0 +1,40 @@
+from urllib.parse import quote
+
+import pytest
+
+from conftest import add_video
+
+
+@pytest.fixture
+def large_library(nantube, monkeypatch):
+    """Каталог больше CATALOG_MAX_ITEMS: снимка в памяти нет, данные читаются из БД"""
+    add_video(nantube, 'wide.mp4')
+    add_video(nantube, 'tall shorts.mp4')
+    nantube.scan_videos_folder()
+    nantube.get_db().execute("UPDATE videos SET width = 1920, height = 1080 WHERE filename = 'wide.mp4'")
+    nantube.get_db().execute("UPDATE videos SET width = 360, height = 640 WHERE filename = 'tall shorts.mp4'")
+    nantube.get_db().commit()
+    monkeypatch.setattr(nantube.catalog_cache, 'max_items', 0)
+    nantube.invalidate_catalog()
+    assert nantube.get_catalog() is None
+
+    queued = []
+    monkeypatch.setattr(nantube, 'HLS_ENABLED', True)
+    monkeypatch.setattr(nantube, 'is_hls_available', lambda: True)
+    monkeypatch.setattr(nantube.hls_packager, 'enqueue', lambda filename, stat: queued.append(filename) or True)
+    return queued
+
+
+def test_pages_work_without_catalog_snapshot(nantube, client, large_library):
+    assert client.get('/watch/wide.mp4').status_code == 200
+    assert large_library == ['wide.mp4']
+    assert client.get('/vertical/' + quote('tall shorts.mp4')).status_code == 200
+    response = client.get('/api/shorts/batch?n=2')
+    assert response.status_code == 200
+
+
+def test_admin_package_without_catalog_snapshot(nantube, admin_client, large_library):
+    response = admin_client.post('/admin/hls/package')
+    assert response.status_code == 200
+    assert response.json['queued'] == 1
+    assert large_library == ['wide.mp4']
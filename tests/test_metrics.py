@@ -0,0 +1,18 @@
+from conftest import add_video
+
+
+def test_metrics_content_type_has_single_charset(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def test_metrics_count_requests_and_video_bytes(nantube, client):
+    add_video(nantube, 'a.mp4', b'x' * 5000)
+    nantube.scan_videos_folder()
+    assert client.get('/video/a.mp4', headers={'Range': 'bytes=0-99'}).status_code == 206
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'nantube_http_requests_total{endpoint="serve_video",method="GET",status="206"}' in text
+    assert 'nantube_video_bytes_served_total' in text
+    assert 'nantube_http_request_seconds_bucket{endpoint="serve_video",le="+Inf"}' in text
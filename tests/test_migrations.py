@@ -0,0 +1,133 @@
+"""Миграции схемы базы данных"""
+import sqlite3
+
+# Схема базы до появления миграций
+BASELINE_SCHEMA = '''
+    CREATE TABLE videos (
+        filename TEXT PRIMARY KEY,
+        orientation TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        banned INTEGER DEFAULT 0,
+        views INTEGER DEFAULT 0,
+        likes INTEGER DEFAULT 0,
+        dislikes INTEGER DEFAULT 0,
+        display_name TEXT,
+        duration REAL DEFAULT 0,
+        width INTEGER DEFAULT 0,
+        height INTEGER DEFAULT 0
+    );
+    CREATE TABLE video_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        filename TEXT,
+        watched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE banned_videos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT UNIQUE,
+        banned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        reason TEXT
+    );
+    CREATE TABLE admin_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        action TEXT,
+        details TEXT,
+        performed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE video_ratings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT,
+        filename TEXT,
+        rating INTEGER,
+        rated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(session_id, filename)
+    );
+    INSERT INTO videos (filename, orientation, display_name, views, banned, duration)
+    VALUES ('Кошка.mp4', 'horizontal', 'Кошка', 5, 0, 60),
+           ('shorts.mp4', 'vertical', 'shorts', 2, 0, 15),
+           ('bad.mp4', 'horizontal', 'bad', 0, 1, 30);
+    INSERT INTO banned_videos (filename, reason) VALUES ('bad.mp4', 'spam');
+    INSERT INTO video_history (session_id, filename) VALUES ('s1', 'Кошка.mp4'), ('s1', 'shorts.mp4');
+    INSERT INTO video_ratings (session_id, filename, rating) VALUES ('s1', 'Кошка.mp4', 1);
+'''
+
+
+def recreate_database(nantube, script):
+    """Заменяет базу теста базой, созданной скриптом (как будто ее оставила старая версия)"""
+    nantube.close_db_connections()
+    nantube.os.remove(nantube.DATABASE_PATH)
+    conn = sqlite3.connect(nantube.DATABASE_PATH)
+    conn.executescript(script)
+    conn.close()
+
+
+def auto_vacuum_mode(nantube):
+    return nantube.get_db().execute('PRAGMA auto_vacuum').fetchone()[0]
+
+
+def test_new_database_uses_incremental_vacuum(nantube):
+    assert auto_vacuum_mode(nantube) == 2
+    assert nantube.get_shared_state('incremental_vacuum') is None
+
+
+def applied_versions(nantube):
+    return [row[0] for row in nantube.get_db().execute('SELECT version FROM schema_version ORDER BY version')]
+
+
+def test_new_database_has_all_migrations(nantube):
+    assert applied_versions(nantube) == [version for version, _, _ in nantube.MIGRATIONS]
+    assert applied_versions(nantube)[-1] == 16
+
+    # Повторный запуск ничего не применяет и не падает
+    nantube.init_database()
+    assert applied_versions(nantube)[-1] == 16
+
+
+def test_baseline_database_is_upgraded_with_data(nantube):
+    recreate_database(nantube, BASELINE_SCHEMA)
+    nantube.init_database()
+    assert applied_versions(nantube) == list(range(1, 17))
+
+    conn = nantube.get_db()
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'video_files', 'probe_cache', 'uploads', 'jobs', 'leases', 'app_state', 'video_cowatch',
+            'video_neighbors', 'history_daily', 'shorts_navigation', 'video_stats_summary'} <= tables
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert 'idx_videos_views' in indexes
+
+    # Существующие данные сохранены, агрегаты и поисковый индекс заполнены
+    assert conn.execute('SELECT COUNT(*) FROM video_history').fetchone()[0] == 2
+    stats = nantube.get_video_stats()
+    assert stats['total_videos'] == 3
+    assert stats['banned_videos'] == 1
+    assert stats['vertical_videos'] == 1
+    assert stats['total_views'] == 7
+    assert conn.execute("SELECT filename FROM videos_fts WHERE videos_fts MATCH 'кошка'").fetchall() == [('Кошка.mp4',)]
+
+
+def test_database_from_older_release_is_upgraded(nantube, monkeypatch):
+    # База выпуска, в котором было 11 миграций: остальные применяются при запуске
+    recreate_database(nantube, BASELINE_SCHEMA)
+    with monkeypatch.context() as patch:
+        patch.setattr(nantube, 'MIGRATIONS', nantube.MIGRATIONS[:11])
+        nantube.init_database()
+    assert applied_versions(nantube) == list(range(1, 12))
+
+    nantube.init_database()
+    assert applied_versions(nantube) == list(range(1, 17))
+    assert nantube.get_video_stats()['total_views'] == 7
+
+
+def test_existing_database_is_not_vacuumed_on_startup(nantube):
+    # База, созданная старой версией: auto_vacuum = NONE
+    recreate_database(nantube, BASELINE_SCHEMA)
+
+    nantube.init_database()
+    assert auto_vacuum_mode(nantube) == 0
+    assert nantube.get_shared_state('incremental_vacuum') == 'pending'
+
+    result = nantube.app.test_cli_runner().invoke(args=['enable-incremental-vacuum'])
+    assert result.exit_code == 0, result.output
+    assert auto_vacuum_mode(nantube) == 2
+    assert nantube.get_shared_state('incremental_vacuum') is None
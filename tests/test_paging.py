@@ -0,0 +1,64 @@
+"""Постраничная выборка по курсору (keyset) в /api/videos"""
+import pytest
+
+
+@pytest.fixture
+def library(nantube):
+    conn = nantube.get_db()
+    rows = [('v%d.mp4' % i, 'vertical' if i % 3 == 0 else 'horizontal', i % 4, 0) for i in range(10)]
+    rows.append(('banned.mp4', 'horizontal', 100, 1))
+    conn.executemany('INSERT INTO videos (filename, orientation, display_name, views, banned) VALUES (?, ?, ?, ?, ?)',
+                     [(filename, orientation, filename, views, banned) for filename, orientation, views, banned in rows])
+    conn.commit()
+    return {filename: views for filename, _, views, banned in rows if not banned}
+
+
+def fetch_all(client, **params):
+    """Проходит все страницы; возвращает имена файлов в порядке выдачи и число запросов"""
+    filenames = []
+    cursor = None
+    requests = 0
+    while True:
+        query = dict(params, limit=3)
+        if cursor:
+            query['cursor'] = cursor
+        data = client.get('/api/videos', query_string=query).get_json()
+        requests += 1
+        filenames += [video['filename'] for video in data['videos']]
+        cursor = data['next_cursor']
+        if cursor is None:
+            return filenames, requests
+
+
+def test_pages_follow_sort_order_with_ties(client, library):
+    filenames, requests = fetch_all(client, sort='views', order='desc')
+    # Равные значения упорядочены по имени файла: ни пропусков, ни повторов на стыках страниц
+    assert filenames == sorted(library, key=lambda f: (library[f], f), reverse=True)
+    assert requests == 4
+
+    filenames, _ = fetch_all(client, sort='filename', order='asc')
+    assert filenames == sorted(library)
+
+
+def test_orientation_filter(client, library):
+    filenames, _ = fetch_all(client, orientation='vertical', sort='filename', order='asc')
+    assert filenames == ['v0.mp4', 'v3.mp4', 'v6.mp4', 'v9.mp4']
+
+
+def test_insert_between_pages_does_not_shift_results(nantube, client, library):
+    first = client.get('/api/videos', query_string={'sort': 'filename', 'order': 'asc', 'limit': 3}).get_json()
+    assert [video['filename'] for video in first['videos']] == ['v0.mp4', 'v1.mp4', 'v2.mp4']
+
+    # Новое видео перед курсором не сдвигает следующую страницу (в отличие от OFFSET)
+    conn = nantube.get_db()
+    conn.execute("INSERT INTO videos (filename, orientation, display_name) VALUES ('a.mp4', 'horizontal', 'a')")
+    conn.commit()
+    second = client.get('/api/videos', query_string={'sort': 'filename', 'order': 'asc', 'limit': 3,
+                                                     'cursor': first['next_cursor']}).get_json()
+    assert [video['filename'] for video in second['videos']] == ['v3.mp4', 'v4.mp4', 'v5.mp4']
+
+
+@pytest.mark.parametrize('cursor', ['not-base64!', 'e30', 'WzEsMiwzXQ'])
+def test_invalid_cursor_is_rejected(client, library, cursor):
+    response = client.get('/api/videos', query_string={'sort': 'views', 'cursor': cursor})
+    assert response.status_code == 400
@@ -0,0 +1,31 @@
+"""Рекомендации по совместным просмотрам"""
+
+
+def cowatch(nantube):
+    rows = nantube.get_db().execute('SELECT filename, neighbor, count FROM video_cowatch')
+    return {(filename, neighbor): count for filename, neighbor, count in rows}
+
+
+def neighbors(nantube, filename):
+    rows = nantube.get_db().execute('SELECT neighbor, score FROM video_neighbors WHERE filename = ? ORDER BY rank',
+                                    (filename,))
+    return rows.fetchall()
+
+
+def test_rename_merges_cowatch_counts(nantube):
+    conn = nantube.get_db()
+    conn.executemany("INSERT INTO videos (filename, orientation, display_name) VALUES (?, 'horizontal', ?)",
+                     [('a.mp4', 'a'), ('c.mp4', 'c')])
+    # У нового имени уже есть счетчики (например, от прежнего файла с тем же именем)
+    pairs = {('a.mp4', 'c.mp4'): 2, ('a.mp4', 'b.mp4'): 1, ('b.mp4', 'c.mp4'): 3}
+    conn.executemany('INSERT INTO video_cowatch (filename, neighbor, count) VALUES (?, ?, ?)',
+                     [(f, n, c) for (f, n), c in pairs.items()] + [(n, f, c) for (f, n), c in pairs.items()])
+    nantube.update_video_neighbors(conn.cursor(), {'a.mp4', 'b.mp4', 'c.mp4'})
+    conn.commit()
+
+    assert nantube.update_video_filename_in_database('a.mp4', 'b.mp4')
+
+    assert cowatch(nantube) == {('b.mp4', 'c.mp4'): 5, ('c.mp4', 'b.mp4'): 5}
+    assert neighbors(nantube, 'b.mp4') == [('c.mp4', 5)]
+    assert neighbors(nantube, 'c.mp4') == [('b.mp4', 5)]
+    assert neighbors(nantube, 'a.mp4') == []
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from conftest import add_video
+
+
+def video_names(nantube):
+    return {row[0] for row in nantube.get_db().execute('SELECT filename FROM videos')}
+
+
+def test_scan_adds_and_deletes(nantube):
+    add_video(nantube, 'a.mp4')
+    add_video(nantube, 'sub/b.mp4')
+    result = nantube.scan_videos_folder()
+    assert result['new'] == 2
+    assert video_names(nantube) == {'a.mp4', 'sub/b.mp4'}
+
+    # Повторный проход без изменений ничего не анализирует
+    assert nantube.scan_videos_folder()['new'] == 0
+
+    os.remove(os.path.join(nantube.VIDEO_FOLDER, 'a.mp4'))
+    assert nantube.scan_videos_folder()['deleted'] == 1
+    assert video_names(nantube) == {'sub/b.mp4'}
+
+
+def test_scan_raises_when_root_unreadable(nantube, monkeypatch):
+    add_video(nantube, 'a.mp4')
+    nantube.scan_videos_folder()
+    nantube.get_db().execute("UPDATE videos SET views = 7")
+    nantube.get_db().commit()
+
+    real_scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.normpath(path) == os.path.normpath(nantube.VIDEO_FOLDER):
+            raise PermissionError(13, 'Permission denied', path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    with pytest.raises(OSError):
+        nantube.scan_videos_folder()
+    assert nantube.get_db().execute("SELECT views FROM videos WHERE filename = 'a.mp4'").fetchone() == (7,)
+
+
+def test_scan_keeps_videos_in_unreadable_subfolder(nantube, monkeypatch):
+    add_video(nantube, 'a.mp4')
+    add_video(nantube, 'share/b.mp4')
+    add_video(nantube, 'share/deep/c.mp4')
+    add_video(nantube, 'other/d.mp4')
+    nantube.scan_videos_folder()
+
+    real_scandir = os.scandir
+    share = os.path.join(nantube.VIDEO_FOLDER, 'share')
+
+    def failing_scandir(path):
+        if os.path.normpath(path) == os.path.normpath(share):
+            raise OSError(5, 'Input/output error', path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    os.remove(os.path.join(nantube.VIDEO_FOLDER, 'other', 'd.mp4'))
+    result = nantube.scan_videos_folder()
+    # Удален только файл, который действительно пропал из прочитанной папки
+    assert result['deleted'] == 1
+    assert video_names(nantube) == {'a.mp4', 'share/b.mp4', 'share/deep/c.mp4'}
+
+
+def test_scan_skips_mass_delete_when_listing_failed(nantube, monkeypatch):
+    add_video(nantube, 'share/b.mp4')
+    add_video(nantube, 'share2/c.mp4')
+    nantube.scan_videos_folder()
+
+    real_scandir = os.scandir
+
+    def failing_scandir(path):
+        if os.path.normpath(path) != os.path.normpath(nantube.VIDEO_FOLDER):
+            raise OSError(5, 'Input/output error', path)
+        return real_scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    assert nantube.scan_videos_folder()['deleted'] == 0
+    assert video_names(nantube) == {'share/b.mp4', 'share2/c.mp4'}
+
+
+def test_scan_skipped_while_other_process_holds_lease(nantube):
+    add_video(nantube, 'a.mp4')
+    conn = nantube.get_db()
+    conn.execute("INSERT INTO leases (name, owner, expires_at) VALUES ('scan', 'other:1', ?)",
+                 (nantube.time.time() + 60,))
+    conn.commit()
+    assert nantube.scan_videos_folder() is None
+    assert video_names(nantube) == set()
+
+    conn.execute("DELETE FROM leases WHERE name = 'scan'")
+    conn.commit()
+    assert nantube.scan_videos_folder()['new'] == 1
+    # После прохода аренда отдана
+    assert conn.execute("SELECT COUNT(*) FROM leases WHERE name = 'scan'").fetchone()[0] == 0
+
+
+def test_rescan_job_cancelled_between_phases(nantube, monkeypatch):
+    add_video(nantube, 'a.mp4')
+    conn = nantube.get_db()
+    job_id = conn.execute("INSERT INTO jobs (type, status) VALUES ('rescan', 'queued')").lastrowid
+    conn.commit()
+
+    # Администратор отменяет задачу, пока сканер перечисляет файлы
+    real_sync = nantube.filename_index.sync
+
+    def sync_and_cancel(files):
+        real_sync(files)
+        nantube.job_manager.cancel(job_id)
+
+    monkeypatch.setattr(nantube.filename_index, 'sync', sync_and_cancel)
+    nantube.job_manager.run(job_id)
+
+    assert nantube.get_job(job_id)['status'] == 'cancelled'
+    assert video_names(nantube) == set()
+    assert conn.execute("SELECT COUNT(*) FROM leases WHERE name = 'scan'").fetchone()[0] == 0
@@ -0,0 +1,62 @@
+"""Поиск видео: FTS5 с ранжированием bm25 и запасной поиск через LIKE"""
+import pytest
+
+
+@pytest.fixture
+def library(nantube):
+    conn = nantube.get_db()
+    conn.executemany('INSERT INTO videos (filename, orientation, display_name, banned) VALUES (?, ?, ?, ?)', [
+        ('clip1.mp4', 'horizontal', 'Ёлка в лесу', 0),
+        ('clip2.mp4', 'vertical', 'Новогодняя елка', 0),
+        ('кошка_и_собака.mp4', 'horizontal', 'Домашние животные', 0),
+        ('clip3.mp4', 'horizontal', 'Кошка спит', 0),
+        ('clip4.mp4', 'horizontal', 'Кошка на ёлке', 1),
+    ])
+    conn.commit()
+
+
+def found(nantube, term, **kwargs):
+    return [video[0] for video in nantube.search_videos(term, **kwargs)[0]]
+
+
+@pytest.fixture(params=['fts', 'like'])
+def search_mode(request, nantube, monkeypatch):
+    """Оба способа поиска должны находить одно и то же (порядок может отличаться)"""
+    if request.param == 'like':
+        # SQLite без FTS5: индекс не создается
+        monkeypatch.setattr(nantube, 'is_fts_enabled', lambda: False)
+    return request.param
+
+
+def test_yo_and_ye_are_equal(nantube, library, search_mode):
+    assert sorted(found(nantube, 'елка')) == ['clip1.mp4', 'clip2.mp4']
+    assert sorted(found(nantube, 'ЁЛКА')) == ['clip1.mp4', 'clip2.mp4']
+
+
+def test_cyrillic_case_and_prefix(nantube, library, search_mode):
+    assert sorted(found(nantube, 'КОШ')) == ['clip3.mp4', 'кошка_и_собака.mp4']
+    assert found(nantube, 'кош', orientation='vertical') == []
+    assert found(nantube, 'новогод', orientation='vertical') == ['clip2.mp4']
+
+
+def test_title_match_ranks_above_filename_match(nantube, library):
+    assert found(nantube, 'кошка') == ['clip3.mp4', 'кошка_и_собака.mp4']
+
+
+def test_index_follows_renames(nantube, library):
+    conn = nantube.get_db()
+    conn.execute("UPDATE videos SET display_name = 'Зелёный лес' WHERE filename = 'clip1.mp4'")
+    conn.commit()
+    assert found(nantube, 'елка') == ['clip2.mp4']
+    assert found(nantube, 'зеленый') == ['clip1.mp4']
+    conn.execute("DELETE FROM videos WHERE filename = 'clip1.mp4'")
+    conn.commit()
+    assert found(nantube, 'зеленый') == []
+
+
+def test_paging_by_cursor(nantube, library):
+    videos, cursor = nantube.search_videos('кошка', limit=1)
+    assert [video[0] for video in videos] == ['clip3.mp4']
+    videos, cursor = nantube.search_videos('кошка', cursor=cursor, limit=1)
+    assert [video[0] for video in videos] == ['кошка_и_собака.mp4']
+    assert cursor is None
@@ -0,0 +1,106 @@
+from urllib.parse import quote
+
+from conftest import add_video
+
+
+def open_short(client, filename):
+    assert client.get('/vertical/' + quote(filename)).status_code == 200
+
+
+def next_short(client, current):
+    response = client.get('/api/shorts/next?current=' + quote(current))
+    assert response.status_code == 200
+    return response.json['filename']
+
+
+def test_next_never_repeats_current_after_round_ends(nantube, client):
+    add_video(nantube, 'a_shorts.mp4')
+    add_video(nantube, 'sub/d_shorts.mp4')
+    nantube.scan_videos_folder()
+
+    current = 'sub/d_shorts.mp4'
+    open_short(client, current)
+    for _ in range(30):
+        filename = next_short(client, current)
+        assert filename != current
+        open_short(client, filename)
+        current = filename
+
+
+def test_single_vertical_is_returned_again(nantube, client):
+    add_video(nantube, 'only_shorts.mp4')
+    nantube.scan_videos_folder()
+    open_short(client, 'only_shorts.mp4')
+    assert next_short(client, 'only_shorts.mp4') == 'only_shorts.mp4'
+
+
+def test_round_has_no_repeats_and_prev_walks_back(nantube, client):
+    names = [f'v{i}_shorts.mp4' for i in range(6)]
+    for name in names:
+        add_video(nantube, name)
+    nantube.scan_videos_folder()
+
+    current = names[0]
+    open_short(client, current)
+    watched = [current]
+    for _ in range(len(names) - 1):
+        current = next_short(client, current)
+        open_short(client, current)
+        watched.append(current)
+    assert sorted(watched) == sorted(names)
+
+    # Назад - по истории в обратном порядке, вперед - по той же истории
+    for expected in reversed(watched[:-1]):
+        response = client.get('/api/shorts/prev?current=' + quote(current))
+        assert response.json['filename'] == expected
+        current = expected
+    assert client.get('/api/shorts/prev?current=' + quote(current)).status_code == 404
+    assert next_short(client, current) == watched[1]
+
+
+def test_prev_after_repeat_view_returns_previous_entry(nantube, client):
+    for name in ('a_shorts.mp4', 'b_shorts.mp4', 'c_shorts.mp4'):
+        add_video(nantube, name)
+    nantube.scan_videos_folder()
+
+    for name in ('a_shorts.mp4', 'b_shorts.mp4', 'a_shorts.mp4', 'c_shorts.mp4'):
+        open_short(client, name)
+    response = client.get('/api/previous_vertical_video?current=c_shorts.mp4')
+    assert response.json['filename'] == 'a_shorts.mp4'
+    response = client.get('/api/previous_vertical_video?current=a_shorts.mp4')
+    assert response.json['filename'] == 'b_shorts.mp4'
+
+
+def test_batch_matches_next_order(nantube, client):
+    names = [f'v{i}_shorts.mp4' for i in range(8)]
+    for name in names:
+        add_video(nantube, name)
+    nantube.scan_videos_folder()
+
+    open_short(client, names[0])
+    response = client.get('/api/shorts/batch?n=3&current=' + quote(names[0]))
+    items = response.json['items']
+    assert len(items) == 3
+    assert {'duration', 'width', 'height', 'poster_url', 'size', 'video_url'} <= set(items[0])
+    assert items[0]['size'] == 1000
+    assert 'rel=preload' in response.headers['Link']
+
+    current = names[0]
+    for item in items:
+        current = next_short(client, current)
+        assert current == item['filename']
+        open_short(client, current)
+
+
+def test_direct_jump_releases_prefetched_items(nantube, client):
+    names = [f'v{i}_shorts.mp4' for i in range(4)]
+    for name in names:
+        add_video(nantube, name)
+    nantube.scan_videos_folder()
+
+    open_short(client, names[0])
+    ahead = [item['filename'] for item in client.get('/api/shorts/batch?n=2').json['items']]
+    jump = next(name for name in names[1:] if name not in ahead)
+    open_short(client, jump)
+    # Выбранные заранее, но не открытые видео не попадают в историю "назад"
+    assert client.get('/api/shorts/prev').json['filename'] == names[0]
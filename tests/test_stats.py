@@ -0,0 +1,84 @@
+"""Агрегаты статистики админки, которые поддерживают триггеры на таблице videos"""
+from conftest import add_video
+
+
+def assert_consistent(nantube):
+    """Агрегаты и список популярных совпадают с полным пересчетом по videos"""
+    cursor = nantube.get_db().cursor()
+    assert nantube.check_video_stats(cursor, nantube.POPULAR_VIDEOS_LIMIT) == []
+
+
+def execute(nantube, sql, params=()):
+    conn = nantube.get_db()
+    conn.execute(sql, params)
+    conn.commit()
+
+
+def test_summary_follows_every_change(nantube):
+    assert_consistent(nantube)
+    for i in range(8):
+        name = f'v{i}.mp4' if i % 2 else f'shorts {i}.mp4'
+        add_video(nantube, name)
+    nantube.scan_videos_folder()
+    for i in range(8):
+        execute(nantube, 'UPDATE videos SET views = ?, duration = ?, likes = ?, dislikes = ? WHERE rowid = ?',
+                (i * 3 % 7, i * 1.5, i, 8 - i, i + 1))
+    assert_consistent(nantube)
+
+    nantube.ban_video('v1.mp4', 'test')
+    assert_consistent(nantube)
+    nantube.unban_video('v1.mp4')
+    nantube.ban_video('v3.mp4')
+    assert_consistent(nantube)
+
+    # Переименование лидера списка популярных
+    leader = nantube.get_video_stats()['popular_videos'][0][0]
+    assert nantube.update_video_filename_in_database(leader, 'renamed.mp4')
+    assert nantube.get_video_stats()['popular_videos'][0][0] == 'renamed.mp4'
+    assert_consistent(nantube)
+
+    # INSERT OR REPLACE: строка удаляется и вставляется заново (с нулевыми счетчиками)
+    nantube.set_video_orientation('v5.mp4', 'horizontal')
+    nantube.set_video_orientation('new.mp4', 'unknown')
+    assert_consistent(nantube)
+
+    # Просмотры растут через буфер, уменьшаются при исправлениях вручную
+    for session_id in ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'h'):
+        nantube.add_to_history(session_id, 'v7.mp4')
+    nantube.view_aggregator.flush()
+    assert nantube.get_video_stats()['popular_videos'][0][0] == 'v7.mp4'
+    assert_consistent(nantube)
+    execute(nantube, "UPDATE videos SET views = 0 WHERE filename = 'v7.mp4'")
+    assert_consistent(nantube)
+
+    assert nantube.delete_video('renamed.mp4')
+    execute(nantube, "DELETE FROM videos WHERE filename = 'v3.mp4'")
+    assert_consistent(nantube)
+
+    stats = nantube.get_video_stats()
+    conn = nantube.get_db()
+    assert stats['total_videos'] == conn.execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+    assert stats['total_views'] == conn.execute('SELECT SUM(views) FROM videos').fetchone()[0]
+    assert len(stats['popular_videos']) == nantube.POPULAR_VIDEOS_LIMIT
+
+
+def test_check_stats_command_reports_and_rebuilds(nantube, monkeypatch):
+    for i in range(7):
+        add_video(nantube, f'v{i}.mp4')
+    nantube.scan_videos_folder()
+    runner = nantube.app.test_cli_runner()
+    assert 'совпадают' in runner.invoke(args=['check-stats']).output
+
+    execute(nantube, 'UPDATE video_stats_summary SET total_videos = 100')
+    result = runner.invoke(args=['check-stats'])
+    assert 'total_videos: 100, ожидалось 7' in result.output
+    assert nantube.get_video_stats()['total_videos'] == 100
+
+    # После изменения POPULAR_VIDEOS_LIMIT триггеры пересоздаются с новым пределом
+    monkeypatch.setattr(nantube, 'POPULAR_VIDEOS_LIMIT', 6)
+    result = runner.invoke(args=['check-stats', '--rebuild'])
+    assert 'Агрегаты пересчитаны' in result.output
+    assert nantube.get_video_stats()['total_videos'] == 7
+    execute(nantube, "UPDATE videos SET views = 3 WHERE filename = 'v0.mp4'")
+    assert len(nantube.get_video_stats()['popular_videos']) == 6
+    assert_consistent(nantube)
@@ -0,0 +1,124 @@
+"""Отдача видео: диапазоны байт, multipart/byteranges и условные запросы"""
+import os
+import re
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+from conftest import add_video
+
+DATA = os.urandom(10000)
+
+
+@pytest.fixture
+def video(nantube):
+    add_video(nantube, 'a.mp4', DATA)
+    nantube.scan_videos_folder()
+    return '/video/a.mp4'
+
+
+def get(client, url, **headers):
+    response = client.get(url, headers=headers)
+    body = response.get_data()
+    response.close()
+    return response, body
+
+
+def parse_multipart(response, body):
+    boundary = re.search(r'boundary=(\w+)', response.headers['Content-Type']).group(1).encode()
+    parts = []
+    for chunk in body.split(b'--' + boundary)[1:-1]:
+        head, _, data = chunk.partition(b'\r\n\r\n')
+        content_range = re.search(rb'Content-Range: bytes (\d+)-(\d+)/(\d+)', head)
+        parts.append((int(content_range.group(1)), int(content_range.group(2)), data[:-2]))
+    assert body.endswith(b'--' + boundary + b'--\r\n')
+    return parts
+
+
+def test_full_file(client, video):
+    response, body = get(client, video)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Type'] == 'video/mp4'
+    assert body == DATA
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=0-99', 0, 100),
+    ('bytes=9000-', 9000, 10000),
+    ('bytes=-500', 9500, 10000),
+    ('bytes=9990-20000', 9990, 10000),
+])
+def test_single_range(client, video, header, start, stop):
+    response, body = get(client, video, Range=header)
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes {start}-{stop - 1}/10000'
+    assert int(response.headers['Content-Length']) == stop - start
+    assert body == DATA[start:stop]
+
+
+def test_multiple_ranges_are_sent_as_multipart(client, video):
+    response, body = get(client, video, Range='bytes=0-9,500-599,-10')
+    assert response.status_code == 206
+    assert response.headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+    assert int(response.headers['Content-Length']) == len(body)
+    assert parse_multipart(response, body) == [(0, 9, DATA[0:10]), (500, 599, DATA[500:600]),
+                                               (9990, 9999, DATA[9990:])]
+
+
+def test_adjacent_ranges_are_merged(client, video):
+    response, body = get(client, video, Range='bytes=0-99,100-199')
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == 'bytes 0-199/10000'
+    assert body == DATA[:200]
+
+
+def test_suffix_range_does_not_absorb_other_ranges(client, video):
+    response, body = get(client, video, Range='bytes=0-9,-10')
+    assert parse_multipart(response, body) == [(0, 9, DATA[:10]), (9990, 9999, DATA[9990:])]
+    # Диапазон от конца файла, пересекающийся с предыдущим, объединяется с ним
+    response, body = get(client, video, Range='bytes=9000-9599,-500')
+    assert response.headers['Content-Range'] == 'bytes 9000-9999/10000'
+    assert body == DATA[9000:]
+
+
+def test_too_many_ranges_return_whole_file(nantube, client, video):
+    header = 'bytes=' + ','.join(f'{i * 100}-{i * 100 + 9}' for i in range(nantube.STREAM_MAX_RANGES + 1))
+    response, body = get(client, video, Range=header)
+    assert response.status_code == 200
+    assert body == DATA
+
+
+def test_unsatisfiable_range(client, video):
+    response, _ = get(client, video, Range='bytes=20000-')
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == 'bytes */10000'
+
+
+def test_if_range_with_other_version_returns_whole_file(client, video):
+    etag = get(client, video)[0].headers['ETag']
+    response, body = get(client, video, Range='bytes=0-99', **{'If-Range': etag})
+    assert response.status_code == 206
+    response, body = get(client, video, Range='bytes=0-99', **{'If-Range': '"other"'})
+    assert response.status_code == 200
+    assert body == DATA
+
+
+def test_conditional_request(client, video):
+    etag = get(client, video)[0].headers['ETag']
+    response, body = get(client, video, **{'If-None-Match': etag})
+    assert response.status_code == 304
+    assert body == b''
+
+
+@pytest.mark.parametrize('headers', [{}, {'Range': 'bytes=0-9'}, {'Range': 'bytes=0-9,20-29'}])
+def test_stream_is_closed_with_wsgi_iterator(nantube, video, headers):
+    environ = EnvironBuilder(path=video, headers=headers).get_environ()
+    app_iter = nantube.app.wsgi_app(environ, lambda status, response_headers, exc_info=None: None)
+    b''.join(app_iter)
+    # Тело еще не закрыто сервером: файл открыт
+    assert nantube.video_streams_in_flight.values.get((), 0) == 1
+    # Сервер закрывает итератор, пока сам держит ссылку на него
+    app_iter.close()
+    assert nantube.video_streams_in_flight.values.get((), 0) == 0
+    del app_iter
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='нужен fork')
+def test_sampler_reports_worker_process_after_fork(nantube):
+    # Главный процесс уже снимал показатели до fork (как serve.py до запуска рабочих)
+    nantube.system_sampler.latest()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            nantube.system_sampler.start()
+            os.write(write_fd, str(nantube.system_sampler.get_info()['pid']).encode())
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    reported = int(os.read(read_fd, 64))
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    assert reported == pid
+    assert nantube.system_sampler.get_info()['pid'] == os.getpid()
+
+
+def test_system_metrics_endpoint(admin_client):
+    response = admin_client.get('/admin/system/metrics?seconds=60')
+    assert response.status_code == 200
+    assert response.json['info']['pid'] == os.getpid()
+    assert 'process_memory' in response.json['latest']
@@ -0,0 +1,62 @@
+"""Кэш превью: повторные попытки после неудачи и очистка старых версий"""
+import os
+
+import pytest
+
+from conftest import add_video
+
+
+@pytest.fixture
+def extract(nantube, monkeypatch):
+    """Подмена извлечения кадра: записывает вызовы, результат задается через extract.ok"""
+    class FakeExtract:
+        ok = False
+        calls = 0
+
+        def __call__(self, video_path, output_path):
+            self.calls += 1
+            if self.ok:
+                with open(output_path, 'wb') as f:
+                    f.write(b'jpeg')
+            return self.ok
+
+    fake = FakeExtract()
+    monkeypatch.setattr(nantube, 'extract_thumbnail_frame', fake)
+    return fake
+
+
+def cached_files(nantube):
+    return sorted(name for _, _, files in os.walk(nantube.THUMBNAIL_FOLDER) for name in files)
+
+
+def test_failure_is_remembered_per_file_version(nantube, extract):
+    path = add_video(nantube, 'a.mp4', b'1' * 100)
+    assert nantube.get_thumbnail('a.mp4', path) is None
+    assert nantube.get_thumbnail('a.mp4', path) is None
+    assert extract.calls == 1
+    # Отметка лежит в кэше на диске: ее видят все процессы и она переживает перезапуск
+    assert [name.endswith('.failed') for name in cached_files(nantube)] == [True]
+
+    # Файл заменили: новая версия пробуется заново, отметка старой версии удаляется
+    add_video(nantube, 'a.mp4', b'2' * 200)
+    assert nantube.get_thumbnail('a.mp4', path) is None
+    assert extract.calls == 2
+    assert len(cached_files(nantube)) == 1
+
+    extract.ok = True
+    add_video(nantube, 'a.mp4', b'3' * 300)
+    thumb_path, _ = nantube.get_thumbnail('a.mp4', path)
+    assert cached_files(nantube) == [os.path.basename(thumb_path)]
+
+
+def test_failure_is_retried_after_timeout(nantube, extract):
+    path = add_video(nantube, 'a.mp4')
+    assert nantube.get_thumbnail('a.mp4', path) is None
+    failure_path = nantube.get_thumbnail_failure_path(*nantube.get_thumbnail_key('a.mp4', path))
+    old = os.path.getmtime(failure_path) - nantube.THUMBNAIL_RETRY_SECONDS - 1
+    os.utime(failure_path, (old, old))
+
+    extract.ok = True
+    assert nantube.get_thumbnail('a.mp4', path) is not None
+    assert extract.calls == 2
+    assert not os.path.exists(failure_path)
@@ -0,0 +1,91 @@
+"""Загрузка файлов частями: проверка CRC кусков и завершение загрузки"""
+import os
+import zlib
+
+import pytest
+
+
+@pytest.fixture
+def submitted(nantube, monkeypatch):
+    """Загрузки, переданные на фоновую обработку (сама обработка не запускается)"""
+    calls = []
+    monkeypatch.setattr(nantube.upload_queue, 'submit', calls.append)
+    return calls
+
+
+def start_upload(client, data):
+    response = client.post('/upload/init', json={'filename': 'clip.mp4', 'size': len(data)})
+    assert response.status_code == 201
+    return response.get_json()['upload_id']
+
+
+def send_chunk(client, upload_id, offset, data, crc=None):
+    if crc is None:
+        crc = zlib.crc32(data)
+    return client.put(f'/upload/{upload_id}/chunk?offset={offset}', data=data,
+                      headers={'X-Chunk-CRC32': f'{crc:08x}'})
+
+
+def test_chunk_with_wrong_crc_is_rejected(nantube, client):
+    data = os.urandom(3000)
+    upload_id = start_upload(client, data)
+
+    response = send_chunk(client, upload_id, 0, data[:1000], crc=zlib.crc32(data[:1000]) ^ 1)
+    assert response.status_code == 400
+    assert response.get_json()['offset'] == 0
+    assert client.get(f'/upload/{upload_id}').get_json()['offset'] == 0
+    assert os.path.getsize(nantube.get_upload_temp_path(upload_id)) == 0
+
+    assert send_chunk(client, upload_id, 0, data[:1000]).get_json() == {'offset': 1000}
+    # Кусок не с того места: сервер сообщает, откуда продолжать
+    response = send_chunk(client, upload_id, 2000, data[2000:])
+    assert response.status_code == 409
+    assert response.get_json()['offset'] == 1000
+    assert send_chunk(client, upload_id, 1000, data[1000:]).get_json() == {'offset': 3000}
+
+    with open(nantube.get_upload_temp_path(upload_id), 'rb') as f:
+        assert f.read() == data
+
+
+def test_chunk_rejected_while_another_request_writes(nantube, client):
+    data = os.urandom(1000)
+    upload_id = start_upload(client, data)
+    # Другой процесс уже пишет кусок с этого смещения
+    conn = nantube.get_db()
+    conn.execute("UPDATE uploads SET status = 'receiving' WHERE id = ?", (upload_id,))
+    conn.commit()
+
+    response = send_chunk(client, upload_id, 0, data)
+    assert response.status_code == 409
+    assert response.get_json()['status'] == 'uploading'
+    assert nantube.get_upload(upload_id)['received'] == 0
+
+
+def test_complete_starts_processing_once(nantube, client, submitted):
+    data = os.urandom(1000)
+    upload_id = start_upload(client, data)
+    assert client.post(f'/upload/{upload_id}/complete').status_code == 409
+
+    send_chunk(client, upload_id, 0, data)
+    for _ in range(3):
+        response = client.post(f'/upload/{upload_id}/complete')
+        assert response.status_code == 202
+        assert response.get_json()['status'] == 'processing'
+    assert submitted == [upload_id]
+
+
+def test_processed_upload_does_not_overwrite_existing_file(nantube, client, submitted):
+    data = os.urandom(1000)
+    with open(os.path.join(nantube.VIDEO_FOLDER, 'clip.mp4'), 'wb') as f:
+        f.write(b'old')
+    upload_id = start_upload(client, data)
+    send_chunk(client, upload_id, 0, data)
+    client.post(f'/upload/{upload_id}/complete')
+
+    nantube.process_upload(upload_id)
+    upload = nantube.get_upload(upload_id)
+    assert upload['status'] == 'done'
+    assert upload['filename'] == 'clip_1.mp4'
+    with open(os.path.join(nantube.VIDEO_FOLDER, 'clip_1.mp4'), 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(nantube.get_upload_temp_path(upload_id))
@@ -0,0 +1,35 @@
+"""Буфер просмотров: запись пачками и ограничение размера, пока БД недоступна"""
+from conftest import add_video
+
+
+def history_count(nantube):
+    return nantube.get_db().execute('SELECT COUNT(*) FROM video_history').fetchone()[0]
+
+
+def test_buffer_is_capped_while_flush_fails(nantube, client, monkeypatch):
+    add_video(nantube, 'a.mp4')
+    add_video(nantube, 'b.mp4')
+    nantube.scan_videos_folder()
+    aggregator = nantube.ViewAggregator(3600, 1000, 300, 1000, 3)
+    monkeypatch.setattr(nantube, 'view_aggregator', aggregator)
+    monkeypatch.setattr(aggregator, 'start', lambda: None)
+
+    conn = nantube.get_db()
+    conn.execute('ALTER TABLE video_history RENAME TO video_history_offline')
+    conn.commit()
+    for session_id in ('s1', 's2', 's3'):
+        aggregator.record(session_id, 'a.mp4')
+    assert aggregator.flush() == 0
+    for session_id in ('s4', 's5'):
+        aggregator.record(session_id, 'b.mp4')
+
+    # Отброшены два самых старых просмотра вместе с их счетчиками
+    assert [sid for sid, _, _ in aggregator.history] == ['s3', 's4', 's5']
+    assert aggregator.views == {'a.mp4': 1, 'b.mp4': 2}
+    assert aggregator.dropped == 2
+    assert 'nantube_views_dropped_total 2' in client.get('/metrics').get_data(as_text=True)
+
+    conn.execute('ALTER TABLE video_history_offline RENAME TO video_history')
+    conn.commit()
+    assert aggregator.flush() == 3
+    assert history_count(nantube) == 3